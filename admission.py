@@ -0,0 +1,102 @@
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reservations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    pid INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MemoryBudget:
+    """Budget for the memory of conversions in flight, shared by every worker through SQLite.
+
+    A conversion reserves its estimated decoded size before it is queued
+    and releases it once it is done. Reservations of workers that died
+    without releasing them are reclaimed on the next acquire.
+    """
+
+    def __init__(self, db_path, max_bytes):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._connect().executescript(SCHEMA)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _connect(self):
+        # One connection per thread, reopened after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def try_acquire(self, nbytes):
+        """Reserve nbytes if they fit in the budget; returns a reservation id or None"""
+        with self._transaction() as conn:
+            # Reclaim what dead workers left behind
+            for (pid,) in conn.execute('SELECT DISTINCT pid FROM reservations').fetchall():
+                if pid != os.getpid() and not pid_alive(pid):
+                    conn.execute('DELETE FROM reservations WHERE pid = ?', (pid,))
+            in_flight = conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM reservations').fetchone()[0]
+            if in_flight + nbytes > self.max_bytes:
+                return None
+            cursor = conn.execute(
+                'INSERT INTO reservations (pid, bytes, created_at) VALUES (?, ?, ?)',
+                (os.getpid(), nbytes, time.time())
+            )
+            return cursor.lastrowid
+
+    def acquire(self, nbytes, timeout):
+        """Wait up to timeout seconds for nbytes to fit; returns a reservation id or None"""
+        deadline = time.monotonic() + timeout
+        delay = 0.05
+        while True:
+            reservation = self.try_acquire(nbytes)
+            if reservation is not None or time.monotonic() >= deadline:
+                return reservation
+            time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+            delay = min(delay * 2, 0.5)
+
+    def release(self, reservation):
+        self._connect().execute('DELETE FROM reservations WHERE id = ?', (reservation,))
+
+    def in_flight(self):
+        """Bytes currently reserved by all workers"""
+        return self._connect().execute('SELECT COALESCE(SUM(bytes), 0) FROM reservations').fetchone()[0]
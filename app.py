@@ -1,22 +1,83 @@
-from flask import Flask, render_template, request, send_from_directory, jsonify, redirect, url_for
+from flask import (Flask, render_template, request, send_from_directory, jsonify, redirect, url_for, Response, g, make_response,
+                   copy_current_request_context)
 import os
 import uuid
 import time
 import shutil
 from pathlib import Path
-from PIL import Image
+import PIL
 import pillow_heif
+from PIL import Image, ImageColor
 import threading
 import datetime
 import json
+import inspect
+import functools
+from urllib.parse import quote
+from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.utils import safe_join, send_file as werkzeug_send_file
+from converter import (ConversionEngine, create_preview, estimate_memory, output_name, ENCODER_PRESETS, DEFAULT_PRESET,
+                       DEFAULT_BACKGROUND)
+from ingest import iter_upload_parts, spool_path, write_chunk, file_sha256
+from session_store import SessionStore, default_db_path
+from upload_store import UploadStore, RECEIVING, missing_ranges, is_orphaned
+from expiry import ExpiryScheduler
+from output_gc import OutputCollector
+from conversion_cache import ConversionCache
+from listing_cache import ListingCache
+from archive import archive_members, is_current, stream_archive, build_archive
+from metrics import Metrics
+from profiler import RequestProfiler
+from admission import MemoryBudget
 
 # Setup Flask app
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_DIR', 'uploads')
 app.config['OUTPUT_FOLDER'] = os.environ.get('OUTPUT_DIR', 'outputs')
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max upload
+app.config['UPLOAD_CHUNK_SIZE'] = int(os.environ.get('UPLOAD_CHUNK_SIZE', str(4 * 1024 * 1024)))  # bytes per request of a chunked upload
+if not 0 < app.config['UPLOAD_CHUNK_SIZE'] <= app.config['MAX_CONTENT_LENGTH']:
+    raise ValueError(f"UPLOAD_CHUNK_SIZE must be between 1 and {app.config['MAX_CONTENT_LENGTH']} bytes")
+app.config['MAX_FILE_SIZE'] = int(os.environ.get('MAX_FILE_SIZE', str(app.config['MAX_CONTENT_LENGTH'])))  # largest file a chunked upload accepts
+app.config['MAX_FILES'] = int(os.environ.get('MAX_FILES', '500'))  # files a chunked upload may declare
 app.config['EXPIRATION_TIME'] = int(os.environ.get('EXPIRATION_TIME', '3600'))  # 1 hour in seconds
-app.config['SESSION_FILE'] = os.environ.get('SESSION_FILE', 'sessions.json')
+app.config['SESSION_FILE'] = os.environ.get('SESSION_FILE', 'sessions.json')  # legacy, migrated on startup
+app.config['SESSION_DB'] = os.environ.get('SESSION_DB', default_db_path(app.config['SESSION_FILE']))
+app.config['SWEEP_INTERVAL'] = int(os.environ.get('SWEEP_INTERVAL', '300'))  # seconds between expiry index refills
+app.config['EXPIRY_SWEEPER'] = os.environ.get('EXPIRY_SWEEPER', '1') not in ('0', 'false', 'no')
+app.config['WEB_CONCURRENCY'] = int(os.environ.get('WEB_CONCURRENCY', '1'))  # gunicorn workers, which share the CPUs
+app.config['CONVERSION_WORKERS'] = int(os.environ.get('CONVERSION_WORKERS', str(max(1, (os.cpu_count() or 1) // app.config['WEB_CONCURRENCY']))))  # processes per app worker
+app.config['CONVERSION_TIMEOUT'] = int(os.environ.get('CONVERSION_TIMEOUT', '90'))  # seconds per file
+app.config['MAX_FRAMES'] = int(os.environ.get('MAX_FRAMES', '1000'))  # frames of an animation or multi-page file, 0 for no limit
+app.config['MAX_FRAME_PIXELS'] = int(os.environ.get('MAX_FRAME_PIXELS', '500000000'))  # pixels of all its frames together, 0 for no limit
+app.config['GC_INTERVAL'] = int(os.environ.get('GC_INTERVAL', '3600'))  # seconds between sweeps of the output folder, 0 disables the GC
+app.config['GC_GRACE'] = int(os.environ.get('GC_GRACE', str(7 * 24 * 3600)))  # seconds expired session directories are kept for troubleshooting
+app.config['GC_MAX_BYTES'] = int(os.environ.get('GC_MAX_BYTES', '0'))  # disk budget of all session directories, 0 for none
+app.config['GC_MAX_INODES'] = int(os.environ.get('GC_MAX_INODES', '0'))  # files and directories they may use together, 0 for none
+app.config['GC_BATCH_SIZE'] = int(os.environ.get('GC_BATCH_SIZE', '500'))  # session directories scanned between pauses
+app.config['CACHE_FOLDER'] = os.environ.get('CACHE_DIR', os.path.join(app.config['OUTPUT_FOLDER'], '.cache'))  # must share a filesystem with outputs for hardlinks
+app.config['CACHE_MAX_BYTES'] = int(os.environ.get('CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))  # 0 disables the cache
+app.config['LISTING_CACHE_SIZE'] = int(os.environ.get('LISTING_CACHE_SIZE', '1024'))  # session directory listings kept per process, 0 disables
+app.config['PREBUILD_ZIP'] = os.environ.get('PREBUILD_ZIP', '0').lower() in ('1', 'true', 'yes')  # build the download-all ZIP right after conversion
+app.config['ENCODER_PRESET'] = os.environ.get('ENCODER_PRESET', DEFAULT_PRESET)  # fast, balanced or smallest
+if app.config['ENCODER_PRESET'] not in ENCODER_PRESETS:
+    raise ValueError(f"Unknown ENCODER_PRESET {app.config['ENCODER_PRESET']!r}, use one of {', '.join(ENCODER_PRESETS)}")
+# Color transparent images are flattened onto for JPEG output, as #rrggbb (raises if it isn't a color)
+app.config['JPEG_BACKGROUND'] = '#%02x%02x%02x' % ImageColor.getrgb(os.environ.get('JPEG_BACKGROUND', DEFAULT_BACKGROUND))[:3]
+app.config['METRICS_DB'] = os.environ.get('METRICS_DB', os.path.join(os.path.dirname(app.config['SESSION_DB']) or '.', 'metrics.db'))
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', '')  # empty disables profiling
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))  # fraction of requests profiled without the header
+app.config['PROFILE_TOKEN'] = os.environ.get('PROFILE_TOKEN', '')  # required X-Profile header value, if set
+app.config['MEMORY_BUDGET'] = int(os.environ.get('MEMORY_BUDGET', str(2 * 1024 * 1024 * 1024)))  # estimated bytes of conversions in flight across workers, 0 disables
+app.config['ADMISSION_TIMEOUT'] = float(os.environ.get('ADMISSION_TIMEOUT', '30'))  # seconds a file may wait for memory before the upload gets a 503
+app.config['ADMISSION_RETRY_AFTER'] = int(os.environ.get('ADMISSION_RETRY_AFTER', '10'))  # Retry-After of that 503
+app.config['FILE_OFFLOAD'] = os.environ.get('FILE_OFFLOAD', '').lower()  # x-accel (nginx) or x-sendfile to let the front proxy send files
+if app.config['FILE_OFFLOAD'] not in ('', 'x-accel', 'x-sendfile'):
+    raise ValueError(f"Unknown FILE_OFFLOAD {app.config['FILE_OFFLOAD']!r}, use x-accel or x-sendfile")
+app.config['OFFLOAD_PREFIX'] = os.environ.get('OFFLOAD_PREFIX', '/internal-outputs/')  # internal proxy location of OUTPUT_DIR for x-accel
+app.config['UPLOAD_DB'] = os.environ.get('UPLOAD_DB', os.path.join(os.path.dirname(app.config['SESSION_DB']) or '.', 'uploads.db'))
+app.config['FORMATS_CACHE'] = os.environ.get('FORMATS_CACHE', os.path.join(os.path.dirname(app.config['SESSION_DB']) or '.', 'formats.json'))
+app.config['JOB_FOLDER'] = os.environ.get('JOB_DIR', os.path.join(os.path.dirname(app.config['SESSION_FILE']) or '.', 'jobs'))
 
 # Get supported image formats from Pillow
 def get_supported_formats():
@@ -31,8 +92,10 @@ def get_supported_formats():
                        for ext, format_name in input_formats.items() 
                        if format_name in Image.SAVE}
     
-    # Add HEIC format since we have pillow_heif
+    # Add HEIC/HEIF formats since we have pillow_heif
     readable_formats['HEIC'] = 'HEIC'
+    readable_formats['HEIF'] = 'HEIF'
+    readable_formats['HIF'] = 'HEIF'
     
     # Remove EPS from both input and output formats
     if 'EPS' in readable_formats:
@@ -56,108 +119,146 @@ def get_supported_formats():
         'output_details': writable_formats
     }
 
-# Store supported formats for use in routes
-SUPPORTED_FORMATS = get_supported_formats()
+# Bump when get_supported_formats() changes, so cached tables are rebuilt
+FORMATS_VERSION = 1
 
-# Session tracking for expiration - use a more durable structure
-sessions = {}
+_supported_formats = None
+_formats_lock = threading.Lock()
+
+def formats_cache_key():
+    return f"{FORMATS_VERSION}:pillow-{PIL.__version__}:pillow_heif-{pillow_heif.__version__}"
+
+def load_supported_formats(cache_path):
+    """Read the format table from cache_path, rebuilding it if it is missing or stale"""
+    try:
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+        if cached.get('key') == formats_cache_key():
+            return cached['formats']
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    
+    formats = get_supported_formats()
+    try:
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({'key': formats_cache_key(), 'formats': formats}, f)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        print(f"[DEBUG] Could not cache the format table in {cache_path}: {str(e)}")
+    return formats
+
+def supported_formats():
+    """The format table, built on first use.
+
+    Building it imports every Pillow plugin, which used to be most of a
+    worker's boot time. The table is kept in FORMATS_CACHE so that only the
+    first worker after an install or upgrade of Pillow pays for it.
+    """
+    global _supported_formats
+    if _supported_formats is None:
+        with _formats_lock:
+            if _supported_formats is None:
+                _supported_formats = load_supported_formats(app.config['FORMATS_CACHE'])
+    return _supported_formats
+
+# Conversion engine - the process pool is started on first upload
+conversion_engine = ConversionEngine(
+    max_workers=app.config['CONVERSION_WORKERS'],
+    task_timeout=app.config['CONVERSION_TIMEOUT'],
+    frame_limits={'max_frames': app.config['MAX_FRAMES'], 'max_frame_pixels': app.config['MAX_FRAME_PIXELS']}
+)
+
+# Conversion cache - outputs keyed by input content, format and options
+conversion_cache = ConversionCache(app.config['CACHE_FOLDER'], app.config['CACHE_MAX_BYTES'])
+
+# Session directory listings - per process, revalidated against the directory mtime
+session_listings = ListingCache(archive_members, max_entries=app.config['LISTING_CACHE_SIZE'])
 
 # Make sure data directory exists
 data_dir = os.path.dirname(app.config['SESSION_FILE'])
 if data_dir and data_dir != '.':
     os.makedirs(data_dir, exist_ok=True)
 
-# Save sessions to disk to ensure they persist
-def save_sessions():
-    try:
-        sessions_file = app.config['SESSION_FILE']
-        with open(sessions_file, 'w') as f:
-            # Create a serializable version of the sessions dictionary
-            serializable_sessions = {}
-            for session_id, session_data in sessions.items():
-                if isinstance(session_data, (int, float)):
-                    # Old format - just expiry time
-                    serializable_sessions[session_id] = {
-                        'created_at': session_data,
-                        'files': []
-                    }
-                else:
-                    # New format - full session data
-                    serializable_sessions[session_id] = session_data
-            
-            json.dump(serializable_sessions, f, indent=2)
-        
-        print(f"[DEBUG] Saved {len(sessions)} sessions to {sessions_file}")
-        print(f"[DEBUG] Session IDs: {list(sessions.keys())}")
-    except Exception as e:
-        print(f"[DEBUG] Error saving sessions: {str(e)}")
+# Session tracking for expiration - shared by all workers through SQLite
+session_store = SessionStore(app.config['SESSION_DB'])
+
+# Chunked uploads in progress - chunks of a file may arrive on any worker
+upload_store = UploadStore(app.config['UPLOAD_DB'])
+
+# Conversion metrics for /metrics - also shared by all workers through SQLite
+metrics = Metrics(app.config['METRICS_DB'])
+
+# Memory admission control - estimated decoded bytes in flight, shared by all workers
+memory_budget = MemoryBudget(
+    os.path.join(os.path.dirname(app.config['SESSION_DB']) or '.', 'admission.db'),
+    app.config['MEMORY_BUDGET']
+)
 
-# Load sessions from disk on startup
-def load_sessions():
-    global sessions
+# Opt-in profiling of single requests
+request_profiler = RequestProfiler(
+    app.config['PROFILE_DIR'],
+    sample_rate=app.config['PROFILE_SAMPLE_RATE'],
+    token=app.config['PROFILE_TOKEN']
+)
+
+def init_sessions():
+    """Prepare the session store (constant time once migrated).
+
+    Returns True if sessions were imported or discovered.
+    """
+    added = False
     try:
-        sessions_file = app.config['SESSION_FILE']
-        if os.path.exists(sessions_file):
-            with open(sessions_file, 'r') as f:
-                loaded_data = json.load(f)
-                
-            # Clear existing sessions
-            sessions.clear()
-            
-            # Process loaded data
-            for session_id, session_data in loaded_data.items():
-                if isinstance(session_data, str):
-                    # Handle old string format (pre-update)
-                    try:
-                        sessions[session_id] = float(session_data)
-                        print(f"[DEBUG] Loaded legacy session {session_id}")
-                    except ValueError:
-                        print(f"[DEBUG] Skipping invalid session data for {session_id}")
-                elif isinstance(session_data, dict):
-                    # Handle new dictionary format
-                    sessions[session_id] = session_data
-                    expiry_time = session_data.get('created_at', 0)
-                    if isinstance(expiry_time, str):
-                        try:
-                            sessions[session_id]['created_at'] = float(expiry_time)
-                        except ValueError:
-                            sessions[session_id]['created_at'] = time.time()
-                    print(f"[DEBUG] Loaded session {session_id} with {len(session_data.get('files', []))} files")
-                else:
-                    # Unknown format
-                    print(f"[DEBUG] Unknown session data format for {session_id}")
-            
-            print(f"[DEBUG] Loaded {len(sessions)} sessions from {sessions_file}")
-            for session_id in sessions:
-                if isinstance(sessions[session_id], dict):
-                    expiry_time = sessions[session_id].get('created_at', 0)
-                else:
-                    expiry_time = sessions[session_id]
-                expiry_datetime = datetime.datetime.fromtimestamp(expiry_time)
-                print(f"[DEBUG] Session {session_id} expires at {expiry_datetime}")
-        else:
-            print(f"[DEBUG] No sessions file found at {sessions_file}, starting with empty sessions")
-            sessions = {}
-            
-            # Discover session directories and create entries for them
-            output_dir = app.config['OUTPUT_FOLDER']
-            if os.path.exists(output_dir):
-                for item in os.listdir(output_dir):
-                    item_path = os.path.join(output_dir, item)
-                    if os.path.isdir(item_path) and len(item) >= 32:  # Likely a UUID
-                        # Create a new session entry with long expiration
-                        sessions[item] = {
-                            'created_at': time.time() + (24 * 3600),  # 24 hour expiration
-                            'files': []
-                        }
-                        print(f"[DEBUG] Auto-discovered session directory: {item}")
-                
-                # Save discovered sessions
-                if sessions:
-                    save_sessions()
+        # One-shot import of the legacy sessions.json
+        imported = session_store.migrate_from_json(app.config['SESSION_FILE'])
+        if imported is not None:
+            print(f"[DEBUG] Migrated {imported} sessions from {app.config['SESSION_FILE']} to {app.config['SESSION_DB']}")
+            added = True
+        
+        if session_store.get_meta('initialized') is None:
+            session_store.set_meta('initialized', str(time.time()))
+            if session_store.count() == 0:
+                # Discover session directories and create entries for them
+                output_dir = app.config['OUTPUT_FOLDER']
+                if os.path.exists(output_dir):
+                    for item in os.listdir(output_dir):
+                        item_path = os.path.join(output_dir, item)
+                        if os.path.isdir(item_path) and len(item) >= 32:  # Likely a UUID
+                            # Create a new session entry with long expiration
+                            session_store.register(item, time.time() + (24 * 3600))  # 24 hour expiration
+                            print(f"[DEBUG] Auto-discovered session directory: {item}")
+                            added = True
     except Exception as e:
         print(f"[DEBUG] Error loading sessions: {str(e)}")
-        sessions = {}
+    return added
+
+def auto_register_session(session_id, filename=None):
+    """Register a session that exists on disk but not in the store.
+
+    With a filename only that file has to exist, otherwise the whole
+    session directory is scanned. Returns True if the session is known
+    afterwards.
+    """
+    listing = session_listings.get(session_id, os.path.join(app.config['OUTPUT_FOLDER'], session_id))
+    if listing is None:
+        return False
+    if filename is not None:
+        if filename not in listing.names:
+            return False
+        filenames = [filename]
+    else:
+        filenames = [name for name, _, _ in listing.members if not name.endswith('.zip')]
+    
+    now = time.time()
+    files = [{
+        'original_filename': name,
+        'converted_filename': name,
+        'conversion_time': now
+    } for name in filenames]
+    if session_store.register(session_id, now + app.config['EXPIRATION_TIME'], files):
+        expiry_scheduler.schedule(session_id, now + app.config['EXPIRATION_TIME'])
+        print(f"[DEBUG] Auto-registered session {session_id} with {len(files)} files")
+    return True
 
 # Configure server name from environment if available
 server_name = os.environ.get('FLASK_SERVER_NAME')
@@ -168,216 +269,849 @@ if server_name:
 # Ensure upload and output directories exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
+os.makedirs(app.config['JOB_FOLDER'], exist_ok=True)
 
-# Load sessions on startup
-load_sessions()
+def expire_sessions(expired):
+    """Called by the expiry scheduler with the (session_id, job_id) pairs it removed"""
+    print(f"[DEBUG] Expired {len(expired)} sessions in one batch")
+    for session_id, job_id in expired:
+        try:
+            remove_session_artifacts(session_id, job_id)
+            print(f"Auto-cleaned expired session: {session_id}")
+        except Exception as e:
+            print(f"Error cleaning up session {session_id}: {str(e)}")
 
-def cleanup_expired_sessions():
-    """Cleanup thread that runs in the background to remove expired sessions"""
-    while True:
-        current_time = time.time()
-        expired_sessions = []
-        
-        # Find expired sessions
-        for session_id, session_data in list(sessions.items()):
-            # Handle both old and new format
-            if isinstance(session_data, dict):
-                expiry_time = session_data.get('created_at', 0)
-            else:
-                expiry_time = session_data
-                
-            if current_time > expiry_time:
-                expired_sessions.append(session_id)
-        
-        if expired_sessions:
-            print(f"[DEBUG] Found {len(expired_sessions)} expired sessions to clean up")
-            
-            # Clean up expired sessions
-            for session_id in expired_sessions:
-                try:
-                    cleanup_session(session_id)
-                    print(f"Auto-cleaned expired session: {session_id}")
-                except Exception as e:
-                    print(f"Error cleaning up session {session_id}: {str(e)}")
-            
-            # Save sessions after cleanup
-            save_sessions()
-        
-        # Sleep for 5 minutes before checking again
-        time.sleep(300)
+# Expiry scheduler - every worker runs one, only the lock holder sweeps
+expiry_scheduler = ExpiryScheduler(
+    session_store,
+    on_expired=expire_sessions,
+    interval=app.config['SWEEP_INTERVAL'],
+    lock_path=os.path.join(os.path.dirname(app.config['SESSION_DB']) or '.', 'expiry.lock')
+)
+if app.config['EXPIRY_SWEEPER']:
+    expiry_scheduler.start()
+
+_sessions_ready = False
+_sessions_lock = threading.Lock()
+
+@app.before_request
+def prepare_sessions():
+    """Prepare the session store on the first request of a process rather than at import"""
+    global _sessions_ready
+    if _sessions_ready:
+        return
+    with _sessions_lock:
+        if not _sessions_ready:
+            if init_sessions():
+                expiry_scheduler.refresh()
+            _sessions_ready = True
 
 def cleanup_session(session_id):
     """Clean up a session's files"""
-    # Remove from tracking dict
-    if session_id in sessions:
-        del sessions[session_id]
-        save_sessions()  # Save sessions after removal
+    # Remove from the store
+    job_id = session_store.delete(session_id)
+    remove_session_artifacts(session_id, job_id)
+    print(f"[DEBUG] Cleaned up session: {session_id}")
+
+def record_gc(report):
+    """Add what a sweep of the output GC reclaimed to the metrics"""
+    counts = []
+    for reason, reclaimed in report['reclaimed'].items():
+        if reclaimed['sessions']:
+            counts.extend([
+                ('image_convert_gc_reclaimed_sessions_total', {'reason': reason}, reclaimed['sessions']),
+                ('image_convert_gc_reclaimed_bytes_total', {'reason': reason}, reclaimed['bytes']),
+                ('image_convert_gc_reclaimed_inodes_total', {'reason': reason}, reclaimed['inodes'])
+            ])
+    try:
+        metrics.record(counts)
+    except Exception as e:
+        print(f"[DEBUG] Could not record metrics: {str(e)}")
+
+# Output GC - removes expired session directories once their grace period is
+# over, and evicts sessions when the outputs exceed their disk budget
+output_collector = OutputCollector(
+    app.config['OUTPUT_FOLDER'],
+    session_store,
+    grace=app.config['GC_GRACE'],
+    max_bytes=app.config['GC_MAX_BYTES'],
+    max_inodes=app.config['GC_MAX_INODES'],
+    interval=app.config['GC_INTERVAL'],
+    lock_path=os.path.join(os.path.dirname(app.config['SESSION_DB']) or '.', 'gc.lock'),
+    report_path=os.path.join(os.path.dirname(app.config['SESSION_DB']) or '.', 'gc.json'),
+    batch_size=app.config['GC_BATCH_SIZE'],
+    min_idle=app.config['CONVERSION_TIMEOUT'],
+    on_evict=cleanup_session,
+    on_swept=record_gc
+)
+if app.config['EXPIRY_SWEEPER'] and app.config['GC_INTERVAL'] > 0:
+    output_collector.start()
+
+def archive_path(session_id):
+    """Where the cached download-all ZIP of a session is kept"""
+    return os.path.join(app.config['OUTPUT_FOLDER'], f"{session_id}_converted.zip")
+
+def preview_path(session_id, filename):
+    """Previews live in a hidden directory, out of listings and archives"""
+    return os.path.join(app.config['OUTPUT_FOLDER'], session_id, '.previews', f"{filename}.webp")
+
+def remove_session_artifacts(session_id, job_id=None):
+    """Remove what is left of a session once it is gone from the store"""
+    session_listings.invalidate(session_id)
     
-    # Don't remove files for troubleshooting purposes
+    # Remove the background job record, if any
+    if job_id and os.path.exists(job_path(job_id)):
+        os.remove(job_path(job_id))
+    
+    # Remove the spools of chunked uploads that never completed
+    for path in upload_store.discard_session(session_id):
+        if os.path.exists(path):
+            os.remove(path)
+    
+    # Don't remove files for troubleshooting purposes, the output GC
+    # removes the directory once GC_GRACE is over
     # session_dir = os.path.join(app.config['OUTPUT_FOLDER'], session_id)
     # if os.path.exists(session_dir):
     #     shutil.rmtree(session_dir, ignore_errors=True)
     
     # Remove zip file if it exists
-    zip_path = os.path.join(app.config['OUTPUT_FOLDER'], f"{session_id}_converted.zip")
+    zip_path = archive_path(session_id)
     if os.path.exists(zip_path):
         os.remove(zip_path)
+
+# Background conversion jobs - each job is kept in its own JSON file so that
+# every gunicorn worker can report progress, not just the one running it
+def job_path(job_id):
+    return os.path.join(app.config['JOB_FOLDER'], f"{job_id}.json")
+
+def save_job(job):
+    path = job_path(job['job_id'])
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(job, f)
+    os.replace(temp_path, path)
+
+def load_job(job_id):
+    try:
+        with open(job_path(job_id), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def task_result(task):
+    """Build the per-file entry reported by /upload and /jobs"""
+    if task['error'] is not None:
+        return {
+            'original': task['filename'],
+            'status': 'error',
+            'error': task['error']
+        }
+    return {
+        'original': task['filename'],
+        'converted': task['output_filename'],
+        'status': 'success',
+        'download_url': task['download_url'],
+        'share_url': task['share_url'],
+        'preview_url': task['preview_url']
+    }
+
+def cache_output(task):
+    """Keep a fresh conversion so later uploads of the same content can reuse it"""
+    if task['error'] is None and not task['cached']:
+        try:
+            conversion_cache.store(task['cache_key'], task['output_path'])
+        except Exception as e:
+            print(f"[DEBUG] Could not cache {task['output_path']}: {str(e)}")
+
+# Failure reasons reported by /metrics, by how the error message starts
+FAILURE_REASONS = (
+    ('Failed to read HEIC file', 'decode'),
+    ('Failed to open image file', 'decode'),
+    ('Failed to decode image file', 'decode'),
+    ('Failed to save converted image', 'encode'),
+    ('Image too large to convert', 'too_large'),
+    ('Conversion timed out', 'timeout'),
+    ('Conversion worker crashed', 'crash'),
+    ('Failed to queue conversion', 'queue'),
+    ('Conversion aborted', 'aborted'),
+)
+
+def failure_reason(error):
+    for prefix, reason in FAILURE_REASONS:
+        if error.startswith(prefix):
+            return reason
+    return 'other'
+
+def record_metrics(task):
+    """Add the outcome of one file to the metrics shared by all workers"""
+    output_format = task['output_format'].upper()
+    counts = [('image_convert_received_bytes_total', {}, task['input_bytes'])]
+    observations = []
+    if task['error'] is not None:
+        outcome = 'failed'
+        counts.append(('image_convert_failures_total', {'reason': failure_reason(task['error'])}, 1))
+    else:
+        outcome = 'cached' if task['cached'] else 'converted'
+        if os.path.exists(task['output_path']):
+            counts.append(('image_convert_output_bytes_total', {'output': output_format},
+                           os.path.getsize(task['output_path'])))
+    counts.append(('image_convert_conversions_total', {'output': output_format, 'result': outcome}, 1))
     
-    print(f"[DEBUG] Cleaned up session: {session_id}")
+    # Stage timings come back from the pool worker with the result
+    result = task['result']
+    if result is not None:
+        labels = {'input': result['input_format'] or 'unknown', 'output': output_format}
+        stages = dict(receive=task['receive_seconds'], admission=task['admission_seconds'], **result['timings'])
+        observations = [('image_convert_stage_seconds', dict(labels, stage=stage), seconds)
+                        for stage, seconds in stages.items() if seconds is not None]
+    try:
+        metrics.record(counts, observations)
+    except Exception as e:
+        print(f"[DEBUG] Could not record metrics: {str(e)}")
+
+def count_metric(name, labels, amount=1):
+    try:
+        metrics.record(counts=[(name, labels, amount)])
+    except Exception as e:
+        print(f"[DEBUG] Could not record metrics: {str(e)}")
+
+class ServerBusy(Exception):
+    """The memory budget stayed exhausted for longer than ADMISSION_TIMEOUT"""
+
+def admit(task):
+    """Reserve memory for converting a task before it is queued.
+
+    The decoded size is estimated from the file header. Images that could
+    never fit in the budget fail with an error on the task; otherwise this
+    waits up to ADMISSION_TIMEOUT for other conversions to free memory and
+    raises ServerBusy if they don't. Returns the reservation, or None if
+    nothing was reserved.
+    """
+    if not memory_budget.enabled:
+        return None
+    try:
+        width, height, needed = estimate_memory(task['input_path'], task['output_format'])
+    except Exception as e:
+        # Not an image the probe can parse - the conversion reports the error
+        print(f"[DEBUG] Could not estimate the memory for {task['filename']}: {str(e)}")
+        return None
+    
+    if needed > memory_budget.max_bytes:
+        task['error'] = (f"Image too large to convert: {width}x{height} needs about {needed // 2**20} MB "
+                         f"of memory, the limit is {memory_budget.max_bytes // 2**20} MB")
+        count_metric('image_convert_admission_total', {'result': 'too_large'})
+        return None
+    
+    started = time.perf_counter()
+    reservation = memory_budget.try_acquire(needed)
+    outcome = 'admitted'
+    if reservation is None:
+        print(f"[DEBUG] Waiting for {needed // 2**20} MB of memory to convert {task['filename']}")
+        reservation = memory_budget.acquire(needed, app.config['ADMISSION_TIMEOUT'])
+        outcome = 'rejected' if reservation is None else 'queued'
+    task['admission_seconds'] = time.perf_counter() - started
+    count_metric('image_convert_admission_total', {'result': outcome})
+    if reservation is None:
+        raise ServerBusy()
+    return reservation
+
+def server_busy():
+    response = jsonify({
+        'error': 'Server busy',
+        'message': 'Too many large images are being converted right now, please try again shortly'
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(app.config['ADMISSION_RETRY_AFTER'])
+    return response
+
+def create_task(session_id, index, filename, input_path, sha256, size, receive_seconds, output_format, options, taken):
+    """Describe the conversion of one received file into the session directory.
+
+    taken holds the output names given to the files before it. Every file
+    gets a name of its own (a.png and a.bmp don't both become a.jpg), so
+    no two conversions ever write, or cache, the same path.
+    """
+    output_filename = output_name(Path(filename).name, output_format, False, taken)
+    output_path = os.path.join(app.config['OUTPUT_FOLDER'], session_id, output_filename)
+    print(f"[DEBUG] Output path: {output_path}")
+    
+    task = {
+        'index': index,
+        'filename': filename,
+        'input_path': input_path,
+        'output_path': output_path,
+        'output_filename': output_filename,
+        'output_format': output_format,
+        'options': dict(options),
+        'preview_path': preview_path(session_id, output_filename),
+        'share_url': url_for('share_file', session_id=session_id, filename=output_filename, _external=True),
+        'download_url': url_for('download_file', session_id=session_id, filename=output_filename),
+        'preview_url': url_for('preview_file', session_id=session_id, filename=output_filename),
+        'cache_key': ConversionCache.make_key(sha256, output_format, options),
+        'input_bytes': size,
+        'receive_seconds': receive_seconds,
+        'admission_seconds': None,
+        'cached': False,
+        'future': None,
+        'reservation': None,
+        'result': None,
+        'error': None
+    }
+    if 'profile_tags' in g:
+        # Profile the conversion in the pool worker as well
+        task['profile_dir'] = request_profiler.profile_dir
+        task['profile_tags'] = {
+            'endpoint': 'convert',
+            'session_id': session_id,
+            'filename': filename,
+            'output': output_format.upper(),
+            'options': dict(options)
+        }
+    return task
+
+def start_task(task):
+    """Reuse a cached output or queue the conversion; raises ServerBusy if memory stays short"""
+    if conversion_cache.materialize(task['cache_key'], task['output_path']):
+        # Same content converted before - reuse the output
+        print(f"[DEBUG] Cache hit for {task['filename']}")
+        task['cached'] = True
+        os.remove(task['input_path'])
+        return
+    task['reservation'] = admit(task)
+    if task['error'] is None:
+        try:
+            task['future'] = conversion_engine.submit(task)
+        except Exception as e:
+            task['error'] = f"Failed to queue conversion: {str(e)}"
+    if task['future'] is not None:
+        # Also called when the conversion is cancelled or its worker dies
+        task['future'].add_done_callback(lambda future: release_memory(task))
+    else:
+        release_memory(task)
+
+def release_memory(task):
+    """Give back the memory reserved for a task.
+
+    Called when its future completes, and again by whoever stops waiting
+    for it: a timed-out conversion is abandoned and its future may never
+    complete. Releasing twice is harmless.
+    """
+    if task['reservation'] is not None:
+        memory_budget.release(task['reservation'])
+
+def prebuild_archive(session_id):
+    """Build the download-all ZIP ahead of the first click"""
+    session_dir = os.path.join(app.config['OUTPUT_FOLDER'], session_id)
+    members = archive_members(session_dir)
+    zip_path = archive_path(session_id)
+    if not members or is_current(zip_path, members):
+        return
+    try:
+        build_archive(members, zip_path)
+        print(f"[DEBUG] Prebuilt archive for session {session_id}")
+    except Exception as e:
+        print(f"[DEBUG] Could not prebuild archive for session {session_id}: {str(e)}")
+
+def run_conversion_job(job, tasks):
+    """Wait for the conversions of an ingested batch, recording progress per file"""
+    session_id = job['session_id']
+    job_lock = threading.Lock()
+    
+    def record(task):
+        record_metrics(task)
+        with job_lock:
+            index = task['index']
+            job['results'][index] = task_result(task)
+            if task['error'] is None:
+                session_listings.invalidate(session_id)
+                job['completed'] += 1
+                session_store.add_files(session_id, [{
+                    'original_filename': task['filename'],
+                    'converted_filename': task['output_filename'],
+                    'conversion_time': time.time()
+                }])
+            else:
+                print(f"[DEBUG] Error converting {task['filename']}: {task['error']}")
+                job['failed'] += 1
+            save_job(job)
+    
+    def on_result(index, result, error):
+        task = pending[index]
+        task['result'] = result
+        task['error'] = error
+        if os.path.exists(task['input_path']):
+            os.remove(task['input_path'])
+        cache_output(task)
+        record(task)
+    
+    job['status'] = 'running'
+    save_job(job)
+    
+    # Cache hits and files that failed during ingest are already done
+    for task in tasks:
+        if task['future'] is None:
+            record(task)
+    
+    pending = [task for task in tasks if task['future'] is not None]
+    try:
+        conversion_engine.wait_for([task['future'] for task in pending], on_result=on_result)
+    except Exception as e:
+        print(f"[DEBUG] Conversion job {job['job_id']} aborted: {str(e)}")
+        for task in pending:
+            if job['results'][task['index']]['status'] == 'pending':
+                task['error'] = f"Conversion aborted: {str(e)}"
+                record(task)
+    finally:
+        for task in tasks:
+            release_memory(task)
+            if os.path.exists(task['input_path']):
+                os.remove(task['input_path'])
+    
+    with job_lock:
+        job['finished_at'] = time.time()
+        if job['completed'] == 0:
+            # All conversions failed, remove the empty session and its job like /upload does
+            job['status'] = 'failed'
+            shutil.rmtree(os.path.join(app.config['OUTPUT_FOLDER'], session_id), ignore_errors=True)
+            remove_session_artifacts(session_id, session_store.delete(session_id))
+        else:
+            job['status'] = 'completed'
+            save_job(job)
+    print(f"[DEBUG] Conversion job {job['job_id']} {job['status']}: {job['completed']}/{job['total']} files")
+    
+    if job['status'] == 'completed' and app.config['PREBUILD_ZIP']:
+        prebuild_archive(session_id)
+
+def batch_progress(uploads):
+    """The job fields of a chunked upload, from the state of its files"""
+    results = [upload['result'] or {
+        'original': upload['filename'],
+        'status': 'pending',
+        'received': upload['received'],
+        'size': upload['size']
+    } for upload in uploads]
+    completed = sum(result['status'] == 'success' for result in results)
+    failed = sum(result['status'] == 'error' for result in results)
+    if completed + failed < len(results):
+        status = 'running' if any(upload['received'] for upload in uploads) else 'queued'
+    else:
+        status = 'completed' if completed else 'failed'
+    return {'results': results, 'completed': completed, 'failed': failed, 'status': status}
+
+def start_chunked_conversion(upload):
+    """Start converting a file of a chunked upload once its last chunk has arrived"""
+    print(f"[DEBUG] Received all {upload['size']} bytes of {upload['filename']}")
+    # Name the files before this one first, so every worker arrives at the same names
+    taken = set()
+    _, uploads = upload_store.progress(upload['job_id'])
+    for earlier in uploads[:upload['position']]:
+        output_name(Path(earlier['filename']).name, upload['output_format'], False, taken)
+    task = create_task(upload['session_id'], upload['position'], upload['filename'], upload['path'],
+                       file_sha256(upload['path']), upload['size'], upload['completed_at'] - upload['started_at'],
+                       upload['output_format'], upload['options'], taken)
+    start_task(task)
+    threading.Thread(target=finish_chunked_conversion, args=(upload, task), daemon=True).start()
+
+def recover_chunked_conversions(job_id):
+    """Convert again the files of a batch whose worker was restarted in the middle of converting them"""
+    for upload in upload_store.reclaim_orphaned(job_id):
+        print(f"[DEBUG] Taking over the conversion of {upload['filename']} from a stopped worker")
+        if not os.path.exists(upload['path']):
+            # The worker removed the spool file, and with it what there was to convert
+            settle_chunked_upload(upload, {
+                'original': upload['filename'],
+                'status': 'error',
+                'error': 'Conversion aborted: the worker converting it stopped'
+            })
+            continue
+        try:
+            start_chunked_conversion(upload)
+        except ServerBusy:
+            # Left for the next status request to take over
+            upload_store.disown(upload['upload_id'])
+        except Exception as e:
+            if os.path.exists(upload['path']):
+                os.remove(upload['path'])
+            settle_chunked_upload(upload, {
+                'original': upload['filename'],
+                'status': 'error',
+                'error': f"Conversion aborted: {str(e)}"
+            })
+
+def finish_chunked_conversion(upload, task):
+    """Wait for the conversion of one file of a chunked upload and record its outcome.
+
+    Files of a batch complete on whichever worker receives their last
+    chunk. The worker that records the last of them settles the job the
+    way run_conversion_job() does.
+    """
+    session_id = upload['session_id']
+    try:
+        if task['future'] is not None:
+            [(task['result'], task['error'])] = conversion_engine.wait_for([task['future']])
+    except Exception as e:
+        task['error'] = f"Conversion aborted: {str(e)}"
+    finally:
+        release_memory(task)
+        if os.path.exists(task['input_path']):
+            os.remove(task['input_path'])
+    cache_output(task)
+    record_metrics(task)
+    
+    if task['error'] is None:
+        session_listings.invalidate(session_id)
+        session_store.add_files(session_id, [{
+            'original_filename': task['filename'],
+            'converted_filename': task['output_filename'],
+            'conversion_time': time.time()
+        }])
+    else:
+        print(f"[DEBUG] Error converting {task['filename']}: {task['error']}")
+    settle_chunked_upload(upload, task_result(task))
+
+def settle_chunked_upload(upload, result):
+    """Store the outcome of one file, and settle the job if it was the last of its batch"""
+    session_id = upload['session_id']
+    uploads = upload_store.finish(upload['upload_id'], result)
+    job = load_job(upload['job_id']) if uploads is not None else None
+    if job is None:
+        return
+    job.update(batch_progress(uploads), finished_at=time.time())
+    if job['status'] == 'failed':
+        # All conversions failed, remove the empty session and its job like /upload does
+        shutil.rmtree(os.path.join(app.config['OUTPUT_FOLDER'], session_id), ignore_errors=True)
+        remove_session_artifacts(session_id, session_store.delete(session_id))
+    else:
+        save_job(job)
+    print(f"[DEBUG] Conversion job {job['job_id']} {job['status']}: {job['completed']}/{job['total']} files")
+    
+    if job['status'] == 'completed' and app.config['PREBUILD_ZIP']:
+        prebuild_archive(session_id)
+
+def profile_iterable(profile, iterable):
+    """Profile the production of each chunk of a streamed response"""
+    try:
+        while True:
+            profile.enable()
+            try:
+                chunk = next(iterable)
+            except StopIteration:
+                return
+            finally:
+                profile.disable()
+            yield chunk
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+def profiled(endpoint):
+    """Profile the decorated view when profiling is enabled and the request is picked.
+
+    The profile is tagged with the view arguments and whatever the view
+    adds through tag_profile(). Streamed responses are profiled while they
+    are sent and saved once the response is closed.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not request_profiler.wanted(request.headers.get('X-Profile')):
+                return view(*args, **kwargs)
+            
+            profile_tags = g.profile_tags = dict(kwargs, endpoint=endpoint)
+            started = time.perf_counter()
+            
+            def finish(**tags):
+                profile_tags.update(tags, seconds=time.perf_counter() - started)
+                request_profiler.save(profile, profile_tags)
+            
+            profile = request_profiler.start()
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception as e:
+                profile.disable()
+                finish(error=str(e))
+                raise
+            profile.disable()
+            
+            if inspect.isgenerator(response.response):
+                response.response = profile_iterable(profile, response.response)
+                response.call_on_close(lambda: finish(status=response.status_code))
+            else:
+                finish(status=response.status_code)
+            return response
+        return wrapper
+    return decorator
+
+def tag_profile(**tags):
+    """Add tags to the profile of the current request, if it is being profiled"""
+    if 'profile_tags' in g:
+        g.profile_tags.update(tags)
 
 @app.route('/')
 def index():
     print("Root route accessed!")
     return render_template('index.html', 
-                          input_formats=SUPPORTED_FORMATS['input_formats'],
-                          output_formats=SUPPORTED_FORMATS['output_formats'])
+                          input_formats=supported_formats()['input_formats'],
+                          output_formats=supported_formats()['output_formats'],
+                          encoder_presets=list(ENCODER_PRESETS),
+                          default_preset=app.config['ENCODER_PRESET'])
+
+def validate_output_format(output_format):
+    """Return an error message if the requested output format can't be used"""
+    if not output_format:
+        return 'No output format specified'
+    if output_format.upper() not in supported_formats()['output_formats']:
+        return f'Unsupported output format: {output_format}'
+    return None
+
+RESIZE_FIELDS = ('max_width', 'max_height', 'scale')
+
+def parse_background(value):
+    """Normalize a CSS color (name, #rgb, #rrggbb, rgb()...) to #rrggbb, or None if it isn't one"""
+    try:
+        return '#%02x%02x%02x' % ImageColor.getrgb(value.strip())[:3]
+    except ValueError:
+        return None
+
+def parse_resize_option(name, value):
+    """Parse one of the optional resize fields, returning (value, error message)"""
+    value = value.strip()
+    if not value:
+        return None, None
+    try:
+        number = float(value) if name == 'scale' else int(value)
+    except ValueError:
+        return None, f'Invalid {name}: {value}'
+    if name == 'scale' and not 0 < number <= 1:
+        return None, 'scale must be greater than 0 and at most 1'
+    if name != 'scale' and number < 1:
+        return None, f'{name} must be a positive number of pixels'
+    return number, None
 
 @app.route('/upload', methods=['POST'])
+@profiled('upload')
 def upload_file():
     try:
-        if 'files[]' not in request.files:
+        boundary = request.mimetype_params.get('boundary')
+        if request.mimetype != 'multipart/form-data' or not boundary:
             return jsonify({'error': 'No files provided'}), 400
         
-        files = request.files.getlist('files[]')
-        if not files or files[0].filename == '':
-            return jsonify({'error': 'No files selected'}), 400
-            
-        output_format = request.form.get('format', 'JPEG')
-        if not output_format:
-            return jsonify({'error': 'No output format specified'}), 400
-        
-        # Validate output format
-        if output_format.upper() not in SUPPORTED_FORMATS['output_formats']:
-            return jsonify({'error': f'Unsupported output format: {output_format}'}), 400
-        
-        # Create session
+        # The session directory and entry are created when the first file arrives
         session_id = str(uuid.uuid4())
         session_output_dir = os.path.join(app.config['OUTPUT_FOLDER'], session_id)
-        os.makedirs(session_output_dir, exist_ok=True)
-        
-        # Print detailed debug info
-        print(f"[DEBUG] Created session directory: {session_output_dir}")
-        print(f"[DEBUG] Converting to format: {output_format}")
-        print(f"[DEBUG] Number of files: {len(files)}")
-        print(f"[DEBUG] Original sizes will be preserved")
-        
-        # Set expiration time
         expiry_time = time.time() + app.config['EXPIRATION_TIME']
-        sessions[session_id] = {
-            'created_at': expiry_time,
-            'files': []
-        }
         
         results = []
         conversion_errors = []
         
-        for file in files:
-            if file and file.filename:
-                # Save uploaded file temporarily
-                filename = file.filename
-                print(f"[DEBUG] Processing file: {filename}")
-                temp_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                
-                try:
-                    file.save(temp_path)
-                    print(f"[DEBUG] Saved temp file: {temp_path}")
-                    
-                    # Generate output path with format extension
-                    file_stem = Path(filename).stem
-                    output_filename = f"{file_stem}.{output_format.lower()}"
-                    output_path = os.path.join(session_output_dir, output_filename)
-                    print(f"[DEBUG] Output path: {output_path}")
-                    
-                    conversion_success = False
-                    
-                    # Handle HEIC files
-                    if filename.lower().endswith('.heic'):
-                        try:
-                            heif_file = pillow_heif.read_heif(temp_path)
-                            image = Image.frombytes(
-                                heif_file.mode,
-                                heif_file.size,
-                                heif_file.data,
-                                "raw",
-                            )
-                            original_size = image.size
-                            print(f"[DEBUG] HEIC image original size: {original_size}")
-                        except Exception as e:
-                            raise Exception(f"Failed to read HEIC file: {str(e)}")
-                    else:
-                        # Use regular PIL for other formats
-                        try:
-                            image = Image.open(temp_path)
-                            original_size = image.size
-                            print(f"[DEBUG] Original image size: {original_size}")
-                        except Exception as e:
-                            raise Exception(f"Failed to open image file: {str(e)}")
-                    
-                    # Convert to RGB if needed for certain output formats
-                    if output_format.lower() in ['jpeg', 'jpg'] and image.mode != 'RGB':
-                        image = image.convert('RGB')
-                    
-                    # Handle transparency for PNG
-                    if output_format.lower() == 'png' and image.mode not in ['RGBA', 'RGB']:
-                        image = image.convert('RGBA')
-                    
-                    # Save the image with specified format - preserving original dimensions
-                    try:
-                        image.save(output_path, output_format.upper())
-                        print(f"[DEBUG] Preserved original dimensions: {original_size}")
-                        conversion_success = True
-                    except Exception as e:
-                        raise Exception(f"Failed to save converted image: {str(e)}")
-                
-                    if not os.path.exists(output_path):
-                        raise Exception("Conversion completed but output file not found")
-                    
-                    print(f"[DEBUG] Converted and saved: {output_path}")
-                    
-                    # Generate URLs
-                    share_url = url_for('share_file', session_id=session_id, filename=output_filename, _external=True)
-                    download_url = url_for('download_file', session_id=session_id, filename=output_filename)
-                    print(f"[DEBUG] Share URL: {share_url}")
-                    
-                    # Track file in session
-                    file_info = {
-                        'original_filename': filename,
-                        'converted_filename': output_filename,
-                        'conversion_time': time.time()
-                    }
-                    sessions[session_id]['files'].append(file_info)
-                    
-                    results.append({
-                        'original': filename,
-                        'converted': output_filename,
-                        'status': 'success',
-                        'download_url': download_url,
-                        'share_url': share_url
-                    })
-                    
-                except Exception as e:
-                    error_msg = str(e)
-                    print(f"[DEBUG] Error converting {filename}: {error_msg}")
-                    conversion_errors.append(error_msg)
-                    results.append({
-                        'original': filename,
-                        'status': 'error',
-                        'error': error_msg
-                    })
-                finally:
-                    # Clean up temp file
-                    if os.path.exists(temp_path):
-                        os.remove(temp_path)
+        form = {}
+        file_parts = []
+        tasks = []
+        taken = set()
+        output_format = None
+        # Encoder preset, JPEG background and optional downscaling, applied to every file of the upload
+        options = {'preset': app.config['ENCODER_PRESET'], 'background': app.config['JPEG_BACKGROUND']}
+        
+        def queue_conversion(part):
+            """Start converting a file part as soon as it has fully arrived"""
+            if not tasks:
+                os.makedirs(session_output_dir, exist_ok=True)
+                print(f"[DEBUG] Created session directory: {session_output_dir}")
+                print(f"[DEBUG] Converting to format: {output_format} ({options['preset']} preset)")
+                if any(name in options for name in RESIZE_FIELDS):
+                    print(f"[DEBUG] Resizing with {options}")
+                else:
+                    print("[DEBUG] Original sizes will be preserved")
+                session_store.create(session_id, expiry_time)
+                expiry_scheduler.schedule(session_id, expiry_time)
+            
+            filename = part['filename']
+            print(f"[DEBUG] Processing file: {filename} ({part['size']} bytes)")
+            task = create_task(session_id, len(tasks), filename, part['path'], part['sha256'], part['size'],
+                               part['seconds'], output_format, options, taken)
+            start_task(task)
+            tasks.append(task)
+        
+        def discard_upload():
+            """Throw away everything received so far"""
+            for task in tasks:
+                if task['future'] is not None:
+                    task['future'].cancel()
+                release_memory(task)
+            for part in file_parts:
+                if part['path'] and os.path.exists(part['path']):
+                    os.remove(part['path'])
+            if tasks:
+                shutil.rmtree(session_output_dir, ignore_errors=True)
+                session_store.delete(session_id)
+        
+        # Parse the body as it streams in; each file is spooled under a unique
+        # name and handed to the process pool once its part is complete
+        try:
+            for part in iter_upload_parts(request.stream, boundary, app.config['UPLOAD_FOLDER']):
+                if 'value' in part:
+                    form[part['name']] = part['value']
+                    if part['name'] == 'format' and output_format is None:
+                        output_format = part['value']
+                        format_error = validate_output_format(output_format)
+                        if format_error:
+                            discard_upload()
+                            return jsonify({'error': format_error}), 400
+                        
+                        # Start the files that arrived before the format was known
+                        for held_part in file_parts:
+                            if held_part['path']:
+                                queue_conversion(held_part)
+                    elif part['name'] in RESIZE_FIELDS or part['name'] in ('preset', 'background'):
+                        # Conversions start as files arrive, so options have to come first
+                        if tasks:
+                            discard_upload()
+                            return jsonify({'error': f"{part['name']} must be sent before the files"}), 400
+                        if part['name'] == 'preset':
+                            preset = part['value'].strip().lower() or app.config['ENCODER_PRESET']
+                            if preset not in ENCODER_PRESETS:
+                                discard_upload()
+                                return jsonify({'error': f"Unknown preset: {part['value']}"}), 400
+                            options['preset'] = preset
+                            continue
+                        if part['name'] == 'background':
+                            background = parse_background(part['value'] or app.config['JPEG_BACKGROUND'])
+                            if background is None:
+                                discard_upload()
+                                return jsonify({'error': f"Invalid background color: {part['value']}"}), 400
+                            options['background'] = background
+                            continue
+                        value, resize_error = parse_resize_option(part['name'], part['value'])
+                        if resize_error:
+                            discard_upload()
+                            return jsonify({'error': resize_error}), 400
+                        if value is None:
+                            options.pop(part['name'], None)
+                        else:
+                            options[part['name']] = value
+                elif part['name'] == 'files[]':
+                    file_parts.append(part)
+                    if part['path'] and output_format is not None:
+                        queue_conversion(part)
+                elif part['path']:
+                    os.remove(part['path'])
+        except ServerBusy:
+            discard_upload()
+            return server_busy()
+        except Exception:
+            discard_upload()
+            raise
+        
+        if not file_parts:
+            return jsonify({'error': 'No files provided'}), 400
+        
+        if not any(part['path'] for part in file_parts):
+            return jsonify({'error': 'No files selected'}), 400
+        
+        # No format field at all - fall back to the default
+        if output_format is None:
+            output_format = 'JPEG'
+            try:
+                for part in file_parts:
+                    if part['path']:
+                        queue_conversion(part)
+            except ServerBusy:
+                discard_upload()
+                return server_busy()
+        
+        print(f"[DEBUG] Number of files: {len(tasks)}")
+        tag_profile(session_id=session_id, output=output_format.upper(), files=len(tasks),
+                    bytes=sum(task['input_bytes'] for task in tasks))
+        
+        # In async mode hand the batch to a background job and return right away
+        if form.get('async', request.args.get('async', '')).lower() in ('1', 'true', 'yes'):
+            job_id = str(uuid.uuid4())
+            session_store.set_job(session_id, job_id)
+            
+            expiry_datetime = datetime.datetime.fromtimestamp(expiry_time)
+            job = {
+                'job_id': job_id,
+                'session_id': session_id,
+                'status': 'queued',
+                'total': len(tasks),
+                'completed': 0,
+                'failed': 0,
+                'results': [{'original': task['filename'], 'status': 'pending'} for task in tasks],
+                'download_all_url': url_for('download_all', session_id=session_id),
+                'session_url': url_for('view_session', session_id=session_id, _external=True),
+                'expires_at': expiry_datetime.strftime('%Y-%m-%d %H:%M:%S'),
+                'expiration_seconds': app.config['EXPIRATION_TIME'],
+                'created_at': time.time(),
+                'finished_at': None
+            }
+            save_job(job)
+            
+            job_thread = threading.Thread(target=run_conversion_job, args=(job, tasks), daemon=True)
+            job_thread.start()
+            print(f"[DEBUG] Started conversion job {job_id} for session {session_id}")
+            
+            return jsonify({
+                'job_id': job_id,
+                'session_id': session_id,
+                'status_url': url_for('job_status', job_id=job_id),
+                'session_url': job['session_url'],
+                'download_all_url': job['download_all_url'],
+                'expires_at': job['expires_at'],
+                'expiration_seconds': job['expiration_seconds']
+            }), 202
+        
+        # Wait for the conversions that were started during ingest
+        pending = [task for task in tasks if task['future'] is not None]
+        
+        def on_result(index, result, error):
+            # Cache each output as soon as it is written, not after the whole batch
+            task = pending[index]
+            task['result'] = result
+            task['error'] = error
+            cache_output(task)
+        
+        try:
+            conversion_engine.wait_for([task['future'] for task in pending], on_result=on_result)
+        finally:
+            # Clean up temp files
+            for task in tasks:
+                release_memory(task)
+                if os.path.exists(task['input_path']):
+                    os.remove(task['input_path'])
+        
+        converted = [task['result'] for task in tasks if task['result'] is not None]
+        tag_profile(inputs=sorted({result['input_format'] or 'unknown' for result in converted}),
+                    pixels=sum(result['original_size'][0] * result['original_size'][1] for result in converted),
+                    cached=sum(task['cached'] for task in tasks))
+        
+        converted_files = []
+        for task in tasks:
+            record_metrics(task)
+            results.append(task_result(task))
+            
+            if task['error'] is not None:
+                print(f"[DEBUG] Error converting {task['filename']}: {task['error']}")
+                conversion_errors.append(task['error'])
+                continue
+            
+            print(f"[DEBUG] Converted and saved: {task['output_path']}")
+            print(f"[DEBUG] Share URL: {task['share_url']}")
+            
+            # Track file in session
+            converted_files.append({
+                'original_filename': task['filename'],
+                'converted_filename': task['output_filename'],
+                'conversion_time': time.time()
+            })
         
         # Save session data after all files processed
-        save_sessions()
+        session_store.add_files(session_id, converted_files)
+        session_listings.invalidate(session_id)
         
         # If all conversions failed, remove empty session directory
         if all(result['status'] == 'error' for result in results):
             shutil.rmtree(session_output_dir, ignore_errors=True)
-            if session_id in sessions:
-                del sessions[session_id]
-                save_sessions()
+            session_store.delete(session_id)
             error_details = '; '.join(conversion_errors) if conversion_errors else 'Unknown error'
             return jsonify({
                 'error': 'All conversions failed',
@@ -385,6 +1119,9 @@ def upload_file():
                 'message': error_details
             }), 500
         
+        if app.config['PREBUILD_ZIP']:
+            threading.Thread(target=prebuild_archive, args=(session_id,), daemon=True).start()
+        
         # Generate session URL
         session_url = url_for('view_session', session_id=session_id, _external=True)
         print(f"[DEBUG] Session URL: {session_url}")
@@ -409,6 +1146,8 @@ def upload_file():
         print(f"[DEBUG] Upload successful for session {session_id}")
         return jsonify(response_data)
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"[DEBUG] Unexpected error in upload: {str(e)}")
         return jsonify({
@@ -416,16 +1155,176 @@ def upload_file():
             'message': str(e)
         }), 500
 
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """Start a chunked upload.
+
+    The JSON body has the options /upload takes as form fields (format,
+    preset, background, max_width, max_height, scale) and the name and
+    size of every file. The session and its background job are created
+    right away; the response has an upload URL per file, to send the
+    file to in chunks (see upload_chunk).
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    
+    output_format = str(data.get('format') or 'JPEG')
+    format_error = validate_output_format(output_format)
+    if format_error:
+        return jsonify({'error': format_error}), 400
+    
+    options = {'preset': app.config['ENCODER_PRESET'], 'background': app.config['JPEG_BACKGROUND']}
+    preset = str(data.get('preset') or '').strip().lower() or app.config['ENCODER_PRESET']
+    if preset not in ENCODER_PRESETS:
+        return jsonify({'error': f"Unknown preset: {data['preset']}"}), 400
+    options['preset'] = preset
+    if data.get('background'):
+        options['background'] = parse_background(str(data['background']))
+        if options['background'] is None:
+            return jsonify({'error': f"Invalid background color: {data['background']}"}), 400
+    for name in RESIZE_FIELDS:
+        value, resize_error = parse_resize_option(name, '' if data.get(name) is None else str(data[name]))
+        if resize_error:
+            return jsonify({'error': resize_error}), 400
+        if value is not None:
+            options[name] = value
+    
+    declared = data.get('files')
+    if not isinstance(declared, list) or not declared:
+        return jsonify({'error': 'No files provided'}), 400
+    if len(declared) > app.config['MAX_FILES']:
+        # Every declared file gets a spool file and rows in the upload store up front
+        return jsonify({'error': f"At most {app.config['MAX_FILES']} files can be uploaded at once"}), 413
+    for entry in declared:
+        if not isinstance(entry, dict) or not entry.get('name') or not isinstance(entry['name'], str) \
+                or type(entry.get('size')) is not int:
+            return jsonify({'error': 'Every file needs a name and a size in bytes'}), 400
+        if entry['size'] < 1:
+            return jsonify({'error': f"{entry['name']} is empty"}), 400
+        if entry['size'] > app.config['MAX_FILE_SIZE']:
+            return jsonify({
+                'error': 'File too large',
+                'message': f"{entry['name']} is larger than {app.config['MAX_FILE_SIZE'] // 2**20} MB"
+            }), 413
+    
+    session_id = str(uuid.uuid4())
+    job_id = str(uuid.uuid4())
+    batch_id = uuid.uuid4().hex
+    expiry_time = time.time() + app.config['EXPIRATION_TIME']
+    files = [(uuid.uuid4().hex, entry['name'], entry['size'], spool_path(app.config['UPLOAD_FOLDER'], entry['name']))
+             for entry in declared]
+    for upload_id, filename, size, path in files:
+        open(path, 'xb').close()
+    
+    os.makedirs(os.path.join(app.config['OUTPUT_FOLDER'], session_id), exist_ok=True)
+    session_store.create(session_id, expiry_time, job_id=job_id)
+    expiry_scheduler.schedule(session_id, expiry_time)
+    upload_store.create_batch(batch_id, session_id, job_id, output_format, options, files)
+    
+    expiry_datetime = datetime.datetime.fromtimestamp(expiry_time)
+    job = {
+        'job_id': job_id,
+        'session_id': session_id,
+        'batch_id': batch_id,
+        'status': 'queued',
+        'total': len(files),
+        'completed': 0,
+        'failed': 0,
+        'results': [{'original': filename, 'status': 'pending'} for upload_id, filename, size, path in files],
+        'download_all_url': url_for('download_all', session_id=session_id),
+        'session_url': url_for('view_session', session_id=session_id, _external=True),
+        'expires_at': expiry_datetime.strftime('%Y-%m-%d %H:%M:%S'),
+        'expiration_seconds': app.config['EXPIRATION_TIME'],
+        'created_at': time.time(),
+        'finished_at': None
+    }
+    save_job(job)
+    print(f"[DEBUG] Started chunked upload {batch_id} of {len(files)} files to {output_format} for session {session_id}")
+    
+    return jsonify({
+        'batch_id': batch_id,
+        'job_id': job_id,
+        'session_id': session_id,
+        'status_url': url_for('job_status', job_id=job_id),
+        'session_url': job['session_url'],
+        'download_all_url': job['download_all_url'],
+        'expires_at': job['expires_at'],
+        'expiration_seconds': job['expiration_seconds'],
+        'chunk_size': app.config['UPLOAD_CHUNK_SIZE'],
+        'files': [{
+            'name': filename,
+            'size': size,
+            'upload_url': url_for('upload_chunk', upload_id=upload_id)
+        } for upload_id, filename, size, path in files]
+    }), 201
+
+def upload_status(upload):
+    """What a client needs to resume the upload of a file"""
+    return {
+        'name': upload['filename'],
+        'size': upload['size'],
+        'received': upload['received'],
+        'missing': missing_ranges(upload['ranges'], upload['size']),
+        'status': upload['status']
+    }
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_progress(upload_id):
+    """API endpoint to report which byte ranges of a file are still missing"""
+    upload = upload_store.get(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(upload_status(upload))
+
+@app.route('/uploads/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    """Receive one chunk of a file of a chunked upload.
+
+    The body is written at the byte offset given by the Upload-Offset
+    header. Chunks may arrive in any order, in parallel and on any worker,
+    and may be sent again after a failure. The request that completes the
+    file starts its conversion; if there isn't memory for it, that request
+    is answered with 503 and has to be repeated (an empty chunk will do).
+    """
+    upload = upload_store.get(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return jsonify({'error': 'Upload-Offset header required'}), 400
+    length = request.content_length
+    if length is None:
+        return jsonify({'error': 'Content-Length header required'}), 411
+    if offset < 0 or offset + length > upload['size']:
+        return jsonify({'error': f"Chunk of {length} bytes at offset {offset} is outside of the {upload['size']} byte file"}), 400
+    
+    if upload['status'] == RECEIVING:
+        try:
+            write_chunk(request.stream, upload['path'], offset, length)
+        except ValueError as e:
+            return jsonify({'error': 'Incomplete chunk', 'message': str(e)}), 400
+    
+    upload, claimed = upload_store.add_range(upload_id, offset, offset + length)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    if claimed:
+        try:
+            start_chunked_conversion(upload)
+        except ServerBusy:
+            upload_store.release(upload_id)
+            return server_busy()
+        except Exception:
+            upload_store.release(upload_id)
+            raise
+    return jsonify(upload_status(upload))
+
 @app.route('/check-session/<session_id>')
 def check_session(session_id):
     """API endpoint to check if a session is still valid and when it expires"""
-    if session_id in sessions:
-        # Handle both old and new format
-        if isinstance(sessions[session_id], dict):
-            expiry_time = sessions[session_id].get('created_at', 0)
-        else:
-            expiry_time = sessions[session_id]
-            
+    expiry_time = session_store.expires_at(session_id)
+    if expiry_time is not None:
         current_time = time.time()
         
         if current_time <= expiry_time:
@@ -444,52 +1343,49 @@ def check_session(session_id):
         'valid': False
     })
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """API endpoint to report the progress of a background conversion job"""
+    job = load_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job.get('batch_id') and job['finished_at'] is None:
+        # Chunked uploads record their progress in the upload store
+        progress = upload_store.progress(job_id)
+        if progress is not None:
+            job.update(batch_progress(progress[1]))
+            if any(is_orphaned(upload) for upload in progress[1]):
+                # In the background, with this request's URLs for the results
+                threading.Thread(target=copy_current_request_context(recover_chunked_conversions), args=(job_id,),
+                                 daemon=True).start()
+    return jsonify(job)
+
 @app.route('/share/<session_id>/<filename>')
 def share_file(session_id, filename):
     """Render a simple page to view and download shared file"""
     print(f"[DEBUG] Share request for session_id: {session_id}, filename: {filename}")
-    print(f"[DEBUG] Active sessions: {list(sessions.keys())}")
     
     # Check if session exists and is not expired
-    if session_id not in sessions:
-        print(f"[DEBUG] Session {session_id} not found in sessions dict")
+    expiry_time = session_store.expires_at(session_id)
+    if expiry_time is None:
+        print(f"[DEBUG] Session {session_id} not found in session store")
         # Check if file exists anyway (for recovery purposes)
-        file_path = os.path.join(app.config['OUTPUT_FOLDER'], session_id, filename)
-        if os.path.exists(file_path):
-            print(f"[DEBUG] File exists but session is not registered: {file_path}")
-            # Auto-register the session
-            expiry_time = time.time() + app.config['EXPIRATION_TIME']
-            sessions[session_id] = {
-                'created_at': expiry_time,
-                'files': [{
-                    'original_filename': filename,
-                    'converted_filename': filename,
-                    'conversion_time': time.time()
-                }]
-            }
-            save_sessions()
-            print(f"[DEBUG] Auto-registered session {session_id}")
-        else:
+        if not auto_register_session(session_id, filename):
             return render_template('error.html', message="File link has expired or is invalid"), 404
+        expiry_time = session_store.expires_at(session_id)
     
-    # Get expiry time, handling both formats
-    if isinstance(sessions[session_id], dict):
-        expiry_time = sessions[session_id].get('created_at', 0)
-    else:
-        expiry_time = sessions[session_id]
-        
     if time.time() > expiry_time:
         # Expired but don't clean up, just report
         print(f"[DEBUG] Session {session_id} expired at {datetime.datetime.fromtimestamp(expiry_time)}")
         return render_template('error.html', message="File link has expired"), 404
     
-    file_path = os.path.join(app.config['OUTPUT_FOLDER'], session_id, filename)
-    if not os.path.exists(file_path):
-        print(f"[DEBUG] File not found: {file_path}")
+    listing = session_listings.get(session_id, os.path.join(app.config['OUTPUT_FOLDER'], session_id))
+    if listing is None or filename not in listing.names:
+        print(f"[DEBUG] File not found: {session_id}/{filename}")
         return render_template('error.html', message="File not found or has expired"), 404
     
-    print(f"[DEBUG] File exists: {file_path}")
     file_url = url_for('static_file', session_id=session_id, filename=filename)
+    preview_url = url_for('preview_file', session_id=session_id, filename=filename)
     download_url = url_for('download_file', session_id=session_id, filename=filename)
     
     # Calculate time left
@@ -500,105 +1396,137 @@ def share_file(session_id, filename):
     return render_template('share.html', 
                            filename=filename, 
                            file_url=file_url, 
+                           preview_url=preview_url,
                            download_url=download_url,
                            expires_at=expiry_formatted,
                            seconds_left=time_left,
                            session_id=session_id)
 
+def offload_file(directory, filename, max_age=None, as_attachment=False):
+    """Hand a file under OUTPUT_FOLDER to the front proxy instead of sending it from Python.
+
+    The response carries the headers of the file (type, disposition,
+    caching) but no body. With x-sendfile the proxy gets the absolute path.
+    With x-accel nginx gets the path under OFFLOAD_PREFIX, an internal
+    location that serves the outputs volume. The proxy then answers
+    conditional and Range requests itself.
+    """
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+    response = werkzeug_send_file(
+        os.path.abspath(path), request.environ, as_attachment=as_attachment, conditional=False,
+        etag=False, max_age=max_age, use_x_sendfile=True, response_class=app.response_class
+    )
+    if app.config['FILE_OFFLOAD'] == 'x-accel':
+        del response.headers['X-Sendfile']
+        relative_path = os.path.relpath(path, app.config['OUTPUT_FOLDER']).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = app.config['OFFLOAD_PREFIX'].rstrip('/') + '/' + quote(relative_path)
+    return response
+
+def send_output(directory, filename, expires_at, **kwargs):
+    """Serve a converted file (or its preview) for a session that expires at expires_at.
+
+    Outputs are written once and only ever replaced atomically, so browsers
+    may keep them until the session expires without asking again. The ETag
+    and Last-Modified validators let Werkzeug answer conditional requests
+    with 304, and Range requests are served so large downloads can resume.
+    """
+    max_age = int(expires_at - time.time())
+    if app.config['FILE_OFFLOAD']:
+        response = offload_file(directory, filename, max_age=max(max_age, 0), **kwargs)
+    else:
+        response = send_from_directory(directory, filename, max_age=max(max_age, 0), **kwargs)
+    if max_age > 0:
+        # Session links are private, keep them out of shared caches
+        response.cache_control.public = False
+        response.cache_control.private = True
+        response.cache_control.immutable = True
+    return response
+
 @app.route('/static-file/<session_id>/<filename>')
 def static_file(session_id, filename):
     """Serve the file for viewing in the browser (not as attachment)"""
-    # Auto-register session if it exists on disk but not in memory
-    if session_id not in sessions:
-        file_path = os.path.join(app.config['OUTPUT_FOLDER'], session_id, filename)
-        if os.path.exists(file_path):
-            # Auto-register the session
-            expiry_time = time.time() + app.config['EXPIRATION_TIME']
-            sessions[session_id] = {
-                'created_at': expiry_time,
-                'files': [{
-                    'original_filename': filename,
-                    'converted_filename': filename,
-                    'conversion_time': time.time()
-                }]
-            }
-            save_sessions()
-            print(f"[DEBUG] Auto-registered session {session_id} for static file")
-    
-    # Check if session exists and is not expired
-    if session_id not in sessions:
+    # Check if session exists and is not expired, auto-registering
+    # sessions that exist on disk but not in the store
+    expiry_time = session_store.expires_at(session_id)
+    if expiry_time is None and auto_register_session(session_id, filename):
+        expiry_time = session_store.expires_at(session_id)
+    if expiry_time is None:
         return render_template('error.html', message="File link has expired or is invalid"), 404
     
-    # Get expiry time, handling both formats
-    if isinstance(sessions[session_id], dict):
-        expiry_time = sessions[session_id].get('created_at', 0)
-    else:
-        expiry_time = sessions[session_id]
-        
     if time.time() > expiry_time:
         # Don't clean up, just report expiry
         print(f"[DEBUG] Session {session_id} expired for static file")
         return render_template('error.html', message="File link has expired"), 404
     
     directory = os.path.join(app.config['OUTPUT_FOLDER'], session_id)
-    return send_from_directory(directory, filename)
+    return send_output(directory, filename, expiry_time)
+
+@app.route('/preview/<session_id>/<filename>')
+def preview_file(session_id, filename):
+    """Serve the small preview of a converted file, creating it if it is missing"""
+    # Check if session exists and is not expired, auto-registering
+    # sessions that exist on disk but not in the store
+    expiry_time = session_store.expires_at(session_id)
+    if expiry_time is None and auto_register_session(session_id, filename):
+        expiry_time = session_store.expires_at(session_id)
+    if expiry_time is None:
+        return render_template('error.html', message="File link has expired or is invalid"), 404
+    
+    if time.time() > expiry_time:
+        # Don't clean up, just report expiry
+        return render_template('error.html', message="File link has expired"), 404
+    
+    directory = os.path.join(app.config['OUTPUT_FOLDER'], session_id)
+    preview = preview_path(session_id, filename)
+    if not os.path.exists(preview):
+        # Cache hits and sessions from before previews existed
+        source_path = safe_join(directory, filename)
+        if source_path is None or not os.path.isfile(source_path):
+            return render_template('error.html', message="File not found or has expired"), 404
+        try:
+            create_preview(source_path, preview)
+        except Exception as e:
+            # Show formats Pillow can't preview as they are
+            print(f"[DEBUG] Could not create preview for {source_path}: {str(e)}")
+            return send_output(directory, filename, expiry_time)
+    return send_output(os.path.dirname(preview), os.path.basename(preview), expiry_time)
 
 @app.route('/session/<session_id>')
 def view_session(session_id):
     """View all files in a session"""
-    # Auto-register session if it exists on disk but not in memory
-    if session_id not in sessions:
-        session_dir = os.path.join(app.config['OUTPUT_FOLDER'], session_id)
-        if os.path.exists(session_dir) and os.path.isdir(session_dir):
-            # Auto-register the session
-            expiry_time = time.time() + app.config['EXPIRATION_TIME']
-            sessions[session_id] = {
-                'created_at': expiry_time,
-                'files': []
-            }
-            
-            # Scan for files
-            for filename in os.listdir(session_dir):
-                if os.path.isfile(os.path.join(session_dir, filename)) and not filename.endswith('.zip'):
-                    sessions[session_id]['files'].append({
-                        'original_filename': filename,
-                        'converted_filename': filename,
-                        'conversion_time': time.time()
-                    })
-            
-            save_sessions()
-            print(f"[DEBUG] Auto-registered session {session_id} with {len(sessions[session_id]['files'])} files")
-    
-    # Check if session exists and is not expired
-    if session_id not in sessions:
+    # Check if session exists and is not expired, auto-registering
+    # sessions that exist on disk but not in the store
+    expiry_time = session_store.expires_at(session_id)
+    if expiry_time is None and auto_register_session(session_id):
+        expiry_time = session_store.expires_at(session_id)
+    if expiry_time is None:
         return render_template('error.html', message="Session link has expired or is invalid"), 404
     
-    # Get expiry time, handling both formats
-    if isinstance(sessions[session_id], dict):
-        expiry_time = sessions[session_id].get('created_at', 0)
-    else:
-        expiry_time = sessions[session_id]
-        
     if time.time() > expiry_time:
         # Don't clean up, just report expiry
         return render_template('error.html', message="Session link has expired"), 404
     
-    session_dir = os.path.join(app.config['OUTPUT_FOLDER'], session_id)
-    if not os.path.exists(session_dir):
+    listing = session_listings.get(session_id, os.path.join(app.config['OUTPUT_FOLDER'], session_id))
+    if listing is None:
         return render_template('error.html', message="Session not found or has expired"), 404
     
-    files = []
-    for filename in os.listdir(session_dir):
-        if os.path.isfile(os.path.join(session_dir, filename)) and not filename.endswith('.zip'):
-            file_url = url_for('static_file', session_id=session_id, filename=filename)
-            download_url = url_for('download_file', session_id=session_id, filename=filename)
-            share_url = url_for('share_file', session_id=session_id, filename=filename, _external=True)
+    # The URLs only change with the file list, or the host of the share URLs
+    files = listing.derived.get(('files', request.host_url))
+    if files is None:
+        files = []
+        for filename, _, _ in listing.members:
+            if filename.endswith('.zip'):
+                continue
             files.append({
                 'filename': filename,
-                'file_url': file_url,
-                'download_url': download_url,
-                'share_url': share_url
+                'file_url': url_for('static_file', session_id=session_id, filename=filename),
+                'preview_url': url_for('preview_file', session_id=session_id, filename=filename),
+                'download_url': url_for('download_file', session_id=session_id, filename=filename),
+                'share_url': url_for('share_file', session_id=session_id, filename=filename, _external=True)
             })
+        listing.derived[('files', request.host_url)] = files
     
     download_all_url = url_for('download_all', session_id=session_id)
     
@@ -616,90 +1544,63 @@ def view_session(session_id):
 
 @app.route('/download/<session_id>/<filename>')
 def download_file(session_id, filename):
-    # Auto-register session if it exists on disk but not in memory
-    if session_id not in sessions:
-        file_path = os.path.join(app.config['OUTPUT_FOLDER'], session_id, filename)
-        if os.path.exists(file_path):
-            # Auto-register the session
-            expiry_time = time.time() + app.config['EXPIRATION_TIME']
-            sessions[session_id] = {
-                'created_at': expiry_time,
-                'files': [{
-                    'original_filename': filename,
-                    'converted_filename': filename,
-                    'conversion_time': time.time()
-                }]
-            }
-            save_sessions()
-            print(f"[DEBUG] Auto-registered session {session_id} for download")
-    
-    # Check if session exists and is not expired
-    if session_id not in sessions:
+    # Check if session exists and is not expired, auto-registering
+    # sessions that exist on disk but not in the store
+    expiry_time = session_store.expires_at(session_id)
+    if expiry_time is None and auto_register_session(session_id, filename):
+        expiry_time = session_store.expires_at(session_id)
+    if expiry_time is None:
         return render_template('error.html', message="File link has expired or is invalid"), 404
     
-    # Get expiry time, handling both formats
-    if isinstance(sessions[session_id], dict):
-        expiry_time = sessions[session_id].get('created_at', 0)
-    else:
-        expiry_time = sessions[session_id]
-        
     if time.time() > expiry_time:
         # Don't clean up, just report expiry
         print(f"[DEBUG] Session {session_id} expired for download")
         return render_template('error.html', message="File link has expired"), 404
     
     directory = os.path.join(app.config['OUTPUT_FOLDER'], session_id)
-    return send_from_directory(directory, filename, as_attachment=True)
+    return send_output(directory, filename, expiry_time, as_attachment=True)
 
 @app.route('/download-all/<session_id>')
+@profiled('download-all')
 def download_all(session_id):
-    # Auto-register session if it exists on disk but not in memory
-    if session_id not in sessions:
-        session_dir = os.path.join(app.config['OUTPUT_FOLDER'], session_id)
-        if os.path.exists(session_dir) and os.path.isdir(session_dir):
-            # Auto-register the session
-            expiry_time = time.time() + app.config['EXPIRATION_TIME']
-            sessions[session_id] = {
-                'created_at': expiry_time,
-                'files': []
-            }
-            
-            # Scan for files
-            for filename in os.listdir(session_dir):
-                if os.path.isfile(os.path.join(session_dir, filename)) and not filename.endswith('.zip'):
-                    sessions[session_id]['files'].append({
-                        'original_filename': filename,
-                        'converted_filename': filename,
-                        'conversion_time': time.time()
-                    })
-            
-            save_sessions()
-            print(f"[DEBUG] Auto-registered session {session_id} for download-all")
-    
-    # Check if session exists and is not expired
-    if session_id not in sessions:
+    # Check if session exists and is not expired, auto-registering
+    # sessions that exist on disk but not in the store
+    expiry_time = session_store.expires_at(session_id)
+    if expiry_time is None and auto_register_session(session_id):
+        expiry_time = session_store.expires_at(session_id)
+    if expiry_time is None:
         return render_template('error.html', message="Session link has expired or is invalid"), 404
     
-    # Get expiry time, handling both formats
-    if isinstance(sessions[session_id], dict):
-        expiry_time = sessions[session_id].get('created_at', 0)
-    else:
-        expiry_time = sessions[session_id]
-        
     if time.time() > expiry_time:
         # Don't clean up, just report expiry
         print(f"[DEBUG] Session {session_id} expired for download-all")
         return render_template('error.html', message="Session link has expired"), 404
     
-    # Create a zip of all files in the session
-    session_dir = os.path.join(app.config['OUTPUT_FOLDER'], session_id)
     zip_filename = f"{session_id}_converted.zip"
-    zip_path = os.path.join(app.config['OUTPUT_FOLDER'], zip_filename)
+    zip_path = archive_path(session_id)
+    listing = session_listings.get(session_id, os.path.join(app.config['OUTPUT_FOLDER'], session_id))
+    if listing is None:
+        return render_template('error.html', message="Session not found or has expired"), 404
+    members = listing.members
+    tag_profile(files=len(members), bytes=sum(st.st_size for _, _, st in members))
+    
+    # Reuse the archive while the session's files are unchanged
+    if is_current(zip_path, members):
+        if app.config['FILE_OFFLOAD']:
+            return offload_file(app.config['OUTPUT_FOLDER'], zip_filename, as_attachment=True)
+        return send_from_directory(app.config['OUTPUT_FOLDER'], zip_filename, as_attachment=True)
     
-    # Create zip file
-    shutil.make_archive(zip_path.replace('.zip', ''), 'zip', session_dir)
+    if app.config['FILE_OFFLOAD']:
+        # Build it here and let the proxy send it, so slow clients don't hold a worker
+        build_archive(members, zip_path)
+        return offload_file(app.config['OUTPUT_FOLDER'], zip_filename, as_attachment=True)
     
-    return send_from_directory(app.config['OUTPUT_FOLDER'], zip_filename, as_attachment=True)
+    # Otherwise stream it while it is built, keeping a copy for the next request
+    return Response(
+        stream_archive(members, zip_path),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename={zip_filename}'}
+    )
 
 @app.route('/cleanup/<session_id>', methods=['POST'])
 def cleanup(session_id):
@@ -711,43 +1612,18 @@ def cleanup(session_id):
 def extend_session(session_id):
     """Extend the session expiration time by another hour"""
     print(f"[DEBUG] Extend request for session_id: {session_id}")
-    print(f"[DEBUG] Active sessions: {list(sessions.keys())}")
     
-    # Check if the directory exists even if not in sessions dict
-    session_dir = os.path.join(app.config['OUTPUT_FOLDER'], session_id)
-    if session_id not in sessions and os.path.exists(session_dir) and os.path.isdir(session_dir):
-        print(f"[DEBUG] Session directory exists but not in sessions dict: {session_id}")
-        # Auto-register the session
-        expiry_time = time.time() + app.config['EXPIRATION_TIME']
-        sessions[session_id] = {
-            'created_at': expiry_time,
-            'files': []
-        }
-        
-        # Scan for files
-        for filename in os.listdir(session_dir):
-            if os.path.isfile(os.path.join(session_dir, filename)) and not filename.endswith('.zip'):
-                sessions[session_id]['files'].append({
-                    'original_filename': filename,
-                    'converted_filename': filename,
-                    'conversion_time': time.time()
-                })
-        
-        save_sessions()
-        print(f"[DEBUG] Auto-registered session {session_id}")
+    # Add another hour
+    new_expiry = time.time() + app.config['EXPIRATION_TIME']
     
-    if session_id in sessions:
-        # Add another hour
-        new_expiry = time.time() + app.config['EXPIRATION_TIME']
-        
-        # Update expiry time, handling both formats
-        if isinstance(sessions[session_id], dict):
-            sessions[session_id]['created_at'] = new_expiry
-        else:
-            sessions[session_id] = new_expiry
-            
-        save_sessions()  # Save sessions after extension
-        
+    # Register the session if the directory exists even if not in the store
+    extended = session_store.set_expiry(session_id, new_expiry)
+    if not extended and auto_register_session(session_id):
+        print(f"[DEBUG] Session directory exists but was not in the store: {session_id}")
+        extended = session_store.set_expiry(session_id, new_expiry)
+    
+    if extended:
+        expiry_scheduler.schedule(session_id, new_expiry)
         expiry_datetime = datetime.datetime.fromtimestamp(new_expiry)
         expiry_formatted = expiry_datetime.strftime('%Y-%m-%d %H:%M:%S')
         print(f"[DEBUG] Extended session {session_id} to {expiry_formatted}")
@@ -764,7 +1640,33 @@ def extend_session(session_id):
 @app.route('/api/formats')
 def get_formats():
     """Return supported formats as JSON"""
-    return jsonify(SUPPORTED_FORMATS)
+    return jsonify(supported_formats())
+
+@app.route('/api/cache')
+def get_cache_stats():
+    """Return conversion cache hit/miss counters as JSON"""
+    return jsonify(conversion_cache.stats())
+
+@app.route('/api/gc')
+def get_gc_stats():
+    """Return the settings of the output GC and what its last sweep reclaimed as JSON"""
+    return jsonify({
+        'enabled': app.config['GC_INTERVAL'] > 0,
+        'interval': app.config['GC_INTERVAL'],
+        'grace': app.config['GC_GRACE'],
+        'max_bytes': app.config['GC_MAX_BYTES'],
+        'max_inodes': app.config['GC_MAX_INODES'],
+        'last_sweep': output_collector.last_report()
+    })
+
+@app.route('/metrics')
+def get_metrics():
+    """Conversion metrics of all workers in the Prometheus text format"""
+    body = metrics.render(gauges={
+        'image_convert_active_sessions': session_store.count_active(time.time()),
+        'image_convert_memory_in_flight_bytes': memory_budget.in_flight()
+    })
+    return Response(body, content_type='text/plain; version=0.0.4; charset=utf-8')
 
 @app.route('/debug/session/<session_id>')
 def debug_session(session_id):
@@ -772,9 +1674,10 @@ def debug_session(session_id):
     if not app.debug:
         return jsonify({'error': 'Debug endpoints only available in debug mode'}), 403
         
+    session_data = session_store.get(session_id)
     result = {
         'session_id': session_id,
-        'in_memory': session_id in sessions,
+        'in_store': session_data is not None,
         'directory_exists': False
     }
     
@@ -796,25 +1699,17 @@ def debug_session(session_id):
         result['files'] = files
     
     # Include session data if it exists
-    if session_id in sessions:
-        session_data = sessions[session_id]
-        if isinstance(session_data, dict):
-            expiry_time = session_data.get('created_at', 0)
-            result['session_data'] = {
-                'expires_at': datetime.datetime.fromtimestamp(expiry_time).strftime('%Y-%m-%d %H:%M:%S'),
-                'seconds_left': int(expiry_time - time.time()),
-                'files_count': len(session_data.get('files', []))
-            }
-        else:
-            # Handle legacy format
-            result['session_data'] = {
-                'expires_at': datetime.datetime.fromtimestamp(session_data).strftime('%Y-%m-%d %H:%M:%S'),
-                'seconds_left': int(session_data - time.time()),
-                'legacy_format': True
-            }
+    if session_data is not None:
+        expiry_time = session_data['created_at']
+        result['session_data'] = {
+            'expires_at': datetime.datetime.fromtimestamp(expiry_time).strftime('%Y-%m-%d %H:%M:%S'),
+            'seconds_left': int(expiry_time - time.time()),
+            'files_count': len(session_data['files']),
+            'job_id': session_data['job_id']
+        }
     
-    # Include all active sessions
-    result['active_sessions'] = list(sessions.keys())
+    # Include the number of active sessions
+    result['active_sessions'] = session_store.count()
     
     return jsonify(result)
 
@@ -844,10 +1739,6 @@ def serve_static(filename):
     return send_from_directory('static', filename)
 
 if __name__ == '__main__':
-    # Start background cleanup thread
-    cleanup_thread = threading.Thread(target=cleanup_expired_sessions, daemon=True)
-    cleanup_thread.start()
-    
     # FORCE port 5000 with no randomization whatsoever
     port = 5000
     print(f"FORCING PORT 5000 - IGNORING ALL OTHER PORT SETTINGS")
@@ -0,0 +1,118 @@
+import os
+import time
+import uuid
+import hashlib
+import zipfile
+
+CHUNK_SIZE = 64 * 1024
+
+# Formats that are already compressed - deflating them again costs CPU for no gain
+STORED_EXTENSIONS = {'.jpg', '.jpeg', '.jpe', '.webp', '.heic', '.heif', '.avif', '.png', '.gif'}
+
+
+def archive_members(session_dir):
+    """Return (name, path, stat) for the files that belong in a session's archive, sorted by name"""
+    members = []
+    try:
+        with os.scandir(session_dir) as entries:
+            for entry in entries:
+                # Skip in-progress .part files and other hidden files
+                if entry.name.startswith('.') or entry.name.endswith('.part') or not entry.is_file():
+                    continue
+                members.append((entry.name, entry.path, entry.stat()))
+    except FileNotFoundError:
+        pass
+    members.sort()
+    return members
+
+
+def fingerprint(members):
+    """Identify a file set by the names, sizes and modification times of its files"""
+    digest = hashlib.sha256()
+    for name, _, st in members:
+        digest.update(f"{name}\0{st.st_size}\0{st.st_mtime_ns}\n".encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+
+def is_current(zip_path, members):
+    """True if zip_path was built from exactly this file set"""
+    try:
+        with zipfile.ZipFile(zip_path) as zf:
+            return zf.comment == fingerprint(members).encode('ascii')
+    except (OSError, zipfile.BadZipFile):
+        return False
+
+
+class _TeeWriter:
+    """Unseekable file object for ZipFile that collects output for the client and the cache file"""
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.cache_file.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_archive(members, zip_path, chunk_size=CHUNK_SIZE):
+    """Build a ZIP of members, yielding it chunk by chunk while it is written.
+
+    The archive is written to a private .part file next to zip_path at the
+    same time and moved into place only once it is complete, so concurrent
+    downloads never see each other's half-written archive. The file set
+    fingerprint is stored as the archive comment for is_current().
+    """
+    part_path = os.path.join(os.path.dirname(zip_path), f".{uuid.uuid4().hex}.part")
+    complete = False
+    try:
+        with open(part_path, 'wb') as cache_file:
+            writer = _TeeWriter(cache_file)
+            with zipfile.ZipFile(writer, 'w') as zf:
+                zf.comment = fingerprint(members).encode('ascii')
+                for name, path, st in members:
+                    info = zipfile.ZipInfo(name, time.localtime(st.st_mtime)[:6])
+                    info.file_size = st.st_size
+                    info.external_attr = (st.st_mode & 0xFFFF) << 16
+                    if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+                        info.compress_type = zipfile.ZIP_STORED
+                    else:
+                        info.compress_type = zipfile.ZIP_DEFLATED
+                    try:
+                        src = open(path, 'rb')
+                    except FileNotFoundError:
+                        # Removed since it was listed
+                        continue
+                    with src, zf.open(info, 'w') as dest:
+                        while True:
+                            chunk = src.read(chunk_size)
+                            if not chunk:
+                                break
+                            dest.write(chunk)
+                            if writer.chunks:
+                                yield writer.drain()
+                    if writer.chunks:
+                        yield writer.drain()
+            # Central directory
+            yield writer.drain()
+        os.replace(part_path, zip_path)
+        complete = True
+    finally:
+        # Also reached when the client disconnects mid-download
+        if not complete and os.path.exists(part_path):
+            os.remove(part_path)
+
+
+def build_archive(members, zip_path):
+    """Write the archive of members to zip_path without streaming it anywhere"""
+    for _ in stream_archive(members, zip_path):
+        pass
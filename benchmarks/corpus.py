@@ -0,0 +1,62 @@
+"""Deterministic synthetic images for the benchmarks.
+
+Everything is generated from fixed seeds, so two runs (and two commits)
+measure exactly the same pixels.
+"""
+import random
+from PIL import Image, ImageDraw, ImageFilter
+
+# Modes tried in order when a format can't store the image as it is
+FALLBACK_MODES = ['RGB', 'RGBA', 'L', 'P', '1']
+
+
+def grain(size, seed=0):
+    """Blurred pseudo-random noise from a fixed seed"""
+    noise = random.Random(seed).randbytes(size[0] * size[1])
+    return Image.frombytes('L', size, noise).filter(ImageFilter.GaussianBlur(1))
+
+
+def photo(size, seed=0):
+    """Smooth gradients with fractal detail and some grain, roughly like a photo"""
+    noise = grain(size, seed)
+    detail = Image.effect_mandelbrot(size, (-0.75, -0.1, -0.7, -0.05), 200)
+    return Image.merge('RGB', (
+        Image.blend(Image.linear_gradient('L').resize(size), noise, 0.3),
+        detail,
+        Image.blend(Image.radial_gradient('L').resize(size), noise, 0.3),
+    ))
+
+
+def graphic(size):
+    """Flat colours, sharp edges and text on a transparent background"""
+    image = Image.new('RGBA', size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    width, height = size
+    for i in range(12):
+        box = (i * width // 30, i * height // 30, width - i * width // 30 - 1, height - i * height // 30 - 1)
+        draw.rectangle(box, outline=(40 * i % 256, 90, 200, 255), width=6)
+        draw.ellipse(box, fill=(200, 30 * i % 256, 60, 128))
+    for row in range(0, height, 40):
+        draw.text((10, row), "Image Converter reference corpus " * 4, fill=(20, 20, 20, 255))
+    return image
+
+
+def size_for(megapixels):
+    """A 4:3 size of roughly the given number of megapixels"""
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    return width, width * 3 // 4
+
+
+def save_as(image, path, format_name):
+    """Save image in format_name, falling back to other modes the format accepts.
+
+    Returns the mode that was stored; raises the first error if no mode works.
+    """
+    first_error = None
+    for mode in FALLBACK_MODES:
+        try:
+            image.convert(mode).save(path, format_name)
+            return mode
+        except Exception as e:
+            first_error = first_error or e
+    raise first_error
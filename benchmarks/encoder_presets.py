@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Encode time and output size of each encoder preset per output format.
+
+The reference corpus is synthesized by corpus.py: a photo-like image
+(smooth gradients, fractal detail and grain) and a flat-colour graphic
+with transparency.
+
+    python benchmarks/encoder_presets.py --repeat 3
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from converter import ENCODER_PRESETS, encoder_options, prepare_for_format
+from corpus import photo, graphic
+
+FORMATS = ['JPEG', 'PNG', 'WEBP', 'TIFF', 'HEIF']
+
+
+def measure(image, format_name, save_options, repeat):
+    timings = []
+    for _ in range(repeat):
+        buffer = io.BytesIO()
+        start = time.perf_counter()
+        image.save(buffer, format_name, **save_options)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), buffer.tell()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark encoder presets per output format')
+    parser.add_argument('--width', type=int, default=2000, help='Width of the corpus images (default: 2000)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per measurement, the median is reported (default: 3)')
+    parser.add_argument('--formats', nargs='+', default=FORMATS, help='Output formats to measure')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    size = (args.width, args.width * 3 // 4)
+    corpus = {'photo': photo(size), 'graphic': graphic(size)}
+
+    results = []
+    for image_name, image in corpus.items():
+        for output_format in args.formats:
+            for preset in ENCODER_PRESETS:
+                format_name, save_options = encoder_options(output_format, preset)
+                seconds, size_bytes = measure(prepare_for_format(image, format_name), format_name, save_options, args.repeat)
+                results.append({
+                    'image': image_name,
+                    'format': format_name,
+                    'preset': preset,
+                    'ms': round(seconds * 1000, 1),
+                    'kib': round(size_bytes / 1024, 1),
+                })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'image':<8} {'format':<6} {'preset':<9} {'ms':>9} {'KiB':>9}")
+    for r in results:
+        print(f"{r['image']:<8} {r['format']:<6} {r['preset']:<9} {r['ms']:>9} {r['kib']:>9}")
+
+
+if __name__ == "__main__":
+    main()
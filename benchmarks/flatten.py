@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Cost of flattening transparent images for JPEG output.
+
+Compares, per input mode, the conversions an RGBA, LA, PA or transparent
+palette image can go through on its way to JPEG:
+
+    convert    image.convert('RGB'), what JPEG output used to do; drops
+               the alpha instead of compositing it
+    composite  convert('RGBA') + alpha_composite() onto the background +
+               convert('RGB'), the correct result with Pillow's usual calls
+    numpy      the same compositing as integer arithmetic on NumPy arrays
+               (skipped if NumPy isn't installed)
+    flatten    converter.flatten_alpha(), what JPEG output does now
+
+    python benchmarks/flatten.py --megapixels 12 --repeat 5
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import warnings
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image
+from converter import flatten_alpha
+from corpus import photo, size_for
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BACKGROUND = (255, 255, 255)
+
+# convert('RGBA') of a palette image with tRNS alpha asks for exactly that conversion
+warnings.filterwarnings('ignore', message='Palette images with Transparency expressed in bytes')
+
+
+def transparent_images(megapixels):
+    """One image per mode, with a gradient alpha so every pixel needs blending"""
+    rgb = photo(size_for(megapixels))
+    alpha = Image.linear_gradient('L').resize(rgb.size)
+    rgba = rgb.copy()
+    rgba.putalpha(alpha)
+    la = rgb.convert('L')
+    la.putalpha(alpha)
+    palette = rgb.quantize(255)
+    pa = palette.convert('PA')
+    pa.putalpha(alpha)
+    indexed = palette.copy()
+    # A palette entry with its own alpha, as PNG stores it in tRNS
+    indexed.info['transparency'] = bytes(range(0, 255))
+    return {'RGBA': rgba, 'LA': la, 'PA': pa, 'P': indexed}
+
+
+def composite(image):
+    image = image.convert('RGBA')
+    return Image.alpha_composite(Image.new('RGBA', image.size, BACKGROUND + (255,)), image).convert('RGB')
+
+
+def numpy_composite(image):
+    pixels = numpy.asarray(image.convert('RGBA'))
+    alpha = pixels[..., 3:4].astype(numpy.uint16)
+    blended = pixels[..., :3] * alpha + numpy.array(BACKGROUND, numpy.uint16) * (255 - alpha)
+    return Image.fromarray(((blended + 127) // 255).astype(numpy.uint8), 'RGB')
+
+
+METHODS = {
+    'convert': lambda image: image.convert('RGB'),
+    'composite': composite,
+    'numpy': numpy_composite,
+    'flatten': lambda image: flatten_alpha(image, '#%02x%02x%02x' % BACKGROUND),
+}
+
+
+def measure_flatten(megapixels, repeat):
+    """Return one row per (mode, method) with the median of repeat runs"""
+    rows = []
+    for mode, image in transparent_images(megapixels).items():
+        for method, function in METHODS.items():
+            if method == 'numpy' and numpy is None:
+                continue
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                function(image)
+                timings.append(time.perf_counter() - started)
+            rows.append({
+                'mode': mode,
+                'method': method,
+                'megapixels': megapixels,
+                'median_ms': round(statistics.median(timings) * 1000, 2),
+                'min_ms': round(min(timings) * 1000, 2),
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark alpha flattening for JPEG output')
+    parser.add_argument('--megapixels', type=float, default=12, help='Image size (default: 12)')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement, the median is reported (default: 5)')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    rows = measure_flatten(args.megapixels, args.repeat)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+
+    print(f"{'mode':<6} {'method':<10} {'median ms':>10} {'min ms':>8}")
+    for row in rows:
+        print(f"{row['mode']:<6} {row['method']:<10} {row['median_ms']:>10} {row['min_ms']:>8}")
+
+
+if __name__ == "__main__":
+    main()
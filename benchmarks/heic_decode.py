@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Per-megapixel cost of the HEIC decode path, before and after sniffed decoding.
+
+"before" is the original read_heif() + Image.frombytes() path, "after" is
+converter.open_heif_image(). Test files are synthesized with pillow_heif,
+as single-image files and as multi-image containers holding extra images
+next to the primary one.
+
+    python benchmarks/heic_decode.py --sizes 1 4 12 --repeat 5
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pillow_heif
+from PIL import Image
+from converter import open_heif_image
+from corpus import photo, size_for
+
+
+def decode_before(path):
+    heif_file = pillow_heif.read_heif(path)
+    return Image.frombytes(heif_file.mode, heif_file.size, heif_file.data, "raw")
+
+
+def decode_after(path):
+    return open_heif_image(path)
+
+
+def synthesize(path, megapixels, extra_images):
+    """Write a 4:3 RGB HEIC of roughly the given size with extra_images additional top-level images"""
+    width, height = size_for(megapixels)
+    image = photo((width, height))
+    heif_file = pillow_heif.from_pillow(image)
+    for _ in range(extra_images):
+        heif_file.add_from_pillow(image)
+    heif_file.save(path, quality=85)
+    return width, height
+
+
+def measure(decode, path, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        image = decode(path)
+        image.getpixel((0, 0))
+        timings.append(time.perf_counter() - start)
+        del image
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark HEIC decoding per megapixel')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 4, 12],
+                        help='Image sizes in megapixels (default: 1 4 12)')
+    parser.add_argument('--extra-images', type=int, default=2,
+                        help='Additional images in the multi-image container (default: 2)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs per measurement, the median is reported (default: 5)')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for megapixels in args.sizes:
+            for extra_images in sorted({0, args.extra_images}):
+                path = os.path.join(work_dir, f"{megapixels}mp_{extra_images}.heic")
+                width, height = synthesize(path, megapixels, extra_images)
+                actual_mp = width * height / 1_000_000
+                before = measure(decode_before, path, args.repeat)
+                after = measure(decode_after, path, args.repeat)
+                results.append({
+                    'width': width,
+                    'height': height,
+                    'images': extra_images + 1,
+                    'before_ms_per_mp': round(before * 1000 / actual_mp, 2),
+                    'after_ms_per_mp': round(after * 1000 / actual_mp, 2),
+                    'speedup': round(before / after, 2),
+                })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'size':>11} {'images':>6} {'before ms/MP':>13} {'after ms/MP':>12} {'speedup':>8}")
+    for r in results:
+        print(f"{r['width']:>5}x{r['height']:<5} {r['images']:>6} {r['before_ms_per_mp']:>13} "
+              f"{r['after_ms_per_mp']:>12} {r['speedup']:>7}x")
+
+
+if __name__ == "__main__":
+    main()
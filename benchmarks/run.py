@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""Conversion benchmark suite.
+
+Synthesizes a reference corpus (see corpus.py) in every input format of
+SUPPORTED_FORMATS that Pillow or pillow_heif can write, at several
+resolutions, and measures:
+
+    decode   open + full decode of each corpus file
+    convert  the mode conversion convert_image() does for each output format
+    encode   save() with the encoder preset, per input/output pair
+    upload   end-to-end POST /upload latency through the Flask test client
+    startup  import and first request of a fresh worker (see startup.py)
+    flatten  compositing transparent images for JPEG output (see flatten.py)
+
+Results are printed as JSON (or written with --output). Two result files
+can be compared with --compare, which exits non-zero on regressions.
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --output after.json
+    python benchmarks/run.py --compare before.json after.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import contextlib
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import PIL
+import pillow_heif
+from PIL import Image
+from converter import is_heif, open_heif_image, pillow_format, prepare_for_format, encoder_options, DEFAULT_PRESET
+from corpus import photo, size_for, save_as
+from startup import measure_startup
+from flatten import measure_flatten
+
+TIMING_FIELDS = ('decode_ms', 'convert_ms', 'encode_ms', 'median_ms')
+# Fields that identify a row of a section across result files
+KEY_FIELDS = ('stage', 'formats_cache', 'mode', 'method', 'input', 'output', 'megapixels')
+
+
+def timed(function, repeat):
+    """Run function repeat times; returns (median seconds, last result)"""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+
+def decode(path):
+    if is_heif(path):
+        return open_heif_image(path)
+    image = Image.open(path)
+    image.load()
+    return image
+
+
+def encode(image, format_name, save_options):
+    buffer = io.BytesIO()
+    image.save(buffer, format_name, **save_options)
+    return buffer.tell()
+
+
+def input_formats(input_details, selected=None):
+    """One extension per distinct writer, preferring the extension named like the format"""
+    formats = {}
+    for extension in sorted(input_details, key=lambda ext: (ext != pillow_format(ext), ext)):
+        formats.setdefault(pillow_format(extension), extension)
+    if selected:
+        wanted = {pillow_format(name) for name in selected}
+        formats = {name: ext for name, ext in formats.items() if name in wanted}
+    return formats
+
+
+def build_corpus(work_dir, formats, sizes, repeat):
+    corpus, skipped = [], []
+    for megapixels in sizes:
+        source = photo(size_for(megapixels))
+        for format_name, extension in sorted(formats.items()):
+            path = os.path.join(work_dir, f"{megapixels}mp.{extension.lower()}")
+            try:
+                if format_name not in Image.SAVE:
+                    raise ValueError("Pillow has no writer for this format")
+                mode = save_as(source, path, format_name)
+                seconds, image = timed(lambda: decode(path), repeat)
+            except Exception as e:
+                if megapixels == sizes[0]:
+                    skipped.append({'input': format_name, 'reason': str(e) or type(e).__name__})
+                continue
+            pixels = image.width * image.height
+            corpus.append({
+                'input': format_name,
+                'extension': extension.lower(),
+                'megapixels': megapixels,
+                'width': image.width,
+                'height': image.height,
+                'stored_mode': mode,
+                'decoded_mode': image.mode,
+                'bytes': os.path.getsize(path),
+                'path': path,
+                'decode_ms': round(seconds * 1000, 2),
+                'decode_mp_per_s': round(pixels / 1_000_000 / seconds, 2),
+            })
+    return corpus, skipped
+
+
+def measure_stages(corpus, outputs, preset, repeat):
+    stages = []
+    for entry in corpus:
+        image = decode(entry['path'])
+        pixels = image.width * image.height
+        for output_format in outputs:
+            format_name, save_options = encoder_options(output_format, preset)
+            row = {'input': entry['input'], 'output': format_name, 'megapixels': entry['megapixels']}
+            try:
+                convert_seconds, prepared = timed(lambda: prepare_for_format(image, format_name), repeat)
+                encode_seconds, size_bytes = timed(lambda: encode(prepared, format_name, save_options), repeat)
+            except Exception as e:
+                row['error'] = str(e)
+                stages.append(row)
+                continue
+            row.update({
+                'convert_ms': round(convert_seconds * 1000, 2),
+                'encode_ms': round(encode_seconds * 1000, 2),
+                'encode_mp_per_s': round(pixels / 1_000_000 / encode_seconds, 2),
+                'output_bytes': size_bytes,
+            })
+            stages.append(row)
+    return stages
+
+
+def measure_uploads(app_module, corpus, output_format, preset, repeat):
+    client = app_module.app.test_client()
+    uploads = []
+    for entry in corpus:
+        with open(entry['path'], 'rb') as f:
+            data = f.read()
+        timings, statuses = [], set()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = client.post('/upload', data={
+                'format': output_format,
+                'preset': preset,
+                'files[]': [(io.BytesIO(data), os.path.basename(entry['path']))],
+            }, content_type='multipart/form-data')
+            timings.append(time.perf_counter() - start)
+            statuses.add(response.status_code)
+            session_id = (response.get_json(silent=True) or {}).get('session_id')
+            if session_id:
+                shutil.rmtree(os.path.join(app_module.app.config['OUTPUT_FOLDER'], session_id), ignore_errors=True)
+        uploads.append({
+            'input': entry['input'],
+            'output': pillow_format(output_format),
+            'megapixels': entry['megapixels'],
+            'upload_bytes': len(data),
+            'median_ms': round(statistics.median(timings) * 1000, 2),
+            'min_ms': round(min(timings) * 1000, 2),
+            'status': sorted(statuses),
+        })
+    return uploads
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'pillow_heif': pillow_heif.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'sizes': args.sizes,
+        'outputs': args.outputs,
+        'preset': args.preset,
+        'repeat': args.repeat,
+    }
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='image-convert-bench-')
+    try:
+        # The app reads its configuration at import time; keep it in the work
+        # directory and disable the conversion cache so every upload converts
+        os.environ.update({
+            'UPLOAD_DIR': os.path.join(work_dir, 'uploads'),
+            'OUTPUT_DIR': os.path.join(work_dir, 'outputs'),
+            'SESSION_FILE': os.path.join(work_dir, 'data', 'sessions.json'),
+            'JOB_DIR': os.path.join(work_dir, 'data', 'jobs'),
+            'CACHE_MAX_BYTES': '0',
+            'EXPIRY_SWEEPER': '0',
+            'PREBUILD_ZIP': '0',
+        })
+        import app as app_module
+
+        corpus_dir = os.path.join(work_dir, 'corpus')
+        os.makedirs(corpus_dir)
+        formats = input_formats(app_module.supported_formats()['input_details'], args.inputs)
+        corpus, skipped = build_corpus(corpus_dir, formats, args.sizes, args.repeat)
+        stages = measure_stages(corpus, args.outputs, args.preset, args.repeat)
+        uploads = [] if args.skip_upload else measure_uploads(
+            app_module, corpus, args.upload_output, args.preset, args.repeat)
+        app_module.conversion_engine.shutdown()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for entry in corpus:
+        del entry['path']
+    startup = [] if args.skip_startup else measure_startup(args.repeat)
+    flatten = [] if args.skip_flatten else measure_flatten(max(args.sizes), args.repeat)
+    return {'meta': metadata(args), 'corpus': corpus, 'skipped': skipped, 'stages': stages, 'upload': uploads,
+            'startup': startup, 'flatten': flatten}
+
+
+def compare(old_path, new_path, threshold, min_ms=1.0):
+    """Print timings that changed by more than threshold; returns the number of regressions"""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def rows(results):
+        for section in ('corpus', 'stages', 'upload', 'startup', 'flatten'):
+            for row in results.get(section, []):
+                key = (section,) + tuple(row[field] for field in KEY_FIELDS if field in row)
+                yield key, row
+
+    old_rows = dict(rows(old))
+    regressions = 0
+    for key, row in rows(new):
+        before = old_rows.get(key)
+        if before is None:
+            continue
+        for field in TIMING_FIELDS:
+            if field not in row or not before.get(field):
+                continue
+            if max(row[field], before[field]) < min_ms:
+                # Too short to compare reliably
+                continue
+            change = row[field] / before[field] - 1
+            if abs(change) > threshold:
+                regressions += change > 0
+                section, what = key[0], ' '.join(str(part) for part in key[1:])
+                print(f"{'SLOWER' if change > 0 else 'faster':<7} {section:<7} {what:<24} "
+                      f"{field:<11} {before[field]:>10} -> {row[field]:>10} ({change:+.0%})")
+    print(f"{regressions} regression(s) above {threshold:.0%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark decode, convert, encode and /upload latency')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[0.5, 2],
+                        help='Corpus resolutions in megapixels (default: 0.5 2)')
+    parser.add_argument('--inputs', nargs='+', help='Only these input formats (default: all writable ones)')
+    parser.add_argument('--outputs', nargs='+', default=['JPEG', 'PNG', 'WEBP'],
+                        help='Output formats to encode (default: JPEG PNG WEBP)')
+    parser.add_argument('--preset', default=DEFAULT_PRESET, help=f'Encoder preset (default: {DEFAULT_PRESET})')
+    parser.add_argument('--upload-output', default='JPEG', help='Output format for the /upload runs (default: JPEG)')
+    parser.add_argument('--skip-upload', action='store_true', help='Skip the /upload latency runs')
+    parser.add_argument('--skip-startup', action='store_true', help='Skip the worker startup runs')
+    parser.add_argument('--skip-flatten', action='store_true', help='Skip the alpha flattening runs')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per measurement, the median is reported (default: 3)')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative change reported by --compare (default: 0.1)')
+    parser.add_argument('--min-ms', type=float, default=1.0,
+                        help='Ignore timings below this many milliseconds in --compare (default: 1.0)')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold, args.min_ms) else 0)
+
+    # The app logs to stdout, keep that out of the JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Cold-start cost of an app worker.
+
+Every run starts a fresh interpreter, as gunicorn does for each worker,
+and measures the import of app.py and the first request to / (which needs
+the format table). "cold" runs start without a format cache, like the
+first worker after a deploy; "warm" runs find the one the previous run
+wrote, like every other worker and every restart.
+
+    python benchmarks/startup.py --repeat 5
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the fresh interpreter; the app logs to stdout, so the result is the last line
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {root!r})
+import app
+imported = time.perf_counter()
+from PIL import Image
+plugins = len(Image.OPEN)
+response = app.app.test_client().get('/')
+served = time.perf_counter()
+print(json.dumps({{'import_ms': (imported - started) * 1000, 'first_request_ms': (served - imported) * 1000,
+                  'plugins_at_import': plugins, 'status': response.status_code}}))
+"""
+
+
+def start_worker(work_dir):
+    env = dict(os.environ,
+               UPLOAD_DIR=os.path.join(work_dir, 'uploads'),
+               OUTPUT_DIR=os.path.join(work_dir, 'outputs'),
+               SESSION_FILE=os.path.join(work_dir, 'data', 'sessions.json'),
+               JOB_DIR=os.path.join(work_dir, 'data', 'jobs'),
+               EXPIRY_SWEEPER='0')
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', PROBE.format(root=ROOT)], env=env, cwd=work_dir,
+                            capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process_ms'] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def measure_startup(repeat):
+    """Return one row per (stage, formats cache) with the median of repeat fresh workers"""
+    runs = {'cold': [], 'warm': []}
+    for _ in range(repeat):
+        work_dir = tempfile.mkdtemp(prefix='image-convert-startup-')
+        try:
+            runs['cold'].append(start_worker(work_dir))
+            runs['warm'].append(start_worker(work_dir))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    rows = []
+    for cache, results in runs.items():
+        for stage in ('process', 'import', 'first_request'):
+            timings = [result[f"{stage}_ms"] for result in results]
+            rows.append({
+                'stage': stage,
+                'formats_cache': cache,
+                'median_ms': round(statistics.median(timings), 2),
+                'min_ms': round(min(timings), 2),
+                'plugins_at_import': results[0]['plugins_at_import'],
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark app worker startup')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Fresh workers per measurement, the median is reported (default: 5)')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    rows = measure_startup(args.repeat)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+
+    print(f"{'stage':<14} {'cache':<6} {'median ms':>10} {'min ms':>8}")
+    for row in rows:
+        print(f"{row['stage']:<14} {row['formats_cache']:<6} {row['median_ms']:>10} {row['min_ms']:>8}")
+    print(f"Pillow plugins loaded at import: {rows[0]['plugins_at_import']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""Convert a directory tree of images offline, with the same code /upload uses.
+
+Files are converted in batches on the conversion process pool. Every
+finished file is appended to a manifest, so an interrupted run picks up
+where it stopped when started again with the same arguments.
+
+    python bulk_convert.py photos/ --format webp --output-dir converted/
+    python bulk_convert.py photos/ --format jpg --session --hours 72
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import argparse
+from PIL import Image, ImageColor
+from converter import (ConversionEngine, pillow_format, output_name, ENCODER_PRESETS, DEFAULT_PRESET, DEFAULT_BACKGROUND,
+                       MAX_FRAMES, MAX_FRAME_PIXELS)
+from session_store import SessionStore, default_db_path
+
+MANIFEST_NAME = '.bulk-manifest.jsonl'
+# pillow_heif opens these, Pillow doesn't register them
+HEIF_EXTENSIONS = {'.heic', '.heif', '.hif'}
+
+
+def print_colored(message, color_code):
+    """Print message with color."""
+    print(f"\033[{color_code}m{message}\033[0m")
+
+
+def input_extensions():
+    """Extensions of every format Pillow or pillow_heif can open"""
+    Image.init()
+    extensions = {ext for ext, format_name in Image.registered_extensions().items() if format_name in Image.OPEN}
+    return (extensions | HEIF_EXTENSIONS) - {'.eps', '.ps'}
+
+
+def walk_inputs(source_dir, extensions):
+    """Yield (relative path, absolute path) of the images under source_dir, in a stable order"""
+    for root, dirs, files in os.walk(source_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(files):
+            if name.startswith('.') or os.path.splitext(name)[1].lower() not in extensions:
+                continue
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, source_dir), path
+
+
+class Manifest:
+    """Append-only JSON lines file of the files a run has finished.
+
+    A file counts as done if it converted and has the same size and
+    modification time as when it did; failed files are tried again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        self.session_id = None
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Cut short by an interrupted run
+                        continue
+                    if 'session_id' in entry:
+                        self.session_id = entry['session_id']
+                    elif entry.get('status') == 'converted':
+                        self.done[entry['input']] = entry
+                    else:
+                        self.done.pop(entry['input'], None)
+        self._file = open(path, 'a')
+
+    def is_done(self, relative_path, stat):
+        entry = self.done.get(relative_path)
+        return entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns
+
+    def append(self, entry):
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def throughput_report(totals, seconds):
+    """Summary of a run: counts, rates and the time spent per conversion stage"""
+    seconds = max(seconds, 1e-9)
+    return {
+        'converted': totals['converted'],
+        'failed': totals['failed'],
+        'skipped': totals['skipped'],
+        'seconds': round(seconds, 2),
+        'files_per_second': round(totals['converted'] / seconds, 2),
+        'input_mb_per_second': round(totals['input_bytes'] / 2**20 / seconds, 2),
+        'output_mb_per_second': round(totals['output_bytes'] / 2**20 / seconds, 2),
+        'megapixels_per_second': round(totals['pixels'] / 1_000_000 / seconds, 2),
+        'input_bytes': totals['input_bytes'],
+        'output_bytes': totals['output_bytes'],
+        'stage_seconds': {stage: round(value, 2) for stage, value in sorted(totals['stages'].items())},
+    }
+
+
+def positive_int(value):
+    """argparse type for pixel sizes: a whole number greater than 0"""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}")
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be greater than 0, got {number}")
+    return number
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a directory tree of images offline')
+    parser.add_argument('source', help='Directory to convert, searched recursively')
+    parser.add_argument('--format', required=True, help='Output format, e.g. webp, jpg, png')
+    parser.add_argument('--preset', default=DEFAULT_PRESET, choices=sorted(ENCODER_PRESETS),
+                        help=f'Encoder preset (default: {DEFAULT_PRESET})')
+    parser.add_argument('--background', default=os.environ.get('JPEG_BACKGROUND', DEFAULT_BACKGROUND),
+                        help=f'Color transparent images are flattened onto for JPEG '
+                             f'(default: $JPEG_BACKGROUND or {DEFAULT_BACKGROUND})')
+    parser.add_argument('--max-width', type=positive_int, help='Scale down to at most this many pixels wide')
+    parser.add_argument('--max-height', type=positive_int, help='Scale down to at most this many pixels high')
+    parser.add_argument('--scale', type=float, help='Scale down by this factor (greater than 0, at most 1)')
+    parser.add_argument('--output-dir', help='Where to write the converted tree (not with --session)')
+    parser.add_argument('--session', action='store_true',
+                        help='Register the outputs as a session so they can be shared and downloaded')
+    parser.add_argument('--hours', type=float, default=24,
+                        help='Lifetime of the session from the start of the run (default: 24)')
+    parser.add_argument('--data-path', default='/mnt/fastlane/docker/image-convert',
+                        help='Base path for Image Converter data, used with --session')
+    parser.add_argument('--external-url', default=os.environ.get('EXTERNAL_URL', 'http://localhost:5000'),
+                        help='Base URL printed for the session (default: $EXTERNAL_URL)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Conversion processes (default: number of CPUs)')
+    parser.add_argument('--batch-size', type=int,
+                        help='Files queued at a time; progress is printed after each batch (default: 16 per worker)')
+    parser.add_argument('--timeout', type=int, default=int(os.environ.get('CONVERSION_TIMEOUT', '90')),
+                        help='Seconds a single file may take (default: $CONVERSION_TIMEOUT or 90)')
+    parser.add_argument('--max-frames', type=int, default=int(os.environ.get('MAX_FRAMES', str(MAX_FRAMES))),
+                        help='Frames an animation may have, 0 for no limit')
+    parser.add_argument('--max-frame-pixels', type=int,
+                        default=int(os.environ.get('MAX_FRAME_PIXELS', str(MAX_FRAME_PIXELS))),
+                        help='Pixels all frames of an animation may have together, 0 for no limit')
+    parser.add_argument('--manifest', help=f'Manifest file (default: {MANIFEST_NAME} in the output directory, '
+                                           'or one per source and format under image_data/bulk with --session)')
+    parser.add_argument('--json', action='store_true', help='Print the throughput report as JSON')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.source):
+        print(f"Error: {args.source} is not a directory")
+        return 1
+    if args.session == bool(args.output_dir):
+        print("Error: give either --output-dir or --session")
+        return 1
+    output_format = args.format.upper()
+    Image.init()
+    if pillow_format(output_format) not in Image.SAVE:
+        print(f"Error: unsupported output format {args.format}")
+        return 1
+    if args.scale is not None and not 0 < args.scale <= 1:
+        print("Error: --scale must be greater than 0 and at most 1")
+        return 1
+
+    try:
+        background = '#%02x%02x%02x' % ImageColor.getrgb(args.background.strip())[:3]
+    except ValueError:
+        print(f"Error: invalid background color {args.background}")
+        return 1
+
+    # The same options /upload passes
+    options = {'preset': args.preset, 'background': background}
+    for name in ('max_width', 'max_height', 'scale'):
+        if getattr(args, name):
+            options[name] = getattr(args, name)
+
+    store = session_id = None
+    if args.session:
+        # Same layout the app and the other scripts use
+        session_file = os.path.join(args.data_path, 'image_data', 'sessions.json')
+        output_root = os.path.join(args.data_path, 'image_outputs')
+        try:
+            store = SessionStore(default_db_path(session_file))
+        except sqlite3.DatabaseError as e:
+            print(f"Error: could not open the sessions database: {str(e)}")
+            return 1
+        # Keyed by what is converted, so the same command resumes the same session
+        run_key = hashlib.sha256(json.dumps([os.path.abspath(args.source), output_format, options],
+                                            sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        manifest_path = args.manifest or os.path.join(args.data_path, 'image_data', 'bulk', f"{run_key}.jsonl")
+    else:
+        output_dir = os.path.abspath(args.output_dir)
+        manifest_path = args.manifest or os.path.join(output_dir, MANIFEST_NAME)
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    manifest = Manifest(manifest_path)
+
+    if args.session:
+        # A resumed run adds to the session it started
+        session_id = manifest.session_id
+        if session_id is not None and session_id not in store:
+            print(f"Error: session {session_id} from {manifest_path} has expired; "
+                  f"remove the manifest to start a new session")
+            return 1
+        if session_id is None:
+            session_id = str(uuid.uuid4())
+            store.create(session_id, time.time() + args.hours * 3600)
+            manifest.append({'session_id': session_id})
+        output_dir = os.path.join(output_root, session_id)
+    os.makedirs(output_dir, exist_ok=True)
+
+    engine = ConversionEngine(
+        max_workers=args.workers,
+        task_timeout=args.timeout,
+        frame_limits={'max_frames': args.max_frames, 'max_frame_pixels': args.max_frame_pixels}
+    )
+    batch_size = args.batch_size or engine.max_workers * 16
+    totals = {'converted': 0, 'failed': 0, 'skipped': 0, 'input_bytes': 0, 'output_bytes': 0,
+              'pixels': 0, 'stages': {}}
+    taken = set()
+    started = time.perf_counter()
+
+    def run_batch(tasks):
+        files = []
+
+        def on_result(index, result, error):
+            task = tasks[index]
+            entry = {'input': task['relative_path'], 'size': task['size'], 'mtime_ns': task['mtime_ns'],
+                     'output': task['output_filename']}
+            if error is not None:
+                totals['failed'] += 1
+                entry.update(status='failed', error=error)
+                print_colored(f"✗ {task['relative_path']}: {error}", "91")
+            else:
+                totals['converted'] += 1
+                totals['input_bytes'] += task['size']
+                totals['output_bytes'] += os.path.getsize(task['output_path'])
+                width, height = result['original_size']
+                totals['pixels'] += width * height * result.get('frames', 1)
+                for stage, seconds in result['timings'].items():
+                    totals['stages'][stage] = totals['stages'].get(stage, 0.0) + seconds
+                entry.update(status='converted', seconds=round(sum(result['timings'].values()), 3))
+                files.append({'original_filename': task['relative_path'],
+                              'converted_filename': task['output_filename'],
+                              'conversion_time': time.time()})
+            manifest.append(entry)
+
+        engine.convert_batch(tasks, on_result=on_result)
+        if store is not None and files:
+            store.add_files(session_id, files)
+        elapsed = time.perf_counter() - started
+        print(f"{totals['converted']} converted, {totals['failed']} failed, {totals['skipped']} skipped "
+              f"({totals['converted'] / elapsed:.1f} files/s)")
+
+    try:
+        tasks = []
+        for relative_path, path in walk_inputs(args.source, input_extensions()):
+            name = output_name(relative_path, output_format, args.session, taken)
+            stat = os.stat(path)
+            if manifest.is_done(relative_path, stat) and os.path.exists(os.path.join(output_dir, name)):
+                totals['skipped'] += 1
+                continue
+            output_path = os.path.join(output_dir, name)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            tasks.append({
+                'relative_path': relative_path,
+                'input_path': path,
+                'output_path': output_path,
+                'output_filename': name,
+                'output_format': output_format,
+                'filename': os.path.basename(path),
+                # Same place the app keeps previews, so the session pages need no second decode
+                'preview_path': os.path.join(output_dir, '.previews', f"{name}.webp") if args.session else None,
+                'options': dict(options),
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+            })
+            if len(tasks) >= batch_size:
+                run_batch(tasks)
+                tasks = []
+        if tasks:
+            run_batch(tasks)
+    except KeyboardInterrupt:
+        print("\nInterrupted; run the same command again to resume")
+        return 130
+    finally:
+        engine.shutdown()
+        manifest.close()
+
+    report = throughput_report(totals, time.perf_counter() - started)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"\nConverted {report['converted']} files in {report['seconds']} s, "
+              f"{report['failed']} failed, {report['skipped']} already done")
+        print(f"  {report['files_per_second']} files/s, {report['megapixels_per_second']} megapixels/s, "
+              f"{report['input_mb_per_second']} MB/s in, {report['output_mb_per_second']} MB/s out")
+        if report['stage_seconds']:
+            print("  CPU seconds per stage: " +
+                  ", ".join(f"{stage} {value}" for stage, value in report['stage_seconds'].items()))
+    if session_id is not None:
+        print(f"Session: {args.external_url.rstrip('/')}/session/{session_id}")
+    return 1 if totals['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,8 +2,11 @@
 import os
 import json
 import time
+import sqlite3
 import argparse
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from session_store import SessionStore, default_db_path, parse_legacy_entry
 
 def print_status(message, success=True):
     """Print a status message with color."""
@@ -25,18 +28,204 @@ def check_expiration(timestamp, expiration_time):
     else:
         return f"VALID ({int(remaining/60)} minutes remaining)"
 
+def session_files(files):
+    """The names of scan_directory's files a session lists: hidden ones, like previews and .part files, aren't"""
+    return [name for name in files if not name.startswith('.')]
+
+def scan_directory(path):
+    """Return {relative path: size} of the files under a directory, or None if it doesn't exist.
+
+    One scandir per directory and one stat per file, nothing else: on a
+    network filesystem every call is a round trip.
+    """
+    files = {}
+    stack = [(path, '')]
+    while stack:
+        directory, prefix = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    name = prefix + entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, name + '/'))
+                        else:
+                            files[name] = entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+        except (FileNotFoundError, NotADirectoryError):
+            if directory == path:
+                return None
+        except OSError:
+            continue
+    return files
+
+def scan_outputs(output_dir, workers):
+    """Scan every session directory of the output folder on a thread pool.
+
+    Returns ({session id: files}, {session id: ZIP size}, other bytes),
+    where files is what scan_directory returns and other bytes counts
+    whatever else sits at the top of the folder (the conversion cache
+    excluded).
+    """
+    directories = []
+    archives = {}
+    other_bytes = 0
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry)
+                elif entry.name.endswith('_converted.zip'):
+                    archives[entry.name[:-len('_converted.zip')]] = entry.stat(follow_symlinks=False).st_size
+                else:
+                    other_bytes += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                continue
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        listings = pool.map(scan_directory, [entry.path for entry in directories])
+        sessions = {entry.name: files for entry, files in zip(directories, listings) if files is not None}
+    return sessions, archives, other_bytes
+
+def read_sessions(session_db, session_file):
+    """Return {session id: session} without changing anything on disk.
+
+    The database is opened read-only. A sessions.json the app hasn't
+    migrated yet is read directly, its entries replacing those of the
+    database as the migration would.
+    """
+    sessions = {}
+    migrated = False
+    if os.path.exists(session_db):
+        store = SessionStore(session_db, read_only=True)
+        sessions.update(store.items())
+        migrated = store.get_meta('json_migrated') is not None
+    if not migrated and os.path.exists(session_file):
+        with open(session_file, 'r') as f:
+            for session_id, session_data in json.load(f).items():
+                entry = parse_legacy_entry(session_data)
+                if entry is not None:
+                    sessions[session_id] = {'created_at': entry[0], 'files': entry[1], 'job_id': entry[2]}
+    return sessions
+
+def audit(sessions, upload_dir, output_dir, workers, details=False, now=None):
+    """Compare the sessions read_sessions returns with what is on disk; returns a JSON-ready report.
+
+    Orphans are session directories (or download-all ZIPs) the store does
+    not know about. Missing files are converted files the store lists
+    but the session directory doesn't hold, including every file of a
+    session whose directory is gone.
+    """
+    now = now or time.time()
+    started = time.perf_counter()
+    on_disk, archives, other_bytes = scan_outputs(output_dir, workers)
+    upload_files = scan_directory(upload_dir) or {}
+
+    report = {
+        'generated_at': now,
+        'seconds': None,
+        'sessions': {'total': 0, 'active': 0, 'expired': 0, 'without_directory': 0},
+        'files': {'recorded': 0, 'present': 0, 'missing': 0, 'on_disk': 0},
+        'bytes': {'sessions': 0, 'archives': 0, 'orphans': 0, 'uploads': sum(upload_files.values()), 'other': other_bytes},
+        'uploads': {'files': len(upload_files)},
+        'missing': [],
+        'orphans': [],
+        'expired': []
+    }
+    if details:
+        report['details'] = {}
+
+    for session_id, session_data in sessions.items():
+        # The store keeps the expiry timestamp under 'created_at'
+        expires_at = session_data.get('created_at', 0)
+        files = on_disk.pop(session_id, None)
+        archive_bytes = archives.pop(session_id, 0)
+        recorded = [f.get('converted_filename') for f in session_data.get('files', []) if f.get('converted_filename')]
+        missing = [name for name in recorded if files is None or name not in files]
+        session_bytes = sum(files.values()) if files else 0
+        on_disk_count = len(session_files(files or ()))
+
+        report['sessions']['total'] += 1
+        if expires_at < now:
+            report['sessions']['expired'] += 1
+            report['expired'].append(session_id)
+        else:
+            report['sessions']['active'] += 1
+        if files is None:
+            report['sessions']['without_directory'] += 1
+        report['files']['recorded'] += len(recorded)
+        report['files']['present'] += len(recorded) - len(missing)
+        report['files']['missing'] += len(missing)
+        report['files']['on_disk'] += on_disk_count
+        report['bytes']['sessions'] += session_bytes
+        report['bytes']['archives'] += archive_bytes
+        report['missing'].extend({'session_id': session_id, 'filename': name} for name in missing)
+        if details:
+            report['details'][session_id] = {
+                'expires_at': expires_at,
+                'expired': expires_at < now,
+                'directory': files is not None,
+                'files': len(recorded),
+                'files_on_disk': on_disk_count,
+                'bytes': session_bytes,
+                'archive_bytes': archive_bytes,
+                'missing': missing
+            }
+
+    # Whatever the store didn't claim is orphaned
+    for session_id, files in sorted(on_disk.items()):
+        orphan_bytes = sum(files.values()) + archives.pop(session_id, 0)
+        report['orphans'].append({'session_id': session_id, 'files': len(session_files(files)), 'bytes': orphan_bytes})
+        report['bytes']['orphans'] += orphan_bytes
+    for session_id, archive_bytes in sorted(archives.items()):
+        report['orphans'].append({'session_id': session_id, 'files': 1, 'bytes': archive_bytes, 'archive_only': True})
+        report['bytes']['orphans'] += archive_bytes
+    report['bytes']['total'] = sum(report['bytes'].values())
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    return report
+
+def run_audit(args, session_file, session_db, upload_dir, output_dir):
+    """Print the audit report as JSON; exits 1 if files are missing or directories orphaned"""
+    if not os.path.exists(session_db) and not os.path.exists(session_file):
+        print(json.dumps({'error': f"Sessions database does not exist: {session_db}"}))
+        return 2
+    try:
+        report = audit(read_sessions(session_db, session_file), upload_dir, output_dir, args.workers, details=args.details)
+    except (sqlite3.DatabaseError, ValueError) as e:
+        print(json.dumps({'error': f"Sessions database is corrupted or empty: {str(e)}"}))
+        return 2
+    except OSError as e:
+        print(json.dumps({'error': str(e)}))
+        return 2
+    print(json.dumps(report, indent=2 if args.pretty else None))
+    return 1 if report['missing'] or report['orphans'] else 0
+
 def main():
     parser = argparse.ArgumentParser(description='Check health of Image Converter sessions and files')
     parser.add_argument('--data-path', default='/mnt/fastlane/docker/image-convert', 
                         help='Base path for Image Converter data')
     parser.add_argument('--expiration', type=int, default=3600,
                         help='Session expiration time in seconds (default: 3600)')
+    parser.add_argument('--audit', action='store_true',
+                        help='Print a JSON summary of sessions, files, bytes and orphans instead of the report')
+    parser.add_argument('--details', action='store_true',
+                        help='With --audit, include every session in the summary')
+    parser.add_argument('--workers', type=int, default=16,
+                        help='With --audit, directories scanned in parallel (default: 16)')
+    parser.add_argument('--pretty', action='store_true',
+                        help='With --audit, indent the JSON')
     args = parser.parse_args()
 
     # Set paths
     SESSION_FILE = os.path.join(args.data_path, 'image_data', 'sessions.json')
+    SESSION_DB = default_db_path(SESSION_FILE)
     UPLOAD_DIR = os.path.join(args.data_path, 'image_uploads')
     OUTPUT_DIR = os.path.join(args.data_path, 'image_outputs')
+
+    if args.audit:
+        return run_audit(args, SESSION_FILE, SESSION_DB, UPLOAD_DIR, OUTPUT_DIR)
     
     print("\n===== IMAGE CONVERTER HEALTH CHECK =====\n")
     
@@ -54,13 +243,16 @@ def main():
     
     # Check sessions file
     print("\nChecking sessions...")
-    if os.path.exists(SESSION_FILE):
-        print_status(f"Sessions file exists: {SESSION_FILE}")
+    if os.path.exists(SESSION_DB) or os.path.exists(SESSION_FILE):
         try:
-            with open(SESSION_FILE, 'r') as f:
-                sessions = json.load(f)
+            # Read-only: migrating the legacy file is left to the app
+            sessions = read_sessions(SESSION_DB, SESSION_FILE)
+            if os.path.exists(SESSION_DB):
+                print_status(f"Sessions database exists: {SESSION_DB}")
+            else:
+                print_status(f"Sessions database does NOT exist yet, reading {SESSION_FILE}", False)
             
-            print_status(f"Sessions file loaded successfully. Found {len(sessions)} sessions.")
+            print_status(f"Sessions loaded successfully. Found {len(sessions)} sessions.")
             
             # Check each session
             print("\nSession details:")
@@ -96,14 +288,15 @@ def main():
                             print("(✗ missing)")
                 else:
                     print("  No files in this session")
-        except json.JSONDecodeError:
-            print_status(f"Sessions file is corrupted or empty", False)
+        except (sqlite3.DatabaseError, ValueError):
+            print_status("Sessions database is corrupted or empty", False)
         except Exception as e:
-            print_status(f"Error processing sessions file: {str(e)}", False)
+            print_status(f"Error processing sessions database: {str(e)}", False)
     else:
-        print_status(f"Sessions file does NOT exist: {SESSION_FILE}", False)
+        print_status(f"Sessions database does NOT exist: {SESSION_DB}", False)
     
     print("\n===== HEALTH CHECK COMPLETE =====\n")
+    return 0
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    exit(main()) 
\ No newline at end of file
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+
+# Bump when the conversion code changes in a way that alters its output
+CACHE_VERSION = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def link_or_copy(source, destination):
+    """Hardlink source to destination, copying when linking isn't possible"""
+    temp_path = os.path.join(os.path.dirname(destination), f".{uuid.uuid4().hex}.part")
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        shutil.copyfile(source, temp_path)
+    os.replace(temp_path, destination)
+
+
+class ConversionCache:
+    """Converted outputs keyed by input content hash, target format and options.
+
+    Outputs are stored as hardlinks, so a hit costs one link() into the new
+    session directory instead of a decode and re-encode. The index lives in
+    SQLite next to the cached files, so all workers share the LRU order,
+    the byte total and the hit/miss counters.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._connect().executescript(SCHEMA)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _connect(self):
+        # One connection per thread, reopened after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(os.path.join(self.cache_dir, 'index.db'), timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _count(self, conn, name, amount=1):
+        conn.execute(
+            'INSERT INTO counters (name, value) VALUES (?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET value = value + excluded.value',
+            (name, amount)
+        )
+
+    @staticmethod
+    def make_key(content_hash, output_format, options=None):
+        options_json = json.dumps(options or {}, sort_keys=True)
+        raw = f"{CACHE_VERSION}:{content_hash}:{output_format.upper()}:{options_json}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def materialize(self, key, output_path):
+        """Place a cached output at output_path; returns False on a miss"""
+        if not self.enabled:
+            return False
+        try:
+            link_or_copy(self._path(key), output_path)
+        except OSError:
+            with self._transaction() as conn:
+                # The file may have been evicted by another worker
+                conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self._count(conn, 'misses')
+            return False
+        with self._transaction() as conn:
+            conn.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+            self._count(conn, 'hits')
+        return True
+
+    def store(self, key, output_path):
+        """Add a freshly converted output to the cache and evict down to the budget"""
+        if not self.enabled:
+            return
+        size = os.path.getsize(output_path)
+        if size > self.max_bytes:
+            return
+        cache_path = self._path(key)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        link_or_copy(output_path, cache_path)
+
+        evicted = []
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO entries (key, size, last_used) VALUES (?, ?, ?)',
+                (key, size, time.time())
+            )
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            # Least recently used first, through the last_used index
+            while total > self.max_bytes:
+                oldest = conn.execute(
+                    'SELECT key, size FROM entries WHERE key != ? ORDER BY last_used LIMIT 64', (key,)
+                ).fetchall()
+                if not oldest:
+                    break
+                for old_key, old_size in oldest:
+                    if total <= self.max_bytes:
+                        break
+                    conn.execute('DELETE FROM entries WHERE key = ?', (old_key,))
+                    evicted.append(old_key)
+                    total -= old_size
+            if evicted:
+                self._count(conn, 'evictions', len(evicted))
+
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+    def stats(self):
+        conn = self._connect()
+        counters = dict(conn.execute('SELECT name, value FROM counters').fetchall())
+        entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {
+            'enabled': self.enabled,
+            'hits': counters.get('hits', 0),
+            'misses': counters.get('misses', 0),
+            'evictions': counters.get('evictions', 0),
+            'entries': entries,
+            'bytes': size,
+            'max_bytes': self.max_bytes
+        }
@@ -0,0 +1,872 @@
+import os
+import time
+import threading
+import weakref
+import itertools
+import cProfile
+import multiprocessing
+from concurrent.futures import Future, InvalidStateError, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, ImageColor, ImageMode
+import pillow_heif
+from profiler import save_profile
+
+# Lets Pillow save HEIF/HEIC output
+pillow_heif.register_heif_opener()
+
+
+# ISO base media brands of HEIF still images and sequences. AVIF shares the
+# container (and the generic mif1/msf1 brands) but is left to Pillow.
+HEIF_BRANDS = {b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'hevm', b'hevs', b'mif1', b'msf1'}
+AVIF_BRANDS = {b'avif', b'avis'}
+
+
+def is_heif(path):
+    """Detect a HEIF container from the brands of its ftyp box, whatever the file is called"""
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(64)
+    except OSError:
+        return False
+    if len(header) < 12 or header[4:8] != b'ftyp':
+        return False
+    box_size = int.from_bytes(header[:4], 'big')
+    # Major brand, then the compatible brands after the minor version
+    brands = {header[8:12]}
+    brands.update(header[i:i + 4] for i in range(16, min(box_size, len(header)) - 3, 4))
+    return not brands & AVIF_BRANDS and bool(brands & HEIF_BRANDS)
+
+
+def open_heif_image(input_path):
+    """Decode only the primary image of a HEIF container into a Pillow image.
+
+    open_heif() just parses the container, so other top-level images of a
+    multi-image file, depth maps and thumbnails are never decoded. The
+    decoded buffer keeps libheif's stride and is handed to Pillow directly,
+    where read_heif() + frombytes() decoded every image and copied each one
+    to strip the row padding first.
+    """
+    heif_file = pillow_heif.open_heif(input_path, convert_hdr_to_8bit=True, remove_stride=False)
+    heif_image = heif_file[heif_file.primary_index]
+    skipped = {
+        'other images': len(heif_file) - 1,
+        'depth images': len(heif_image.info.get('depth_images') or []),
+        'thumbnails': len(heif_image.info.get('thumbnails') or []),
+    }
+    if any(skipped.values()):
+        print("[DEBUG] Converting primary HEIF image only, skipping " +
+              ", ".join(f"{count} {kind}" for kind, count in skipped.items() if count))
+    # Shares the buffer for RGBA/L, a single row-wise copy for RGB
+    return Image.frombuffer(heif_image.mode, heif_image.size, heif_image.data,
+                            'raw', heif_image.mode, heif_image.stride, 1)
+
+
+def pixel_bytes(mode):
+    """Bytes per pixel Pillow uses in memory for an image mode"""
+    mode_info = ImageMode.getmode(mode)
+    if len(mode_info.bands) > 1:
+        # Multi-band 8-bit images are stored with 4 bytes per pixel
+        return 4
+    return int(mode_info.typestr[-1])
+
+
+def estimate_memory(input_path, output_format=None):
+    """Estimate the peak memory of converting a file from its header alone.
+
+    Pillow's open() and open_heif() only parse the header, so this is cheap
+    even for files that decode to gigabytes. The estimate covers the decoded
+    image plus one converted copy of it (convert() and the mode changes
+    before saving), and for HEIF also libheif's own decode buffer. Frames of
+    an animation are converted one at a time, except for the output formats
+    whose writers keep every frame until the end. Returns (width, height,
+    bytes); raises if the file isn't a readable image.
+    """
+    if is_heif(input_path):
+        heif_file = pillow_heif.open_heif(input_path, convert_hdr_to_8bit=True)
+        heif_image = heif_file[heif_file.primary_index]
+        width, height = heif_image.size
+        decoded = width * height * (len(heif_image.mode) + pixel_bytes(heif_image.mode))
+    else:
+        with Image.open(input_path) as image:
+            width, height = image.size
+            decoded = width * height * pixel_bytes(image.mode)
+            frames = getattr(image, 'n_frames', 1)
+            if frames > 1 and output_format and pillow_format(output_format) in BUFFERED_FRAME_FORMATS:
+                decoded += width * height * 4 * frames
+    return width, height, decoded + width * height * 4
+
+
+# Longest edges of the gallery/share previews
+PREVIEW_SIZE = (640, 640)
+
+
+def save_preview(image, preview_path, size=PREVIEW_SIZE):
+    """Write a small WebP preview of an already decoded image"""
+    preview = image
+    if preview.mode not in ('RGB', 'RGBA'):
+        has_alpha = 'A' in preview.mode or 'transparency' in preview.info
+        preview = preview.convert('RGBA' if has_alpha else 'RGB')
+    scale = min(size[0] / preview.width, size[1] / preview.height)
+    if scale < 1:
+        preview_size = (max(1, round(preview.width * scale)), max(1, round(preview.height * scale)))
+        # reducing_gap shrinks by an integer factor with reduce() first, then resamples the rest
+        preview = preview.resize(preview_size, Image.BICUBIC, reducing_gap=2.0)
+
+    preview_dir, preview_name = os.path.split(preview_path)
+    os.makedirs(preview_dir, exist_ok=True)
+    part_path = os.path.join(preview_dir, f".{preview_name}.part")
+    try:
+        preview.save(part_path, 'WEBP', quality=80, method=0)
+        os.replace(part_path, preview_path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+
+def create_preview(source_path, preview_path, size=PREVIEW_SIZE):
+    """Build a preview from a converted file, for outputs that were not converted here"""
+    if is_heif(source_path):
+        save_preview(open_heif_image(source_path), preview_path, size)
+        return
+    with Image.open(source_path) as image:
+        # JPEG decodes straight at 1/2, 1/4 or 1/8 scale; other formats ignore this
+        image.draft('RGB', size)
+        save_preview(image, preview_path, size)
+
+
+# Encoder options per preset and Pillow format, trading CPU time for output
+# bytes. Quality settings are the same in every preset, so a preset only
+# changes how hard the encoder works. See the README for measurements.
+ENCODER_PRESETS = {
+    'fast': {
+        'JPEG': {'subsampling': 2, 'optimize': False, 'progressive': False},
+        'PNG': {'compress_level': 1},
+        'WEBP': {'method': 0},
+        'TIFF': {'compression': 'raw'},
+        'HEIF': {'enc_params': {'preset': 'ultrafast'}},
+    },
+    'balanced': {
+        'JPEG': {'subsampling': 2, 'optimize': True, 'progressive': False},
+        'PNG': {'compress_level': 6},
+        'WEBP': {'method': 4},
+        'TIFF': {'compression': 'tiff_lzw'},
+        'HEIF': {'enc_params': {'preset': 'superfast'}},
+    },
+    'smallest': {
+        'JPEG': {'subsampling': 2, 'optimize': True, 'progressive': True},
+        'PNG': {'compress_level': 9},
+        'WEBP': {'method': 6},
+        'TIFF': {'compression': 'tiff_adobe_deflate'},
+        # Slower x265 presets produced larger files at the same quality
+        'HEIF': {'enc_params': {'preset': 'superfast'}},
+    },
+}
+DEFAULT_PRESET = 'balanced'
+
+
+def pillow_format(output_format):
+    """Map a requested output format or extension (JPG, TIF, HEIC...) to Pillow's format name"""
+    extension = f".{output_format.lower()}"
+    # The common formats are known after preinit(), only load every plugin for the others
+    Image.preinit()
+    if extension not in Image.EXTENSION:
+        Image.init()
+    return Image.EXTENSION.get(extension, output_format.upper())
+
+
+def output_name(relative_path, output_format, flatten, taken):
+    """Output path relative to the output directory for an input.
+
+    The directory tree is kept, or flattened into the file name for a
+    session (sessions hold a flat list of files). Inputs that would land on
+    the same output, like IMG_1.jpg and IMG_1.heic, keep their extension,
+    and after that get a number. taken holds the names given out so far
+    and is updated.
+    """
+    stem, _ = os.path.splitext(relative_path)
+    extension = output_format.lower()
+    candidates = itertools.chain((f"{stem}.{extension}", f"{relative_path}.{extension}"),
+                                 (f"{stem}-{number}.{extension}" for number in itertools.count(2)))
+    for name in candidates:
+        if flatten:
+            name = name.replace(os.sep, '_')
+        if name not in taken:
+            break
+    taken.add(name)
+    return name
+
+
+def encoder_options(output_format, preset=None):
+    """Return (Pillow format, save() keyword arguments) for an output format and preset"""
+    format_name = pillow_format(output_format)
+    presets = ENCODER_PRESETS[preset or DEFAULT_PRESET]
+    return format_name, dict(presets.get(format_name, {}))
+
+
+def resize_target(size, max_width=None, max_height=None, scale=None):
+    """Return the downscaled size for the resize options, or None to keep the original size"""
+    width, height = size
+    factor = scale or 1.0
+    if max_width:
+        factor = min(factor, max_width / width)
+    if max_height:
+        factor = min(factor, max_height / height)
+    if factor >= 1:
+        # Never upscale
+        return None
+    return (max(1, round(width * factor)), max(1, round(height * factor)))
+
+
+def shrink_image(image, size):
+    """Downscale to size, doing the bulk of the reduction with a cheap integer reduce()"""
+    if image.mode in ('1', 'P'):
+        # Resizing these modes can only pick nearest pixels
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    if min(image.width / size[0], image.height / size[1]) >= 2:
+        # Still at full size (only JPEG decodes at a reduced scale): reduce()
+        # by the whole factor and finish with a light bilinear pass, or the
+        # resize would cost more than encoding the full image saves
+        return image.resize(size, Image.BILINEAR, reducing_gap=1.0)
+    return image.resize(size, Image.BICUBIC)
+
+
+# Color transparent images are flattened onto for JPEG output
+DEFAULT_BACKGROUND = '#ffffff'
+
+
+def flatten_palette(image, background):
+    """Flatten a transparent palette image by compositing its palette, then converting once"""
+    if image.palette.mode == 'RGBA':
+        entries = image.getpalette('RGBA')
+        colors = [entries[i:i + 3] for i in range(0, len(entries), 4)]
+        alphas = entries[3::4]
+    else:
+        entries = image.getpalette('RGB')
+        colors = [entries[i:i + 3] for i in range(0, len(entries), 3)]
+        alphas = [255] * len(colors)
+    transparency = image.info.get('transparency')
+    if isinstance(transparency, int) and transparency < len(alphas):
+        alphas[transparency] = 0
+    elif isinstance(transparency, bytes):
+        # Per-entry alpha, as PNG's tRNS chunk stores it
+        for index, alpha in enumerate(transparency[:len(alphas)]):
+            alphas[index] = min(alphas[index], alpha)
+    palette = [(value * alpha + back * (255 - alpha) + 127) // 255
+               for color, alpha in zip(colors, alphas) for value, back in zip(color, background)]
+    flattened = image.copy()
+    flattened.info.pop('transparency', None)
+    flattened.putpalette(palette)
+    return flattened.convert('RGB')
+
+
+def flatten_alpha(image, background=DEFAULT_BACKGROUND):
+    """Composite an image onto a solid background color and return it as RGB.
+
+    convert('RGB') just drops the alpha band, which leaves transparent
+    pixels whatever color they happen to store (often black). Alpha bands
+    are applied with a masked paste onto the background instead, a single
+    pass in C. Transparent palette images only need their (at most 256)
+    palette entries composited, so they never go through RGBA.
+    """
+    background = ImageColor.getrgb(background)[:3]
+    if image.mode == 'P' and ('transparency' in image.info or image.palette.mode == 'RGBA'):
+        return flatten_palette(image, background)
+    if image.mode in ('RGBA', 'LA', 'PA'):
+        if image.mode == 'PA':
+            image = image.convert('RGBA')
+        flattened = Image.new('RGB', image.size, background)
+        # paste() reads RGBA and LA pixels directly, without converting them
+        flattened.paste(image, mask=image.getchannel('A'))
+        return flattened
+    return image.convert('RGB')
+
+
+def prepare_for_format(image, format_name, background=DEFAULT_BACKGROUND):
+    """Convert the image mode where the output format needs it"""
+    # JPEG has no alpha, flatten transparent images onto the background
+    if format_name == 'JPEG' and image.mode != 'RGB':
+        image = flatten_alpha(image, background)
+
+    # Handle transparency for PNG
+    if format_name == 'PNG' and image.mode not in ['RGBA', 'RGB']:
+        image = image.convert('RGBA')
+
+    # The HEIF encoder only takes RGB(A)
+    if format_name == 'HEIF' and image.mode not in ['RGBA', 'RGB']:
+        has_alpha = 'A' in image.mode or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    return image
+
+
+# Output formats whose writers take every frame of an animation or multi-page image
+MULTI_FRAME_FORMATS = {'GIF', 'PDF', 'PNG', 'TIFF', 'WEBP'}
+# Of those, the writers that keep a copy of every frame to diff them against
+BUFFERED_FRAME_FORMATS = {'GIF', 'PNG'}
+# Output formats that store palette images as they are
+PALETTE_FORMATS = {'GIF', 'TIFF'}
+# Limits on what a single multi-frame file may make a worker decode
+MAX_FRAMES = 1000
+MAX_FRAME_PIXELS = 500_000_000
+
+
+class PaletteCache:
+    """Maps frames back onto the palettes an animation shares.
+
+    Pillow decodes every GIF frame after the first to RGB(A), even when they
+    all use the global color table. Writing them to a palette format would
+    quantize each frame again: slow, and with a palette of its own per
+    frame. A frame whose colors all come from a palette seen on an earlier
+    frame is mapped onto that palette instead, which is an exact lookup.
+    """
+
+    def __init__(self):
+        # Palette bytes -> (palette image, its colors, transparent index)
+        self._palettes = {}
+
+    def apply(self, image):
+        """Remember the palette of a P frame, or map an RGB(A) frame onto a remembered one"""
+        if image.mode == 'P':
+            self.remember(image)
+            return image
+        return self.to_palette(image) or image
+
+    def remember(self, image):
+        palette = image.getpalette()
+        transparency = image.info.get('transparency')
+        if not isinstance(transparency, int):
+            transparency = None
+        key = (bytes(palette), transparency)
+        if key not in self._palettes:
+            palette_image = Image.new('P', (1, 1))
+            palette_image.putpalette(palette)
+            colors = {tuple(palette[i:i + 3]) for i in range(0, len(palette), 3)
+                      if i // 3 != transparency}
+            self._palettes[key] = (palette_image, colors, transparency)
+
+    def to_palette(self, image):
+        """Return image in mode P on a cached palette, or None if none has all its colors"""
+        if not self._palettes or image.mode not in ('RGB', 'RGBA'):
+            return None
+        # More colors than a palette holds means the frame can't be on one
+        colors = image.getcolors(257)
+        if colors is None:
+            return None
+        if image.mode == 'RGBA':
+            if any(color[3] not in (0, 255) for _, color in colors):
+                return None
+            transparent = any(color[3] == 0 for _, color in colors)
+            opaque = {color[:3] for _, color in colors if color[3] == 255}
+        else:
+            transparent = False
+            opaque = {color for _, color in colors}
+
+        for palette_image, palette_colors, transparency in self._palettes.values():
+            if not opaque <= palette_colors or (transparent and transparency is None):
+                continue
+            transparent_color = tuple(palette_image.getpalette()[transparency * 3:transparency * 3 + 3]) \
+                if transparency is not None else None
+            if transparent_color in opaque:
+                # Opaque pixels of that color could be mapped to the transparent index
+                continue
+            mapped = image.convert('RGB').quantize(palette=palette_image, dither=Image.Dither.NONE)
+            if transparent:
+                mapped.paste(transparency, mask=image.getchannel('A').point(lambda alpha: 255 - alpha))
+            if transparency is not None:
+                mapped.info['transparency'] = transparency
+            return mapped
+        return None
+
+
+class FrameSequence(Image.Image):
+    """The frames of a multi-frame image, decoded and transformed one at a time.
+
+    Pillow's save_all writers walk a multi-frame image with seek(), so
+    handing them this keeps a single source frame and its transformed copy
+    in memory instead of a list of every frame. steps are (stage, function)
+    pairs applied to each frame in turn; the time spent decoding and in
+    each step is added up in timings.
+    """
+
+    def __init__(self, source, steps):
+        super().__init__()
+        self._source = source
+        self._steps = steps
+        self._frame = None
+        self.n_frames = source.n_frames
+        self.is_animated = True
+        self.timings = {'decode': 0.0}
+        self.timings.update((stage, 0.0) for stage, _ in steps)
+        self.seek(0)
+
+    def tell(self):
+        return self._frame
+
+    def seek(self, frame):
+        if not 0 <= frame < self.n_frames:
+            raise EOFError("no more frames")
+        if frame == self._frame:
+            return
+        started = time.perf_counter()
+        self._source.seek(frame)
+        self._source.load()
+        elapsed, started = lap(started)
+        self.timings['decode'] += elapsed
+        image = self._source
+        for stage, step in self._steps:
+            image = step(image)
+            elapsed, started = lap(started)
+            self.timings[stage] += elapsed
+        if image is self._source:
+            # The source decodes the next frame into the same buffer
+            image = image.copy()
+        self.im = image.im
+        if isinstance(getattr(Image.Image, 'mode', None), property):
+            # Pillow 10.1+ keeps mode in _mode behind a read-only property
+            self._mode = image.mode
+        else:
+            self.mode = image.mode
+        self._size = image.size
+        self.palette = image.palette
+        self.info = image.info
+        self._frame = frame
+
+
+def frame_durations(image):
+    """Display time of every frame, which the WebP writer needs up front"""
+    durations = []
+    for frame in range(image.n_frames):
+        image.seek(frame)
+        # Animated WebP only knows a frame's duration once it is decoded
+        image.load()
+        durations.append(image.info.get('duration', 0))
+    image.seek(0)
+    return durations
+
+
+def frame_steps(format_name, target_size=None):
+    """The (stage, function) pairs that turn a decoded frame into one the writer takes"""
+    steps = []
+    if target_size:
+        steps.append(('resize', lambda frame: shrink_image(frame, target_size)))
+    if format_name in PALETTE_FORMATS:
+        palettes = PaletteCache()
+        steps.append(('convert', lambda frame: prepare_for_format(palettes.apply(frame), format_name)))
+    else:
+        steps.append(('convert', lambda frame: prepare_for_format(frame, format_name)))
+    return steps
+
+
+def check_frame_limits(image, limits=None):
+    """Refuse multi-frame images with more frames or total pixels than a worker should decode"""
+    limits = limits or {}
+    max_frames = limits.get('max_frames', MAX_FRAMES)
+    max_pixels = limits.get('max_frame_pixels', MAX_FRAME_PIXELS)
+    frames = image.n_frames
+    pixels = frames * image.width * image.height
+    if max_frames and frames > max_frames:
+        raise Exception(f"Image too large to convert: {frames} frames, the limit is {max_frames}")
+    if max_pixels and pixels > max_pixels:
+        raise Exception(f"Image too large to convert: {frames} frames of {image.width}x{image.height} "
+                        f"are {pixels:,} pixels, the limit is {max_pixels:,}")
+
+
+def lap(started):
+    """Return the seconds since started and the new start time"""
+    now = time.perf_counter()
+    return now - started, now
+
+
+def convert_image(input_path, output_path, output_format, filename=None, preview_path=None, options=None,
+                  limits=None):
+    """Decode, convert and save a single image (runs inside a pool worker).
+
+    options may hold max_width, max_height and scale to downscale the image
+    on the way, the name of an encoder preset and the background color
+    transparent images are flattened onto for JPEG. With a preview_path a small preview is written from the
+    decoded image as well, so previews never need a second decode.
+
+    Animated GIF/WebP/PNG and multi-page TIFF keep all their frames when the
+    output format can hold them; the frames are decoded, converted and
+    encoded one at a time. limits may hold max_frames and max_frame_pixels
+    to override MAX_FRAMES and MAX_FRAME_PIXELS. Other output formats get
+    the first frame.
+
+    Returns the original and output sizes, the detected input format, the
+    number of frames and the seconds spent in each stage (decode, resize,
+    convert, encode, preview).
+    """
+    filename = filename or os.path.basename(input_path)
+    options = options or {}
+    timings = {}
+    started = time.perf_counter()
+
+    # Handle HEIC/HEIF files, recognized by content rather than extension
+    if is_heif(input_path):
+        try:
+            image = open_heif_image(input_path)
+            original_size = image.size
+            input_format = 'HEIF'
+            print(f"[DEBUG] HEIC image original size: {original_size}")
+        except Exception as e:
+            raise Exception(f"Failed to read HEIC file: {str(e)}")
+    else:
+        # Use regular PIL for other formats
+        try:
+            image = Image.open(input_path)
+            original_size = image.size
+            input_format = image.format
+            print(f"[DEBUG] Original image size: {original_size}")
+        except Exception as e:
+            raise Exception(f"Failed to open image file: {str(e)}")
+
+    target_size = resize_target(original_size, options.get('max_width'), options.get('max_height'),
+                                options.get('scale'))
+    format_name, save_options = encoder_options(output_format, options.get('preset'))
+    frames = getattr(image, 'n_frames', 1) if format_name in MULTI_FRAME_FORMATS else 1
+
+    if frames > 1:
+        check_frame_limits(image, limits)
+        print(f"[DEBUG] Converting all {frames} frames")
+        save_options['save_all'] = True
+        if 'loop' in image.info:
+            save_options['loop'] = image.info['loop']
+        if format_name == 'GIF' and ('A' in image.mode or 'transparency' in image.info):
+            # Frames come composited onto the whole canvas; clear each one
+            # first so its transparent pixels don't show the frame before
+            save_options['disposal'] = 2
+        try:
+            if format_name == 'WEBP':
+                save_options['duration'] = frame_durations(image)
+            image = FrameSequence(image, frame_steps(format_name, target_size))
+        except Exception as e:
+            raise Exception(f"Failed to decode image file: {str(e)}")
+        # Frames are decoded and converted while the writer encodes them. The
+        # sequence times that, and all of it counts against the save below
+        opened, started = lap(started)
+        frame_seconds = sum(image.timings.values())
+        timings['decode'] = opened - frame_seconds
+    else:
+        if target_size:
+            # JPEG decodes at 1/2, 1/4 or 1/8 scale if that still covers the target,
+            # other formats ignore the draft and are decoded in full
+            image.draft(image.mode, target_size)
+        try:
+            image.load()
+        except Exception as e:
+            raise Exception(f"Failed to decode image file: {str(e)}")
+        timings['decode'], started = lap(started)
+
+        if target_size:
+            image = shrink_image(image, target_size)
+            timings['resize'], started = lap(started)
+
+        image = prepare_for_format(image, format_name, options.get('background', DEFAULT_BACKGROUND))
+        timings['convert'], started = lap(started)
+
+    if target_size:
+        print(f"[DEBUG] Resized from {original_size} to {image.size}")
+
+    # Save the image with specified format.
+    # Write to a .part file first so session listings never see partial output
+    output_dir, output_name = os.path.split(output_path)
+    part_path = os.path.join(output_dir, f".{output_name}.part")
+    try:
+        image.save(part_path, format_name, **save_options)
+        os.replace(part_path, output_path)
+        if not target_size:
+            print(f"[DEBUG] Preserved original dimensions: {original_size}")
+    except Exception as e:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise Exception(f"Failed to save converted image: {str(e)}")
+    timings['encode'], started = lap(started)
+    if frames > 1:
+        timings['encode'] -= sum(image.timings.values()) - frame_seconds
+        for stage, seconds in image.timings.items():
+            timings[stage] = timings.get(stage, 0.0) + seconds
+
+    if not os.path.exists(output_path):
+        raise Exception("Conversion completed but output file not found")
+
+    if preview_path:
+        try:
+            if frames > 1:
+                image.seek(0)
+            save_preview(image, preview_path)
+            timings['preview'], started = lap(started)
+        except Exception as e:
+            # The preview route builds missing previews on demand
+            print(f"[DEBUG] Could not create preview {preview_path}: {str(e)}")
+
+    return {
+        'original_size': original_size,
+        'output_size': image.size,
+        'input_format': input_format,
+        'frames': frames,
+        'timings': timings
+    }
+
+
+def convert_image_profiled(profile_dir, tags, *args):
+    """Run convert_image() under cProfile and save the profile, tagged with what was converted"""
+    profile = cProfile.Profile()
+    tags = dict(tags)
+    started = time.perf_counter()
+    try:
+        result = profile.runcall(convert_image, *args)
+        width, height = result['original_size']
+        tags.update(inputs=[result['input_format']], pixels=width * height, stages=result['timings'])
+        return result
+    except Exception as e:
+        tags['error'] = str(e)
+        raise
+    finally:
+        tags['seconds'] = time.perf_counter() - started
+        try:
+            save_profile(profile, profile_dir, tags)
+        except Exception as e:
+            print(f"[DEBUG] Could not save profile: {str(e)}")
+
+
+class ConversionTimeout(Exception):
+    """A conversion ran longer than the engine's task_timeout"""
+
+
+# Set in each pool worker: where it reports the tasks it starts
+_start_queue = None
+
+
+def _init_worker(start_queue):
+    global _start_queue
+    _start_queue = start_queue
+
+
+def _run_task(token, function, *args):
+    """Report that a task started executing, then run it"""
+    if _start_queue is not None:
+        # CLOCK_MONOTONIC is system-wide, so the parent can compare it with its own
+        _start_queue.put((token, time.monotonic()))
+    return function(*args)
+
+
+class ConversionEngine:
+    """Runs conversions of a batch in parallel on a bounded process pool.
+
+    The pool is created lazily on first use so that every gunicorn worker
+    forks its own children after the application has been loaded. Workers
+    report when they start a task, which is where its timeout counts from.
+
+    All batches of an app worker share the pool. submit() hands out futures
+    of its own rather than the pool's, so when the pool has to be torn down
+    because one task hung, the tasks of other batches are resubmitted to
+    the new pool instead of failing with it.
+    """
+
+    def __init__(self, max_workers=None, task_timeout=None, frame_limits=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.task_timeout = task_timeout
+        self.frame_limits = frame_limits
+        self._pool = None
+        self._lock = threading.Lock()
+        self._owners = weakref.WeakKeyDictionary()
+        self._running = weakref.WeakKeyDictionary()
+        self._recycled = weakref.WeakSet()
+        self._start_queue = None
+        self._start_lock = threading.Lock()
+        self._tokens = itertools.count()
+        self._futures = weakref.WeakValueDictionary()
+        self._started = weakref.WeakKeyDictionary()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # A fresh queue per pool: a worker killed while writing could leave the old one locked
+                self._start_queue = multiprocessing.SimpleQueue()
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker,
+                                                 initargs=(self._start_queue,))
+                print(f"[DEBUG] Started conversion pool with {self.max_workers} workers")
+            return self._pool
+
+    def _recycle_pool(self, pool):
+        """Tear down a pool that has a stuck or dead worker"""
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+            # Its unfinished tasks are run again on the next pool, see _settle()
+            self._recycled.add(pool)
+            # shutdown() drops the executor's process table, so take it first
+            processes = list((getattr(pool, '_processes', None) or {}).values())
+        self._collect_starts()
+        pool.shutdown(wait=False, cancel_futures=True)
+        # Hung conversions never return on their own, so kill the children
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        print(f"[DEBUG] Recycled conversion pool, stopped {len(processes)} workers")
+
+    def _collect_starts(self):
+        """Record the start times the workers reported since the last call"""
+        with self._start_lock:
+            queue = self._start_queue
+            while queue is not None and not queue.empty():
+                token, started = queue.get()
+                future = self._futures.get(token)
+                if future is not None:
+                    self._started[future] = started
+
+    def submit(self, task):
+        """Queue a single task on the pool and return its future.
+
+        A task is a dict with input_path, output_path, output_format,
+        filename and optionally preview_path and options. With a
+        profile_dir the conversion is profiled and the profile saved
+        there, tagged with profile_tags.
+        """
+        if task.get('profile_dir'):
+            call = (convert_image_profiled, task['profile_dir'], task.get('profile_tags') or {})
+        else:
+            call = (convert_image,)
+        args = (
+            *call,
+            task['input_path'],
+            task['output_path'],
+            task['output_format'],
+            task.get('filename'),
+            task.get('preview_path'),
+            task.get('options'),
+            self.frame_limits,
+        )
+        future = Future()
+        future.add_done_callback(self._cancel_running)
+        self._dispatch(future, args)
+        return future
+
+    def _dispatch(self, future, args):
+        """Run a task on the current pool, settling future when it is done"""
+        pool = self._get_pool()
+        token = next(self._tokens)
+        try:
+            running = pool.submit(_run_task, token, *args)
+        except BrokenProcessPool:
+            self._recycle_pool(pool)
+            return self._dispatch(future, args)
+        self._owners[future] = pool
+        self._running[future] = running
+        self._futures[token] = future
+        self._started.pop(future, None)
+        running.add_done_callback(lambda running: self._settle(future, running, pool, args))
+
+    def _settle(self, future, running, pool, args):
+        """Pass the pool's outcome on to future, or run the task again"""
+        if future.done():
+            # Cancelled, or given up on by wait_for()
+            return
+        if running.cancelled():
+            if pool not in self._recycled:
+                # The engine is shutting down
+                future.cancel()
+                return
+        else:
+            error = running.exception()
+            if error is None:
+                self._resolve(future, result=running.result())
+                return
+            if not isinstance(error, BrokenProcessPool):
+                self._resolve(future, error=error)
+                return
+        self._collect_starts()
+        # A recycled pool went down for some other task's timeout, and a task
+        # that never started can't have crashed its worker: run those again.
+        # A task that was running when a worker died may be the cause.
+        if pool in self._recycled or self._started.get(future) is None:
+            self._dispatch(future, args)
+        else:
+            self._resolve(future, error=error)
+
+    @staticmethod
+    def _resolve(future, result=None, error=None):
+        try:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        except InvalidStateError:
+            # Settled by another thread in the meantime
+            pass
+
+    def _cancel_running(self, future):
+        """Stop the pool task of a future its caller cancelled"""
+        if future.cancelled():
+            running = self._running.get(future)
+            if running is not None:
+                running.cancel()
+
+    def wait_for(self, futures, on_result=None):
+        """Wait for submitted tasks, enforcing the per-task timeout.
+
+        Returns a list of (result, error) tuples in the order of futures,
+        where exactly one of the two is None. If on_result is given it is
+        called as on_result(index, result, error) as soon as each task
+        finishes. A timed-out task's future fails with ConversionTimeout.
+        """
+        pending = {future: index for index, future in enumerate(futures)}
+        outcomes = [None] * len(futures)
+        stuck_pools = set()
+
+        def finish(future, result, error):
+            index = pending.pop(future)
+            outcomes[index] = (result, error)
+            if on_result is not None:
+                on_result(index, result, error)
+
+        # The timeout is counted from when a worker starts the task, not from
+        # when it was queued behind the other files. running() is no help:
+        # it is also true of tasks waiting in the executor's call queue.
+        while pending:
+            done, _ = wait(list(pending), timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in done:
+                result, error = None, None
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    stuck_pools.add(self._owners.get(future))
+                    error = "Conversion worker crashed"
+                except Exception as e:
+                    error = str(e)
+                finish(future, result, error)
+
+            if not self.task_timeout:
+                continue
+            self._collect_starts()
+            now = time.monotonic()
+            for future in list(pending):
+                started = self._started.get(future)
+                if started is not None and now - started > self.task_timeout:
+                    stuck_pools.add(self._owners.get(future))
+                    error = f"Conversion timed out after {self.task_timeout} seconds"
+                    # Settle it first, so recycling the pool doesn't run it again
+                    self._resolve(future, error=ConversionTimeout(error))
+                    finish(future, None, error)
+
+        for pool in stuck_pools:
+            if pool is not None:
+                self._recycle_pool(pool)
+
+        return outcomes
+
+    def convert_batch(self, tasks, on_result=None):
+        """Convert a list of tasks in parallel, see submit() and wait_for()"""
+        return self.wait_for([self.submit(task) for task in tasks], on_result=on_result)
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,125 @@
+import os
+import time
+import heapq
+import fcntl
+import threading
+
+
+class ExpiryScheduler:
+    """Expires sessions from a min-heap ordered by deadline.
+
+    The heap is refilled from the store's expiry index with the sessions
+    due before the next refill, so a sweep only ever touches sessions that
+    are actually due. Due sessions are removed from the store in a single
+    transaction and handed to on_expired as (session_id, job_id) pairs.
+
+    Every gunicorn worker starts a scheduler, but only the one holding the
+    lock file acts as the sweeper; the others retry every interval and take
+    over if the sweeper dies.
+    """
+
+    def __init__(self, store, on_expired, interval=300, lock_path=None, batch_size=1000):
+        self.store = store
+        self.on_expired = on_expired
+        self.interval = interval
+        self.lock_path = lock_path
+        self.batch_size = batch_size
+        self.is_sweeper = False
+        self._heap = []
+        self._deadlines = {}
+        self._cond = threading.Condition()
+        self._lock_file = None
+        self._thread = None
+        self._next_refill = 0
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='expiry-scheduler', daemon=True)
+            self._thread.start()
+
+    def schedule(self, session_id, expires_at):
+        """Tell the sweeper about a new or extended session"""
+        # Other workers' sessions reach the sweeper through the next refill
+        if not self.is_sweeper:
+            return
+        with self._cond:
+            self._push(session_id, expires_at)
+            self._cond.notify()
+
+    def refresh(self):
+        """Reload upcoming expirations from the store, e.g. after sessions were imported"""
+        with self._cond:
+            self._next_refill = 0
+            self._cond.notify()
+
+    def _push(self, session_id, expires_at, force=False):
+        # Sessions due after the next refill are picked up by that refill.
+        # Superseded entries stay in the heap and are skipped when popped.
+        if (force or expires_at < self._next_refill) and self._deadlines.get(session_id) != expires_at:
+            self._deadlines[session_id] = expires_at
+            heapq.heappush(self._heap, (expires_at, session_id))
+
+    def _acquire_lock(self):
+        if self.lock_path is None:
+            return True
+        if self._lock_file is None:
+            self._lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+    def _refill(self, now):
+        """Load the sessions due before the next refill from the expiry index"""
+        self._next_refill = now + self.interval
+        due = self.store.due_before(self._next_refill, limit=self.batch_size)
+        if len(due) == self.batch_size:
+            # More is due than fits in one batch - come back right after this sweep
+            self._next_refill = due[-1][1]
+        with self._cond:
+            for session_id, expires_at in due:
+                self._push(session_id, expires_at, force=True)
+
+    def sweep(self, now=None):
+        """Expire every session whose deadline has passed; returns the expired pairs"""
+        now = now or time.time()
+        due = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                expires_at, session_id = heapq.heappop(self._heap)
+                if self._deadlines.get(session_id) == expires_at:
+                    del self._deadlines[session_id]
+                    due.append(session_id)
+        if not due:
+            return []
+
+        expired = self.store.delete_expired(due, now)
+        if expired:
+            self.on_expired(expired)
+        return expired
+
+    def _run(self):
+        while True:
+            try:
+                if not self.is_sweeper:
+                    self.is_sweeper = self._acquire_lock()
+                    if not self.is_sweeper:
+                        time.sleep(self.interval)
+                        continue
+                    print(f"[DEBUG] Process {os.getpid()} is the session expiry sweeper")
+
+                now = time.time()
+                if now >= self._next_refill:
+                    self._refill(now)
+                self.sweep(now)
+
+                # Sleep until the next deadline or the next refill
+                with self._cond:
+                    wake_at = self._next_refill
+                    if self._heap:
+                        wake_at = min(wake_at, self._heap[0][0])
+                    self._cond.wait(max(0.0, wake_at - time.time()))
+            except Exception as e:
+                print(f"Error in session expiry scheduler: {str(e)}")
+                time.sleep(self.interval)
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 import os
-import json
 import time
+import sqlite3
 import argparse
 from datetime import datetime
+from session_store import SessionStore, default_db_path
 
 def format_time(timestamp):
     """Format a timestamp into a readable datetime."""
@@ -23,19 +24,20 @@ def main():
 
     # Set paths
     SESSION_FILE = os.path.join(args.data_path, 'image_data', 'sessions.json')
+    SESSION_DB = default_db_path(SESSION_FILE)
     
-    # Check if sessions file exists
-    if not os.path.exists(SESSION_FILE):
-        print(f"Error: Sessions file does not exist at {SESSION_FILE}")
+    # Check if the sessions database (or a legacy file to migrate) exists
+    if not os.path.exists(SESSION_DB) and not os.path.exists(SESSION_FILE):
+        print(f"Error: Sessions database does not exist at {SESSION_DB}")
         return 1
     
     try:
-        # Load sessions
-        with open(SESSION_FILE, 'r') as f:
-            sessions = json.load(f)
+        # Open sessions
+        store = SessionStore(SESSION_DB)
+        store.migrate_from_json(SESSION_FILE)
         
-        if not sessions:
-            print("No sessions found in the sessions file.")
+        if store.count() == 0:
+            print("No sessions found in the sessions database.")
             return 0
         
         # Current time and extension time (in seconds)
@@ -49,8 +51,8 @@ def main():
         # Process sessions
         if args.session_id:
             # Extend specific session
-            if args.session_id in sessions:
-                session = sessions[args.session_id]
+            session = store.get(args.session_id)
+            if session is not None:
                 created_at = session.get('created_at', 0)
                 
                 # Check if session is expired and force is not enabled
@@ -58,8 +60,8 @@ def main():
                     print(f"Session {args.session_id} is already expired. Use --force to extend anyway.")
                     skipped_count += 1
                 else:
-                    # Set new creation time (current time)
-                    sessions[args.session_id]['created_at'] = current_time
+                    # The store keeps the expiry, so write the new expiry time
+                    store.set_expiry(args.session_id, current_time + extension_seconds)
                     
                     before_time = format_time(created_at)
                     after_time = format_time(current_time)
@@ -75,7 +77,7 @@ def main():
                 return 1
         else:
             # Extend all valid sessions (or all if force is enabled)
-            for session_id, session_data in sessions.items():
+            for session_id, session_data in list(store.items()):
                 created_at = session_data.get('created_at', 0)
                 
                 # Check if session is expired and force is not enabled
@@ -84,8 +86,8 @@ def main():
                     skipped_count += 1
                     continue
                 
-                # Set new creation time (current time)
-                sessions[session_id]['created_at'] = current_time
+                # The store keeps the expiry, so write the new expiry time
+                store.set_expiry(session_id, current_time + extension_seconds)
                 
                 before_time = format_time(created_at)
                 after_time = format_time(current_time)
@@ -97,15 +99,11 @@ def main():
                 print(f"  New expiry: {expiry_time}")
                 extended_count += 1
         
-        # Save updated sessions
-        with open(SESSION_FILE, 'w') as f:
-            json.dump(sessions, f, indent=2)
-        
         print(f"\nSummary: Extended {extended_count} sessions, skipped {skipped_count} expired sessions.")
-        print(f"Sessions file updated at {SESSION_FILE}")
+        print(f"Sessions database updated at {SESSION_DB}")
         
-    except json.JSONDecodeError:
-        print(f"Error: Sessions file is corrupted or not valid JSON.")
+    except (sqlite3.DatabaseError, ValueError):
+        print(f"Error: Sessions database is corrupted or the legacy sessions file is not valid JSON.")
         return 1
     except Exception as e:
         print(f"Error: {str(e)}")
@@ -0,0 +1,108 @@
+import os
+import re
+import time
+import uuid
+import hashlib
+from pathlib import Path
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+
+CHUNK_SIZE = 64 * 1024
+MAX_FIELD_SIZE = 500 * 1024
+
+
+def spool_path(spool_dir, filename):
+    """Return a unique spool path that keeps the extension of the client filename"""
+    suffix = Path(filename).suffix
+    if not re.fullmatch(r'\.[A-Za-z0-9]{1,10}', suffix):
+        suffix = ''
+    return os.path.join(spool_dir, f"{uuid.uuid4().hex}{suffix}")
+
+
+def iter_upload_parts(stream, boundary, spool_dir, chunk_size=CHUNK_SIZE, max_field_size=MAX_FIELD_SIZE):
+    """Parse a multipart body incrementally, yielding each part once it has fully arrived.
+
+    Form fields are yielded as {'name', 'value'} and file parts as
+    {'name', 'filename', 'path', 'size', 'sha256', 'seconds'}, where seconds is
+    how long the part took to arrive and be written. File data is written straight
+    from the request stream into a per-request unique spool file, so the
+    body only touches the disk once and two clients uploading the same
+    filename never collide. Spool files of yielded parts belong to the
+    caller; a partially received file is removed here.
+    """
+    decoder = MultipartDecoder(boundary.encode('latin-1'), max_form_memory_size=max_field_size)
+    current = None
+    out = None
+    digest = None
+    started = None
+    try:
+        while True:
+            event = decoder.next_event()
+            if isinstance(event, NeedData):
+                if decoder.complete:
+                    raise ValueError("Upload ended before all files were received")
+                chunk = stream.read(chunk_size)
+                decoder.receive_data(chunk or None)
+            elif isinstance(event, Field):
+                current = {'name': event.name, 'value': bytearray()}
+            elif isinstance(event, File):
+                current = {'name': event.name, 'filename': event.filename, 'path': None, 'size': 0, 'sha256': None,
+                           'seconds': None}
+                if event.filename:
+                    started = time.perf_counter()
+                    current['path'] = spool_path(spool_dir, event.filename)
+                    out = open(current['path'], 'xb')
+                    digest = hashlib.sha256()
+            elif isinstance(event, Data):
+                if 'value' in current:
+                    current['value'] += event.data
+                    if len(current['value']) > max_field_size:
+                        raise RequestEntityTooLarge()
+                elif out is not None:
+                    out.write(event.data)
+                    digest.update(event.data)
+                    current['size'] += len(event.data)
+                if not event.more_data:
+                    part, current = current, None
+                    if 'value' in part:
+                        part['value'] = part['value'].decode('utf-8', 'replace')
+                    elif out is not None:
+                        out.close()
+                        out = None
+                        part['sha256'] = digest.hexdigest()
+                        part['seconds'] = time.perf_counter() - started
+                    yield part
+            elif isinstance(event, Epilogue):
+                break
+    finally:
+        if out is not None:
+            out.close()
+            if current and current.get('path') and os.path.exists(current['path']):
+                os.remove(current['path'])
+
+
+def write_chunk(stream, path, offset, length, chunk_size=CHUNK_SIZE):
+    """Copy length bytes of the request stream into the spool file at offset.
+
+    Chunks of a file may arrive in any order and from several workers at
+    once; each writes only its own byte range. Raises ValueError if the
+    stream ends early, in which case the range must not be recorded.
+    """
+    remaining = length
+    with open(path, 'r+b') as out:
+        out.seek(offset)
+        while remaining:
+            data = stream.read(min(chunk_size, remaining))
+            if not data:
+                raise ValueError(f"Chunk ended after {length - remaining} of {length} bytes")
+            out.write(data)
+            remaining -= len(data)
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Hash a spooled file whose chunks arrived out of order"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(chunk_size), b''):
+            digest.update(data)
+    return digest.hexdigest()
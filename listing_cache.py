@@ -0,0 +1,77 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+# A listing taken this soon after the directory changed may have missed a
+# change made in the same timestamp tick (1 s on some network filesystems)
+RACY_NS = 1_000_000_000
+
+
+class Listing:
+    """The files of a session directory, and whatever views derived from them"""
+
+    __slots__ = ('members', 'names', 'mtime_ns', 'racy', 'checked_at', 'derived')
+
+    def __init__(self, members, mtime_ns, racy, checked_at):
+        self.members = members
+        self.names = frozenset(name for name, _, _ in members)
+        self.mtime_ns = mtime_ns
+        self.racy = racy
+        self.checked_at = checked_at
+        # Per-request data built from the members, e.g. URLs per host
+        self.derived = {}
+
+
+class ListingCache:
+    """In-process cache of session directory listings.
+
+    lister(path) returns the (name, path, stat) members of a directory, as
+    archive.archive_members does. A listing stays valid while the
+    directory's mtime is unchanged: files only appear in a session by
+    being renamed or linked into place, and removing one changes the
+    mtime too. A listing checked less than revalidate_after seconds ago is
+    returned without even that stat. Changes made by this process call
+    invalidate(); those of other workers show up within revalidate_after.
+    The least recently used listings beyond max_entries are dropped, and
+    max_entries=0 disables caching.
+    """
+
+    def __init__(self, lister, max_entries=1024, revalidate_after=1.0):
+        self.lister = lister
+        self.max_entries = max_entries
+        self.revalidate_after = revalidate_after
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id, path):
+        """Return the Listing of a session directory, or None if it doesn't exist"""
+        now = time.monotonic()
+        with self._lock:
+            listing = self._entries.get(session_id)
+            if listing is not None:
+                self._entries.move_to_end(session_id)
+        if listing is not None and now - listing.checked_at < self.revalidate_after:
+            return listing
+
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            self.invalidate(session_id)
+            return None
+        if listing is not None and listing.mtime_ns == mtime_ns and not listing.racy:
+            listing.checked_at = now
+            return listing
+
+        listing = Listing(self.lister(path), mtime_ns, time.time_ns() - mtime_ns < RACY_NS, now)
+        if self.max_entries > 0:
+            with self._lock:
+                self._entries[session_id] = listing
+                self._entries.move_to_end(session_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return listing
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
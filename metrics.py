@@ -0,0 +1,158 @@
+import os
+import sqlite3
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the histogram buckets, +Inf is implied
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Type and help text of every metric, in the order they are exposed
+METRICS = {
+    'image_convert_stage_seconds': (
+        'histogram', 'Time spent in each conversion stage, per input and output format'),
+    'image_convert_conversions_total': (
+        'counter', 'Files handled per output format and result (converted, cached or failed)'),
+    'image_convert_failures_total': ('counter', 'Files that could not be converted, by reason'),
+    'image_convert_received_bytes_total': ('counter', 'Bytes of uploaded files'),
+    'image_convert_output_bytes_total': ('counter', 'Bytes of converted files, per output format'),
+    'image_convert_admission_total': (
+        'counter', 'Memory admission decisions: admitted, queued, rejected (503) or too_large'),
+    'image_convert_gc_reclaimed_sessions_total': (
+        'counter', 'Session directories removed by the output GC, expired after the grace period or over budget'),
+    'image_convert_gc_reclaimed_bytes_total': ('counter', 'Disk bytes freed by the output GC, by reason'),
+    'image_convert_gc_reclaimed_inodes_total': ('counter', 'Files and directories removed by the output GC, by reason'),
+    'image_convert_active_sessions': ('gauge', 'Sessions that have not expired yet'),
+    'image_convert_memory_in_flight_bytes': (
+        'gauge', 'Estimated memory reserved by conversions in flight across all workers'),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (name, labels)
+);
+
+CREATE TABLE IF NOT EXISTS histograms (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    PRIMARY KEY (name, labels, bucket)
+);
+"""
+
+
+def format_labels(labels):
+    """Render a label dict the way the Prometheus text format expects, sorted by name"""
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{name}="{escape(value)}"' for name, value in sorted(labels.items()))
+
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metrics:
+    """Counters and histograms shared by every gunicorn worker through SQLite.
+
+    Each worker adds its observations to the same rows, so any worker can
+    answer a scrape with the totals of all of them. Histogram observations
+    are stored per bucket and made cumulative when rendered, which keeps
+    an observation to a single row update.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        # One connection per thread, reopened after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def record(self, counts=(), observations=()):
+        """Add to counters and histograms in one transaction.
+
+        counts are (name, labels, amount) and observations are
+        (name, labels, seconds) tuples, with labels as a dict.
+        """
+        with self._transaction() as conn:
+            conn.executemany(
+                'INSERT INTO counters (name, labels, value) VALUES (?, ?, ?) '
+                'ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value',
+                [(name, format_labels(labels), amount) for name, labels, amount in counts]
+            )
+            conn.executemany(
+                'INSERT INTO histograms (name, labels, bucket, count, sum) VALUES (?, ?, ?, 1, ?) '
+                'ON CONFLICT (name, labels, bucket) DO UPDATE '
+                'SET count = count + 1, sum = sum + excluded.sum',
+                [(name, format_labels(labels), bisect_left(BUCKETS, seconds), seconds)
+                 for name, labels, seconds in observations]
+            )
+
+    def render(self, gauges=None):
+        """Return all metrics in the Prometheus text exposition format.
+
+        gauges maps gauge names to their current value; they are measured
+        at scrape time by the caller rather than stored.
+        """
+        conn = self._connect()
+        samples = {name: [] for name in METRICS}
+
+        for name, labels, value in conn.execute('SELECT name, labels, value FROM counters ORDER BY name, labels'):
+            samples.setdefault(name, []).append(f"{name}{{{labels}}} {format_value(value)}" if labels
+                                                else f"{name} {format_value(value)}")
+
+        histograms = {}
+        for name, labels, bucket, count, total in conn.execute(
+                'SELECT name, labels, bucket, count, sum FROM histograms ORDER BY name, labels'):
+            counts, sums = histograms.setdefault((name, labels), ([0] * (len(BUCKETS) + 1), [0.0]))
+            counts[bucket] += count
+            sums[0] += total
+        for (name, labels), (counts, sums) in histograms.items():
+            prefix = f"{labels}," if labels else ''
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += count
+                samples.setdefault(name, []).append(
+                    f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            suffix = f"{{{labels}}}" if labels else ''
+            samples[name].append(f"{name}_sum{suffix} {format_value(sums[0])}")
+            samples[name].append(f"{name}_count{suffix} {cumulative}")
+
+        for name, value in (gauges or {}).items():
+            samples.setdefault(name, []).append(f"{name} {format_value(value)}")
+
+        lines = []
+        for name, lines_of_metric in samples.items():
+            metric_type, help_text = METRICS.get(name, ('untyped', ''))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.extend(lines_of_metric)
+        return '\n'.join(lines) + '\n'
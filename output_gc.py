@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import threading
+
+
+def usage(path):
+    """Return (bytes, inodes) a session directory takes up on disk.
+
+    Files hardlinked from the conversion cache are not counted: removing
+    the session would not free them, and the cache has a budget of its own.
+    """
+    total_bytes = 0
+    inodes = 1
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        inodes += 1
+                        stack.append(entry.path)
+                    elif stat.st_nlink == 1:
+                        inodes += 1
+                        total_bytes += stat.st_blocks * 512
+        except OSError:
+            continue
+    return total_bytes, inodes
+
+
+class OutputCollector:
+    """Removes the directories of expired sessions from the output folder.
+
+    Expired sessions keep their directory for a grace period, for
+    troubleshooting. When the session directories together use more than
+    max_bytes or max_inodes, expired directories still in their grace
+    period are evicted oldest first, and then active sessions, soonest
+    expiry first. Directories written to within the last min_idle seconds
+    are never evicted.
+
+    The output folder is read with os.scandir in batches of batch_size
+    entries, pausing between batches, so a sweep over a large folder is
+    spread out rather than hogging the disk. Directories are only measured
+    when a budget is set, or when they are removed. Every gunicorn worker
+    starts a collector, but only the one holding the lock file sweeps. The
+    report of the last sweep is written to report_path.
+    """
+
+    def __init__(self, output_dir, store, grace, max_bytes=0, max_inodes=0, interval=3600, lock_path=None,
+                 report_path=None, batch_size=500, pause=0.05, min_idle=0, on_evict=None, on_swept=None):
+        self.output_dir = output_dir
+        self.store = store
+        self.grace = grace
+        self.max_bytes = max_bytes
+        self.max_inodes = max_inodes
+        self.interval = interval
+        self.lock_path = lock_path
+        self.report_path = report_path
+        self.batch_size = batch_size
+        self.pause = pause
+        self.min_idle = min_idle
+        self.on_evict = on_evict
+        self.on_swept = on_swept
+        self._lock_file = None
+        self._thread = None
+
+    @property
+    def budgeted(self):
+        return self.max_bytes > 0 or self.max_inodes > 0
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='output-gc', daemon=True)
+            self._thread.start()
+
+    def _acquire_lock(self):
+        if self.lock_path is None:
+            return True
+        if self._lock_file is None:
+            self._lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+    def _batches(self):
+        """Yield the session directories of the output folder, batch_size at a time"""
+        batch = []
+        try:
+            with os.scandir(self.output_dir) as entries:
+                for entry in entries:
+                    # Session ids are UUIDs; hidden directories (.cache) and anything else are left alone
+                    if entry.name.startswith('.') or len(entry.name) < 32 or not entry.is_dir(follow_symlinks=False):
+                        continue
+                    batch.append(entry)
+                    if len(batch) >= self.batch_size:
+                        yield batch
+                        batch = []
+                        time.sleep(self.pause)
+        except FileNotFoundError:
+            pass
+        if batch:
+            yield batch
+
+    def _archive_path(self, session_id):
+        return os.path.join(self.output_dir, f"{session_id}_converted.zip")
+
+    def _measure(self, entry):
+        """(bytes, inodes) of a session directory together with its download-all ZIP"""
+        total_bytes, inodes = usage(entry.path)
+        try:
+            total_bytes += os.stat(self._archive_path(entry.name)).st_blocks * 512
+            inodes += 1
+        except OSError:
+            pass
+        return total_bytes, inodes
+
+    def _remove(self, entry, reason, report, measured=None):
+        """Delete a session directory and its ZIP, adding what that freed to the report"""
+        total_bytes, inodes = measured or self._measure(entry)
+        if os.path.exists(self._archive_path(entry.name)):
+            os.remove(self._archive_path(entry.name))
+        shutil.rmtree(entry.path, ignore_errors=True)
+        reclaimed = report['reclaimed'][reason]
+        reclaimed['sessions'] += 1
+        reclaimed['bytes'] += total_bytes
+        reclaimed['inodes'] += inodes
+
+    def sweep(self, now=None):
+        """Remove expired directories past their grace period, then evict down to the budget.
+
+        Returns a report of what was scanned and reclaimed.
+        """
+        now = now or time.time()
+        started = time.perf_counter()
+        report = {
+            'started_at': now,
+            'scanned': 0,
+            'reclaimed': {reason: {'sessions': 0, 'bytes': 0, 'inodes': 0} for reason in ('expired', 'budget')},
+            'usage': None,
+            'budget': {'bytes': self.max_bytes, 'inodes': self.max_inodes},
+            'over_budget': False
+        }
+        forgotten = []
+        candidates = []
+        used_bytes = used_inodes = 0
+        for batch in self._batches():
+            report['scanned'] += len(batch)
+            names = [entry.name for entry in batch]
+            active = self.store.expiries(names)
+            expired = self.store.expired_at(names)
+            for entry in batch:
+                try:
+                    modified = entry.stat(follow_symlinks=False).st_mtime
+                except OSError:
+                    continue
+                # Directories the store never knew about count from their last change
+                expired_since = None if entry.name in active else expired.get(entry.name, modified)
+                if expired_since is not None and expired_since < now - self.grace:
+                    self._remove(entry, 'expired', report)
+                    forgotten.append(entry.name)
+                    continue
+                if not self.budgeted:
+                    continue
+                measured = self._measure(entry)
+                used_bytes += measured[0]
+                used_inodes += measured[1]
+                if modified > now - self.min_idle:
+                    continue
+                # Expired directories go before active sessions, oldest first
+                key = (0, expired_since) if expired_since is not None else (1, active[entry.name])
+                candidates.append((key, entry, measured))
+
+        if self.budgeted:
+            candidates.sort(key=lambda candidate: candidate[0])
+            for count, (key, entry, measured) in enumerate(candidates, 1):
+                if (not self.max_bytes or used_bytes <= self.max_bytes) and \
+                        (not self.max_inodes or used_inodes <= self.max_inodes):
+                    break
+                if key[0] == 1 and self.on_evict is not None:
+                    self.on_evict(entry.name)
+                self._remove(entry, 'budget', report, measured)
+                used_bytes -= measured[0]
+                used_inodes -= measured[1]
+                forgotten.append(entry.name)
+                if count % self.batch_size == 0:
+                    time.sleep(self.pause)
+            report['usage'] = {'bytes': used_bytes, 'inodes': used_inodes}
+            report['over_budget'] = bool((self.max_bytes and used_bytes > self.max_bytes) or
+                                         (self.max_inodes and used_inodes > self.max_inodes))
+
+        if forgotten:
+            self.store.forget_expired(forgotten)
+        report['seconds'] = round(time.perf_counter() - started, 3)
+        if self.report_path:
+            temp_path = f"{self.report_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(report, f)
+            os.replace(temp_path, self.report_path)
+        if self.on_swept is not None:
+            self.on_swept(report)
+        return report
+
+    def last_report(self):
+        """The report of the last sweep by any worker, or None"""
+        try:
+            with open(self.report_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def _run(self):
+        is_sweeper = False
+        while True:
+            try:
+                if not is_sweeper:
+                    is_sweeper = self._acquire_lock()
+                if is_sweeper:
+                    report = self.sweep()
+                    reclaimed = report['reclaimed']
+                    print(f"[DEBUG] Output GC scanned {report['scanned']} sessions in {report['seconds']}s, "
+                          f"removed {reclaimed['expired']['sessions']} expired and "
+                          f"evicted {reclaimed['budget']['sessions']} over budget")
+            except Exception as e:
+                print(f"Error in output garbage collector: {str(e)}")
+            time.sleep(self.interval)
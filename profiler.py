@@ -0,0 +1,74 @@
+import os
+import re
+import hmac
+import json
+import time
+import uuid
+import random
+import cProfile
+
+
+def profile_stem(tags):
+    """File name (without extension) of a profile, built from its tags.
+
+    Sorts by time in a directory listing and shows the endpoint, session,
+    formats and pixel count without opening the file.
+    """
+    parts = [time.strftime('%Y%m%d-%H%M%S'), tags.get('endpoint'), tags.get('session_id')]
+    inputs = tags.get('inputs')
+    if inputs or tags.get('output'):
+        parts.append(f"{'+'.join(inputs or ['unknown'])}-to-{tags.get('output') or 'unknown'}")
+    if tags.get('pixels'):
+        parts.append(f"{tags['pixels']}px")
+    parts.append(uuid.uuid4().hex[:8])
+    stem = '_'.join(str(part) for part in parts if part)
+    return re.sub(r'[^A-Za-z0-9_.+-]', '-', stem)
+
+
+def save_profile(profile, profile_dir, tags):
+    """Write profile as a pstats file with a JSON file of its tags next to it; returns the path"""
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, f"{profile_stem(tags)}.prof")
+    profile.dump_stats(path)
+    with open(f"{os.path.splitext(path)[0]}.json", 'w') as f:
+        json.dump(tags, f, indent=2, default=str)
+    return path
+
+
+class RequestProfiler:
+    """Decides which requests to profile and keeps their profiles.
+
+    Nothing is profiled unless a profile directory is configured. A request
+    is then profiled if it carries the X-Profile header (which has to match
+    the token, if one is set) or if it is picked at the sample rate.
+    """
+
+    def __init__(self, profile_dir=None, sample_rate=0.0, token=None):
+        self.profile_dir = profile_dir or None
+        self.sample_rate = sample_rate
+        self.token = token or None
+
+    @property
+    def enabled(self):
+        return self.profile_dir is not None
+
+    def wanted(self, header_value=None):
+        if not self.enabled:
+            return False
+        if header_value:
+            return self.token is None or hmac.compare_digest(header_value, self.token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def save(self, profile, tags):
+        try:
+            path = save_profile(profile, self.profile_dir, tags)
+            print(f"[DEBUG] Saved profile {path}")
+            return path
+        except Exception as e:
+            print(f"[DEBUG] Could not save profile: {str(e)}")
+            return None
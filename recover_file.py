@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 import os
-import json
-import time
+import sqlite3
 import shutil
 import argparse
 from datetime import datetime
 import glob
+from session_store import SessionStore, default_db_path
 
 def print_colored(message, color_code):
     """Print message with color."""
@@ -45,6 +45,7 @@ def main():
 
     # Set paths
     SESSION_FILE = os.path.join(args.data_path, 'image_data', 'sessions.json')
+    SESSION_DB = default_db_path(SESSION_FILE)
     OUTPUT_DIR = os.path.join(args.data_path, 'image_outputs')
     
     # Create recovery directory
@@ -71,20 +72,21 @@ def main():
     if session_dirs:
         print_info(f"Found {len(session_dirs)} session directories on disk")
     
-    # Check for session file
+    # Check for session database
     sessions = {}
-    if os.path.exists(SESSION_FILE):
-        print_success(f"Sessions file exists: {SESSION_FILE}")
+    if os.path.exists(SESSION_DB) or os.path.exists(SESSION_FILE):
         try:
-            with open(SESSION_FILE, 'r') as f:
-                sessions = json.load(f)
-            print_success(f"Loaded {len(sessions)} sessions from file")
-        except json.JSONDecodeError:
-            print_error(f"Sessions file is corrupted or empty")
+            store = SessionStore(SESSION_DB)
+            store.migrate_from_json(SESSION_FILE)
+            print_success(f"Sessions database exists: {SESSION_DB}")
+            sessions = dict(store.items())
+            print_success(f"Loaded {len(sessions)} sessions from database")
+        except (sqlite3.DatabaseError, ValueError):
+            print_error("Sessions database is corrupted or empty")
         except Exception as e:
             print_error(f"Error loading sessions: {str(e)}")
     else:
-        print_warning(f"Sessions file does NOT exist: {SESSION_FILE}")
+        print_warning(f"Sessions database does NOT exist: {SESSION_DB}")
     
     # Recover files based on arguments
     recovered_files = []
@@ -0,0 +1,337 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from urllib.parse import quote
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    expires_at REAL NOT NULL,
+    job_id TEXT
+);
+CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at);
+
+CREATE TABLE IF NOT EXISTS session_files (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL REFERENCES sessions (session_id) ON DELETE CASCADE,
+    original_filename TEXT,
+    converted_filename TEXT,
+    conversion_time REAL
+);
+CREATE INDEX IF NOT EXISTS session_files_session_id ON session_files (session_id);
+
+CREATE TABLE IF NOT EXISTS expired_sessions (
+    session_id TEXT PRIMARY KEY,
+    expired_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def default_db_path(session_file):
+    """The session database lives next to the legacy sessions.json"""
+    return os.path.splitext(session_file)[0] + '.db'
+
+
+def parse_legacy_entry(session_data):
+    """Turn one sessions.json entry into (expires_at, files, job_id), or None if unusable"""
+    if isinstance(session_data, (int, float, str)):
+        # Old format - just the expiry time
+        try:
+            return float(session_data), [], None
+        except ValueError:
+            return None
+    if isinstance(session_data, dict):
+        expires_at = session_data.get('created_at', 0)
+        try:
+            expires_at = float(expires_at)
+        except (TypeError, ValueError):
+            expires_at = time.time()
+        files = [f for f in session_data.get('files', []) if isinstance(f, dict)]
+        return expires_at, files, session_data.get('job_id')
+    return None
+
+
+class SessionStore:
+    """Sessions kept in SQLite (WAL mode) and shared by every process.
+
+    Sessions are returned in the same shape sessions.json used, i.e.
+    {'created_at': <expiry timestamp>, 'files': [...], 'job_id': ...}.
+    Every write touches only the rows of one session. With read_only the
+    database is opened as it is, for tools that must not change anything.
+    """
+
+    def __init__(self, db_path, read_only=False):
+        self.db_path = db_path
+        self.read_only = read_only
+        self._local = threading.local()
+        if read_only:
+            self._connect()
+            return
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        # One connection per thread, reopened after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            if self.read_only:
+                conn = sqlite3.connect(f"file:{quote(os.path.abspath(self.db_path))}?mode=ro", uri=True,
+                                       timeout=30, isolation_level=None)
+            else:
+                conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            if not self.read_only:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+                conn.execute('PRAGMA foreign_keys=ON')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _insert_files(self, conn, session_id, files):
+        conn.executemany(
+            'INSERT INTO session_files (session_id, original_filename, converted_filename, conversion_time) '
+            'VALUES (?, ?, ?, ?)',
+            [(session_id, f.get('original_filename'), f.get('converted_filename'), f.get('conversion_time'))
+             for f in files]
+        )
+
+    def __contains__(self, session_id):
+        return self.expires_at(session_id) is not None
+
+    def expires_at(self, session_id):
+        """Return the expiry timestamp of a session, or None if it is unknown"""
+        row = self._connect().execute(
+            'SELECT expires_at FROM sessions WHERE session_id = ?', (session_id,)
+        ).fetchone()
+        return row['expires_at'] if row else None
+
+    def get(self, session_id):
+        conn = self._connect()
+        row = conn.execute(
+            'SELECT expires_at, job_id FROM sessions WHERE session_id = ?', (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        files = conn.execute(
+            'SELECT original_filename, converted_filename, conversion_time FROM session_files '
+            'WHERE session_id = ? ORDER BY id', (session_id,)
+        ).fetchall()
+        return {
+            'created_at': row['expires_at'],
+            'files': [dict(f) for f in files],
+            'job_id': row['job_id']
+        }
+
+    def create(self, session_id, expires_at, files=(), job_id=None):
+        """Create or replace a session"""
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+            conn.execute(
+                'INSERT INTO sessions (session_id, expires_at, job_id) VALUES (?, ?, ?)',
+                (session_id, expires_at, job_id)
+            )
+            self._insert_files(conn, session_id, files)
+
+    def register(self, session_id, expires_at, files=()):
+        """Create a session unless another process already did; returns True if created"""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO sessions (session_id, expires_at) VALUES (?, ?)',
+                (session_id, expires_at)
+            )
+            if cursor.rowcount == 0:
+                return False
+            self._insert_files(conn, session_id, files)
+        return True
+
+    def add_files(self, session_id, files):
+        with self._transaction() as conn:
+            self._insert_files(conn, session_id, files)
+
+    def set_expiry(self, session_id, expires_at):
+        cursor = self._connect().execute(
+            'UPDATE sessions SET expires_at = ? WHERE session_id = ?', (expires_at, session_id)
+        )
+        return cursor.rowcount > 0
+
+    def set_job(self, session_id, job_id):
+        self._connect().execute(
+            'UPDATE sessions SET job_id = ? WHERE session_id = ?', (job_id, session_id)
+        )
+
+    def delete(self, session_id):
+        """Remove a session, returning its job id (if any) or None"""
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT job_id FROM sessions WHERE session_id = ?', (session_id,)
+            ).fetchone()
+            conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+            if row:
+                conn.execute('INSERT OR REPLACE INTO expired_sessions (session_id, expired_at) VALUES (?, ?)',
+                             (session_id, time.time()))
+        return row['job_id'] if row else None
+
+    def due_before(self, deadline, limit=None):
+        """Return (session_id, expires_at) pairs expiring before deadline, soonest first"""
+        query = 'SELECT session_id, expires_at FROM sessions WHERE expires_at < ? ORDER BY expires_at'
+        params = (deadline,)
+        if limit is not None:
+            query += ' LIMIT ?'
+            params += (limit,)
+        return [(row[0], row[1]) for row in self._connect().execute(query, params)]
+
+    def delete_expired(self, session_ids, now):
+        """Delete those of the given sessions that are still expired, in one transaction.
+
+        Sessions extended in the meantime are left alone. Returns a list of
+        (session_id, job_id) for the sessions that were removed.
+        """
+        session_ids = list(session_ids)
+        removed = []
+        with self._transaction() as conn:
+            # Stay below SQLite's bound parameter limit
+            for start in range(0, len(session_ids), 500):
+                chunk = session_ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = conn.execute(
+                    f'SELECT session_id, job_id FROM sessions '
+                    f'WHERE expires_at < ? AND session_id IN ({placeholders})',
+                    [now] + chunk
+                ).fetchall()
+                conn.executemany('DELETE FROM sessions WHERE session_id = ?', [(row[0],) for row in rows])
+                # Remembered so their directories can be kept for a grace period
+                conn.executemany('INSERT OR REPLACE INTO expired_sessions (session_id, expired_at) VALUES (?, ?)',
+                                 [(row[0], now) for row in rows])
+                removed.extend((row[0], row[1]) for row in rows)
+        return removed
+
+    def _lookup(self, query, session_ids):
+        conn = self._connect()
+        found = {}
+        session_ids = list(session_ids)
+        # Stay below SQLite's bound parameter limit
+        for start in range(0, len(session_ids), 500):
+            chunk = session_ids[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            found.update((row[0], row[1]) for row in conn.execute(query.format(placeholders), chunk))
+        return found
+
+    def expiries(self, session_ids):
+        """Map those of the given sessions that exist to their expiry timestamp"""
+        return self._lookup('SELECT session_id, expires_at FROM sessions WHERE session_id IN ({})', session_ids)
+
+    def expired_at(self, session_ids):
+        """Map those of the given sessions that were expired or deleted to when that happened"""
+        return self._lookup(
+            'SELECT session_id, expired_at FROM expired_sessions WHERE session_id IN ({})', session_ids)
+
+    def forget_expired(self, session_ids):
+        """Drop the expiry records of sessions whose directories are gone"""
+        with self._transaction() as conn:
+            conn.executemany('DELETE FROM expired_sessions WHERE session_id = ?', [(sid,) for sid in session_ids])
+
+    def expired_ids(self, now):
+        """Return the sessions whose expiry has passed, using the expiry index"""
+        return [row[0] for row in self._connect().execute(
+            'SELECT session_id FROM sessions WHERE expires_at < ? ORDER BY expires_at', (now,)
+        )]
+
+    def count(self):
+        return self._connect().execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def count_active(self, now):
+        """Count the sessions that have not expired by now"""
+        return self._connect().execute('SELECT COUNT(*) FROM sessions WHERE expires_at >= ?', (now,)).fetchone()[0]
+
+    def session_ids(self):
+        return [row[0] for row in self._connect().execute('SELECT session_id FROM sessions ORDER BY expires_at')]
+
+    def items(self):
+        """Yield (session_id, session) for every session, soonest expiry first"""
+        conn = self._connect()
+        files = {}
+        for row in conn.execute(
+            'SELECT session_id, original_filename, converted_filename, conversion_time '
+            'FROM session_files ORDER BY id'
+        ):
+            files.setdefault(row['session_id'], []).append({
+                'original_filename': row['original_filename'],
+                'converted_filename': row['converted_filename'],
+                'conversion_time': row['conversion_time']
+            })
+        for row in conn.execute('SELECT session_id, expires_at, job_id FROM sessions ORDER BY expires_at'):
+            yield row['session_id'], {
+                'created_at': row['expires_at'],
+                'files': files.get(row['session_id'], []),
+                'job_id': row['job_id']
+            }
+
+    def get_meta(self, key):
+        row = self._connect().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row['value'] if row else None
+
+    def set_meta(self, key, value):
+        self._connect().execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def migrate_from_json(self, json_path):
+        """Import a legacy sessions.json once, then set it aside.
+
+        Returns the number of imported sessions, or None if there was nothing
+        to do. Safe to call from several processes at the same time.
+        """
+        if self.get_meta('json_migrated') is not None or not os.path.exists(json_path):
+            return None
+
+        with open(json_path, 'r') as f:
+            loaded_data = json.load(f)
+
+        imported = 0
+        with self._transaction() as conn:
+            # Another process may have won the race
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+                return None
+            for session_id, session_data in loaded_data.items():
+                entry = parse_legacy_entry(session_data)
+                if entry is None:
+                    print(f"[DEBUG] Skipping invalid session data for {session_id}")
+                    continue
+                expires_at, files, job_id = entry
+                conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+                conn.execute(
+                    'INSERT INTO sessions (session_id, expires_at, job_id) VALUES (?, ?, ?)',
+                    (session_id, expires_at, job_id)
+                )
+                self._insert_files(conn, session_id, files)
+                imported += 1
+            conn.execute(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                ('json_migrated', str(time.time()))
+            )
+
+        try:
+            os.replace(json_path, json_path + '.migrated')
+        except OSError as e:
+            print(f"[DEBUG] Could not rename {json_path} after migration: {str(e)}")
+        return imported
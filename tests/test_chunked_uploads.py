@@ -0,0 +1,128 @@
+"""Chunked uploads: byte ranges in any order, and conversions outliving their worker."""
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytest
+from PIL import Image
+
+DATA_DIR = tempfile.mkdtemp()
+os.environ.update(
+    UPLOAD_DIR=os.path.join(DATA_DIR, 'uploads'),
+    OUTPUT_DIR=os.path.join(DATA_DIR, 'outputs'),
+    SESSION_FILE=os.path.join(DATA_DIR, 'data', 'sessions.json'),
+    EXPIRY_SWEEPER='0',
+    GC_INTERVAL='0',
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as image_convert  # noqa: E402
+from upload_store import UploadStore, is_orphaned  # noqa: E402
+
+
+@pytest.fixture(scope='module', autouse=True)
+def engine():
+    yield image_convert.conversion_engine
+    image_convert.conversion_engine.shutdown()
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = UploadStore(str(tmp_path / 'uploads.db'))
+    store.create_batch('batch', 'session', 'job', 'JPEG', {}, [('upload', 'a.png', 100, str(tmp_path / 'a.spool'))])
+    return store
+
+
+def dead_pid():
+    process = subprocess.Popen(['true'])
+    process.wait()
+    return process.pid
+
+
+def test_ranges_in_any_order(store):
+    upload, claimed = store.add_range('upload', 60, 100)
+    assert not claimed and upload['ranges'] == [[60, 100]] and upload['received'] == 40
+    store.add_range('upload', 0, 30)
+    # A retried chunk counts once
+    upload, claimed = store.add_range('upload', 0, 30)
+    assert not claimed and upload['ranges'] == [[0, 30], [60, 100]] and upload['received'] == 70
+    # The chunk that fills the last gap claims the file for conversion
+    upload, claimed = store.add_range('upload', 30, 60)
+    assert claimed and upload['ranges'] == [[0, 100]] and upload['status'] == 'converting'
+    assert upload['owner'] == os.getpid()
+    # Late duplicates don't claim it again
+    assert store.add_range('upload', 30, 60)[1] is False
+
+
+def test_reclaim_after_worker_restart(store):
+    store.add_range('upload', 0, 100)
+    # Claimed by this, live, worker
+    assert store.reclaim_orphaned('job') == []
+    store._connect().execute("UPDATE uploads SET owner = ? WHERE upload_id = 'upload'", (dead_pid(),))
+    assert is_orphaned(store.get('upload'))
+    [upload] = store.reclaim_orphaned('job')
+    assert upload['upload_id'] == 'upload' and upload['output_format'] == 'JPEG'
+    assert store.get('upload')['owner'] == os.getpid()
+    # Handed back without converting, e.g. when the server is busy
+    store.disown('upload')
+    assert [upload['upload_id'] for upload in store.reclaim_orphaned('job')] == ['upload']
+
+
+def png_bytes(size, color):
+    image = io.BytesIO()
+    Image.new('RGB', size, color).save(image, 'PNG')
+    return image.getvalue()
+
+
+def wait_for_job(client, status_url):
+    for _ in range(100):
+        job = client.get(status_url).get_json()
+        if job['status'] in ('completed', 'failed'):
+            return job
+        time.sleep(0.1)
+    raise AssertionError(f"job did not finish: {job}")
+
+
+def test_upload_chunks_in_reverse_order():
+    client = image_convert.app.test_client()
+    data = png_bytes((300, 200), 'blue')
+    response = client.post('/uploads', json={'format': 'jpeg', 'files': [{'name': 'blue.png', 'size': len(data)}]})
+    assert response.status_code == 201, response.get_json()
+    batch = response.get_json()
+    upload_url = batch['files'][0]['upload_url']
+
+    chunk_size = len(data) // 3 + 1
+    offsets = list(range(0, len(data), chunk_size))
+    for offset in reversed(offsets[1:]):
+        response = client.patch(upload_url, data=data[offset:offset + chunk_size], headers={'Upload-Offset': str(offset)})
+        assert response.status_code == 200, response.get_json()
+    assert client.get(upload_url).get_json()['missing'] == [[0, chunk_size]]
+    client.patch(upload_url, data=data[:chunk_size], headers={'Upload-Offset': '0'})
+
+    job = wait_for_job(client, batch['status_url'])
+    assert job['status'] == 'completed', job
+    output_path = os.path.join(image_convert.app.config['OUTPUT_FOLDER'], batch['session_id'], 'blue.jpeg')
+    with Image.open(output_path) as image:
+        assert image.size == (300, 200)
+        assert image.getpixel((150, 100))[2] > 200
+
+
+def test_conversion_recovered_after_worker_restart():
+    client = image_convert.app.test_client()
+    data = png_bytes((40, 30), 'red')
+    batch = client.post('/uploads', json={'format': 'jpeg', 'files': [{'name': 'red.png', 'size': len(data)}]}).get_json()
+    upload_id = batch['files'][0]['upload_url'].rstrip('/').split('/')[-1]
+    upload = image_convert.upload_store.get(upload_id)
+    with open(upload['path'], 'wb') as f:
+        f.write(data)
+    # The worker that received the last chunk was restarted before converting it
+    assert image_convert.upload_store.add_range(upload_id, 0, len(data))[1]
+    image_convert.upload_store._connect().execute(
+        'UPDATE uploads SET owner = ? WHERE upload_id = ?', (dead_pid(), upload_id))
+
+    job = wait_for_job(client, batch['status_url'])
+    assert job['status'] == 'completed' and job['results'][0]['status'] == 'success', job
+    assert os.path.exists(os.path.join(image_convert.app.config['OUTPUT_FOLDER'], batch['session_id'], 'red.jpeg'))
@@ -0,0 +1,91 @@
+"""The conversion cache: hits are hardlinks of the cached output, misses leave nothing behind."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversion_cache import ConversionCache  # noqa: E402
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ConversionCache(str(tmp_path / 'outputs' / '.cache'), max_bytes=1024)
+
+
+@pytest.fixture
+def converted(tmp_path):
+    """An output as a conversion leaves it in its session directory"""
+    session_dir = tmp_path / 'outputs' / 'first-session'
+    session_dir.mkdir(parents=True)
+    path = session_dir / 'photo.jpeg'
+    path.write_bytes(b'converted' * 10)
+    return path
+
+
+def session_path(tmp_path, name):
+    session_dir = tmp_path / 'outputs' / name
+    session_dir.mkdir(parents=True, exist_ok=True)
+    return session_dir / 'photo.jpeg'
+
+
+def test_hit_is_hardlink(tmp_path, cache, converted):
+    key = ConversionCache.make_key('content-hash', 'JPEG', {'preset': 'balanced'})
+    cache.store(key, str(converted))
+
+    output_path = session_path(tmp_path, 'second-session')
+    assert cache.materialize(key, str(output_path))
+    assert output_path.read_bytes() == converted.read_bytes()
+    assert os.stat(output_path).st_ino == os.stat(converted).st_ino
+    # The session directory only gets the output, no temporary files
+    assert os.listdir(output_path.parent) == ['photo.jpeg']
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries'], stats['bytes']) == (1, 0, 1, 90)
+
+
+def test_key_covers_format_and_options():
+    key = ConversionCache.make_key('content-hash', 'JPEG', {'preset': 'balanced', 'max_width': 100})
+    # Option order doesn't matter, the output format's case doesn't either
+    assert key == ConversionCache.make_key('content-hash', 'jpeg', {'max_width': 100, 'preset': 'balanced'})
+    assert key != ConversionCache.make_key('content-hash', 'PNG', {'preset': 'balanced', 'max_width': 100})
+    assert key != ConversionCache.make_key('content-hash', 'JPEG', {'preset': 'balanced', 'max_width': 200})
+    assert key != ConversionCache.make_key('other-hash', 'JPEG', {'preset': 'balanced', 'max_width': 100})
+
+
+def test_miss(tmp_path, cache):
+    output_path = session_path(tmp_path, 'session')
+    assert not cache.materialize(ConversionCache.make_key('content-hash', 'JPEG'), str(output_path))
+    assert not output_path.exists()
+    assert cache.stats()['misses'] == 1
+
+
+def test_file_removed_behind_index(tmp_path, cache, converted):
+    key = ConversionCache.make_key('content-hash', 'JPEG')
+    cache.store(key, str(converted))
+    # Evicted by another worker between its index update and the unlink
+    os.remove(cache._path(key))
+    assert not cache.materialize(key, str(session_path(tmp_path, 'session')))
+    assert cache.stats()['entries'] == 0
+
+
+def test_evicts_least_recently_used(tmp_path, cache):
+    keys = []
+    for number in range(3):
+        path = session_path(tmp_path, f'session-{number}')
+        path.write_bytes(b'x' * 400)
+        keys.append(ConversionCache.make_key(f'hash-{number}', 'JPEG'))
+        cache.store(keys[-1], str(path))
+        if number == 1:
+            # Makes the first entry the most recently used
+            assert cache.materialize(keys[0], str(session_path(tmp_path, 'reuse')))
+    assert not os.path.exists(cache._path(keys[1]))
+    assert os.path.exists(cache._path(keys[0])) and os.path.exists(cache._path(keys[2]))
+    assert cache.stats()['evictions'] == 1
+
+
+def test_disabled(tmp_path, converted):
+    cache = ConversionCache(str(tmp_path / 'outputs' / '.cache'), max_bytes=0)
+    key = ConversionCache.make_key('content-hash', 'JPEG')
+    cache.store(key, str(converted))
+    assert not cache.materialize(key, str(session_path(tmp_path, 'session')))
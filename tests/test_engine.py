@@ -0,0 +1,54 @@
+"""The conversion pool: per-task timeouts, and batches that share one pool."""
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import converter  # noqa: E402
+
+
+def sleep_for(input_path, *args):
+    """Stands in for convert_image() in the pool workers: input_path is how long to take"""
+    time.sleep(float(input_path))
+    return {'slept': input_path}
+
+
+def task(seconds):
+    return {'input_path': str(seconds), 'output_path': None, 'output_format': 'PNG'}
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    # Pool workers are forked after the patch, so they run sleep_for() too
+    monkeypatch.setattr(converter, 'convert_image', sleep_for)
+    engine = converter.ConversionEngine(max_workers=2, task_timeout=1.5)
+    yield engine
+    engine.shutdown()
+
+
+def test_timeout_counts_from_start(engine):
+    # Two workers, four 1 s tasks: the last two wait 1 s for a worker, which doesn't count
+    outcomes = engine.convert_batch([task(1) for _ in range(4)])
+    assert outcomes == [({'slept': '1'}, None)] * 4
+
+
+def test_timeout_spares_other_batches(engine):
+    hung = {}
+    thread = threading.Thread(target=lambda: hung.update(outcomes=engine.convert_batch([task(100)])))
+    thread.start()
+    time.sleep(0.2)
+    # These are still running or queued when the hung task's pool is torn down
+    outcomes = engine.convert_batch([task(1) for _ in range(3)])
+    thread.join()
+    assert hung['outcomes'] == [(None, 'Conversion timed out after 1.5 seconds')]
+    assert outcomes == [({'slept': '1'}, None)] * 3
+
+
+def test_timed_out_future_fails(engine):
+    future = engine.submit(task(100))
+    engine.wait_for([future])
+    assert isinstance(future.exception(), converter.ConversionTimeout)
@@ -0,0 +1,56 @@
+"""Session expiry: one elected sweeper removes sessions at their deadline."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from expiry import ExpiryScheduler  # noqa: E402
+from session_store import SessionStore  # noqa: E402
+
+NOW = 1_000_000.0
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SessionStore(str(tmp_path / 'sessions.db'))
+
+
+def test_one_sweeper(tmp_path, store):
+    lock_path = str(tmp_path / 'expiry.lock')
+    first = ExpiryScheduler(store, on_expired=None, lock_path=lock_path)
+    second = ExpiryScheduler(store, on_expired=None, lock_path=lock_path)
+    assert first._acquire_lock()
+    assert not second._acquire_lock()
+    # The lock goes with the sweeper's process; the next worker to try takes over
+    first._lock_file.close()
+    assert second._acquire_lock()
+
+
+def test_sweep_due_sessions(store):
+    expired = []
+    store.create('past', NOW - 10, job_id='job-past')
+    store.create('soon', NOW + 60)
+    store.create('later', NOW + 3600)
+    scheduler = ExpiryScheduler(store, expired.extend, interval=300)
+    scheduler._refill(NOW)
+    assert scheduler.sweep(NOW) == [('past', 'job-past')]
+    assert expired == [('past', 'job-past')] and 'past' not in store
+
+    # Extended after it was loaded into the heap: left alone
+    store.set_expiry('soon', NOW + 7200)
+    assert scheduler.sweep(NOW + 120) == []
+    assert 'soon' in store and 'later' in store
+
+
+def test_schedule_new_session(store):
+    expired = []
+    scheduler = ExpiryScheduler(store, expired.extend, interval=300)
+    scheduler.is_sweeper = True
+    scheduler._refill(NOW)
+    store.create('new', NOW + 30)
+    # Due before the next refill, so the sweeper is told directly
+    scheduler.schedule('new', NOW + 30)
+    assert scheduler.sweep(NOW + 31) == [('new', None)]
+    assert expired == [('new', None)]
@@ -0,0 +1,49 @@
+"""Multi-frame inputs keep every frame in the formats that can hold them."""
+import os
+import sys
+
+import pytest
+from PIL import Image, ImageColor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import converter  # noqa: E402
+
+COLORS = ('red', 'green', 'blue')
+
+
+@pytest.fixture
+def animated_gif(tmp_path):
+    frames = [Image.new('RGB', (40, 30), color) for color in COLORS]
+    path = tmp_path / 'animated.gif'
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=[100, 200, 300], loop=0)
+    return path
+
+
+@pytest.mark.parametrize('output_format', ['PNG', 'TIFF', 'WEBP', 'GIF'])
+def test_frames_kept(animated_gif, tmp_path, output_format):
+    output_path = tmp_path / f'converted.{output_format.lower()}'
+    result = converter.convert_image(str(animated_gif), str(output_path), output_format)
+    assert result['frames'] == len(COLORS)
+    with Image.open(output_path) as image:
+        assert image.n_frames == len(COLORS)
+        for frame, color in enumerate(COLORS):
+            image.seek(frame)
+            pixel = image.convert('RGB').getpixel((20, 15))
+            expected = ImageColor.getrgb(color)
+            # WebP is lossy
+            assert max(abs(a - b) for a, b in zip(pixel, expected)) <= 8, (frame, pixel)
+
+
+def test_frames_resized(animated_gif, tmp_path):
+    output_path = tmp_path / 'converted.png'
+    converter.convert_image(str(animated_gif), str(output_path), 'PNG', options={'scale': 0.5})
+    with Image.open(output_path) as image:
+        assert image.n_frames == len(COLORS)
+        assert image.size == (20, 15)
+
+
+def test_pdf_pages(animated_gif, tmp_path):
+    output_path = tmp_path / 'converted.pdf'
+    converter.convert_image(str(animated_gif), str(output_path), 'PDF')
+    assert output_path.read_bytes().count(b'/Type /Page\n') == len(COLORS)
@@ -0,0 +1,83 @@
+"""FILE_OFFLOAD hands downloads to the front proxy: headers only, no body.
+
+Runs against the Flask test client, standing in for nginx or Apache.
+"""
+import io
+import os
+import sys
+import tempfile
+
+import pytest
+from PIL import Image
+
+DATA_DIR = tempfile.mkdtemp()
+os.environ.update(
+    UPLOAD_DIR=os.path.join(DATA_DIR, 'uploads'),
+    OUTPUT_DIR=os.path.join(DATA_DIR, 'outputs'),
+    SESSION_FILE=os.path.join(DATA_DIR, 'data', 'sessions.json'),
+    EXPIRY_SWEEPER='0',
+    GC_INTERVAL='0',
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as image_convert  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def converted():
+    """One converted file in a fresh session"""
+    image = io.BytesIO()
+    Image.new('RGB', (64, 48), 'red').save(image, 'PNG')
+    image.seek(0)
+    response = image_convert.app.test_client().post(
+        '/upload', data={'format': 'JPEG', 'files[]': [(image, 'red.png')]}, content_type='multipart/form-data')
+    assert response.status_code == 200, response.get_json()
+    data = response.get_json()
+    yield data['session_id'], data['results'][0]
+    image_convert.conversion_engine.shutdown()
+
+
+@pytest.fixture(params=['x-accel', 'x-sendfile'])
+def offload(request, monkeypatch):
+    monkeypatch.setitem(image_convert.app.config, 'FILE_OFFLOAD', request.param)
+    return request.param
+
+
+def check_offloaded(response, offload, relative_path):
+    assert response.status_code == 200
+    assert response.get_data() == b''
+    if offload == 'x-accel':
+        assert 'X-Sendfile' not in response.headers
+        assert response.headers['X-Accel-Redirect'] == image_convert.app.config['OFFLOAD_PREFIX'] + relative_path
+    else:
+        assert 'X-Accel-Redirect' not in response.headers
+        assert response.headers['X-Sendfile'] == os.path.join(image_convert.app.config['OUTPUT_FOLDER'], relative_path)
+
+
+def test_download(converted, offload):
+    session_id, file_info = converted
+    response = image_convert.app.test_client().get(file_info['download_url'])
+    check_offloaded(response, offload, f"{session_id}/{file_info['converted']}")
+    assert response.headers['Content-Type'] == 'image/jpeg'
+    assert response.headers['Content-Disposition'].startswith('attachment')
+
+
+def test_download_all(converted, offload):
+    session_id, _ = converted
+    response = image_convert.app.test_client().get(f'/download-all/{session_id}')
+    check_offloaded(response, offload, f"{session_id}_converted.zip")
+    assert response.headers['Content-Type'] == 'application/zip'
+
+
+def test_preview(converted, offload):
+    session_id, file_info = converted
+    response = image_convert.app.test_client().get(file_info['preview_url'])
+    check_offloaded(response, offload, f"{session_id}/.previews/{file_info['converted']}.webp")
+    assert response.headers['Content-Type'] == 'image/webp'
+
+
+def test_missing_file(converted, offload):
+    session_id, _ = converted
+    response = image_convert.app.test_client().get(f'/download/{session_id}/missing.jpeg')
+    assert response.status_code == 404
+    assert 'X-Accel-Redirect' not in response.headers and 'X-Sendfile' not in response.headers
@@ -0,0 +1,92 @@
+"""The output GC: expired session directories go after their grace period, the rest to fit the budget."""
+import os
+import sys
+import time
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from output_gc import OutputCollector  # noqa: E402
+from session_store import SessionStore  # noqa: E402
+
+GRACE = 3600
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SessionStore(str(tmp_path / 'sessions.db'))
+
+
+@pytest.fixture
+def output_dir(tmp_path):
+    path = tmp_path / 'outputs'
+    path.mkdir()
+    return path
+
+
+def session_dir(output_dir, size=100, age=0):
+    """A session directory holding one file of size bytes, last changed age seconds ago"""
+    session_id = str(uuid.uuid4())
+    path = output_dir / session_id
+    path.mkdir()
+    (path / 'photo.jpeg').write_bytes(b'x' * size)
+    changed = time.time() - age
+    os.utime(path, (changed, changed))
+    return session_id
+
+
+def test_one_collector(tmp_path, store, output_dir):
+    lock_path = str(tmp_path / 'gc.lock')
+    first = OutputCollector(str(output_dir), store, GRACE, lock_path=lock_path)
+    second = OutputCollector(str(output_dir), store, GRACE, lock_path=lock_path)
+    assert first._acquire_lock()
+    assert not second._acquire_lock()
+    first._lock_file.close()
+    assert second._acquire_lock()
+
+
+def test_expired_after_grace(tmp_path, store, output_dir):
+    now = time.time()
+    active = session_dir(output_dir)
+    store.create(active, now + 600)
+    in_grace = session_dir(output_dir)
+    store.create(in_grace, now - 120)
+    past_grace = session_dir(output_dir)
+    store.create(past_grace, now - 2 * GRACE)
+    # Expired by the sweeper at those times
+    store.delete_expired([in_grace], now - 60)
+    store.delete_expired([past_grace], now - GRACE - 60)
+    # Never known to the store: counts from its last change
+    unknown = session_dir(output_dir, age=2 * GRACE)
+    (output_dir / '.cache').mkdir()
+
+    collector = OutputCollector(str(output_dir), store, GRACE, report_path=str(tmp_path / 'gc.json'), pause=0)
+    report = collector.sweep(now)
+    assert sorted(os.listdir(output_dir)) == sorted(['.cache', active, in_grace])
+    assert report['scanned'] == 4
+    assert report['reclaimed']['expired']['sessions'] == 2
+    assert collector.last_report() == report
+    # Removed directories are forgotten
+    assert store.expired_at([past_grace, unknown]) == {}
+
+
+def test_evicts_to_budget(store, output_dir):
+    now = time.time()
+    expired = session_dir(output_dir, size=40000, age=60)
+    store.create(expired, now - 120)
+    store.delete_expired([expired], now - 60)
+    soon = session_dir(output_dir, size=40000, age=60)
+    store.create(soon, now + 600)
+    later = session_dir(output_dir, size=40000, age=60)
+    store.create(later, now + 1200)
+    evicted = []
+
+    collector = OutputCollector(str(output_dir), store, GRACE, max_bytes=60000, pause=0, on_evict=evicted.append)
+    report = collector.sweep(now)
+    # The expired directory goes first, then the active session expiring soonest
+    assert os.listdir(output_dir) == [later]
+    assert evicted == [soon]
+    assert report['reclaimed']['budget']['sessions'] == 2
+    assert not report['over_budget']
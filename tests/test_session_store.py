@@ -0,0 +1,61 @@
+"""The SQLite session store and its one-time import of the legacy sessions.json."""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session_store import SessionStore  # noqa: E402
+
+CONVERTED = {'original_filename': 'a.png', 'converted_filename': 'a.jpeg', 'conversion_time': 0.25}
+
+
+@pytest.fixture
+def legacy_file(tmp_path):
+    """A sessions.json with every shape the app ever wrote"""
+    path = tmp_path / 'sessions.json'
+    path.write_text(json.dumps({
+        # The current shape: created_at holds the expiry time
+        'full': {'created_at': 2000.5, 'files': [CONVERTED], 'job_id': 'job-1'},
+        'no-files': {'created_at': 3000},
+        # Older versions stored only the expiry time, as a number or a string
+        'number': 1500,
+        'string': '2500.25',
+        'unreadable': 'soon',
+    }))
+    return path
+
+
+def test_migrate_legacy_shapes(tmp_path, legacy_file):
+    store = SessionStore(str(tmp_path / 'sessions.db'))
+    assert store.migrate_from_json(str(legacy_file)) == 4
+    assert store.get('full') == {'created_at': 2000.5, 'files': [CONVERTED], 'job_id': 'job-1'}
+    assert store.get('no-files') == {'created_at': 3000, 'files': [], 'job_id': None}
+    assert store.get('number') == {'created_at': 1500, 'files': [], 'job_id': None}
+    assert store.get('string') == {'created_at': 2500.25, 'files': [], 'job_id': None}
+    assert 'unreadable' not in store
+    # Soonest expiry first
+    assert store.session_ids() == ['number', 'full', 'string', 'no-files']
+
+
+def test_migrate_once(tmp_path, legacy_file):
+    store = SessionStore(str(tmp_path / 'sessions.db'))
+    assert store.migrate_from_json(str(legacy_file)) == 4
+    assert not legacy_file.exists()
+    assert (tmp_path / 'sessions.json.migrated').exists()
+    assert store.get_meta('json_migrated') is not None
+
+    # Another worker starting up, even with the file put back, imports nothing
+    store.create('full', 9000)
+    os.replace(tmp_path / 'sessions.json.migrated', legacy_file)
+    other = SessionStore(str(tmp_path / 'sessions.db'))
+    assert other.migrate_from_json(str(legacy_file)) is None
+    assert other.expires_at('full') == 9000
+
+
+def test_missing_legacy_file(tmp_path):
+    store = SessionStore(str(tmp_path / 'sessions.db'))
+    assert store.migrate_from_json(str(tmp_path / 'sessions.json')) is None
+    assert store.count() == 0
@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from admission import pid_alive
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS batches (
+    batch_id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    output_format TEXT NOT NULL,
+    options TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS batches_session_id ON batches (session_id);
+CREATE INDEX IF NOT EXISTS batches_job_id ON batches (job_id);
+
+CREATE TABLE IF NOT EXISTS uploads (
+    upload_id TEXT PRIMARY KEY,
+    batch_id TEXT NOT NULL REFERENCES batches (batch_id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    ranges TEXT NOT NULL DEFAULT '[]',
+    received INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'receiving',
+    result TEXT,
+    started_at REAL,
+    completed_at REAL,
+    owner INTEGER
+);
+CREATE INDEX IF NOT EXISTS uploads_batch_id ON uploads (batch_id, position);
+"""
+
+# Upload states: bytes still missing, being converted, or done either way
+RECEIVING = 'receiving'
+CONVERTING = 'converting'
+FINISHED = ('success', 'error')
+
+
+def is_orphaned(upload):
+    """Whether an upload is claimed for conversion by no live worker"""
+    if upload['status'] != CONVERTING:
+        return False
+    owner = upload['owner']
+    return owner is None or (owner != os.getpid() and not pid_alive(owner))
+
+
+def merge_range(ranges, start, end):
+    """Add the byte range [start, end) to a sorted list of disjoint ranges"""
+    merged = []
+    for low, high in ranges:
+        if high < start or low > end:
+            merged.append([low, high])
+        else:
+            start, end = min(start, low), max(end, high)
+    merged.append([start, end])
+    return sorted(merged)
+
+
+def missing_ranges(ranges, size):
+    """The byte ranges of [0, size) not covered by ranges"""
+    missing = []
+    offset = 0
+    for low, high in ranges:
+        if low > offset:
+            missing.append([offset, low])
+        offset = max(offset, high)
+    if offset < size:
+        missing.append([offset, size])
+    return missing
+
+
+class UploadStore:
+    """Chunked uploads in progress, shared by every worker through SQLite.
+
+    A batch is what a single multipart POST to /upload used to be: one
+    session, one output format and options, and a list of files. Each file
+    is spooled to its own path; chunks may arrive in any order and on any
+    worker, and are recorded as received byte ranges. The worker that
+    records the last missing range claims the file for conversion. A
+    claim made by a worker that has since died is taken over by the next
+    worker asking for the batch, see reclaim_orphaned().
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        # Databases created before claims recorded their worker
+        if 'owner' not in {row['name'] for row in conn.execute('PRAGMA table_info(uploads)')}:
+            conn.execute('ALTER TABLE uploads ADD COLUMN owner INTEGER')
+
+    def _connect(self):
+        # One connection per thread, reopened after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    @staticmethod
+    def _upload(row):
+        upload = dict(row)
+        upload['ranges'] = json.loads(upload['ranges'])
+        upload['result'] = json.loads(upload['result']) if upload['result'] else None
+        if 'options' in upload:
+            upload['options'] = json.loads(upload['options'])
+        return upload
+
+    def _get(self, conn, upload_id):
+        row = conn.execute(
+            'SELECT uploads.*, batches.session_id, batches.job_id, batches.output_format, batches.options '
+            'FROM uploads JOIN batches USING (batch_id) WHERE upload_id = ?', (upload_id,)
+        ).fetchone()
+        return self._upload(row) if row else None
+
+    def create_batch(self, batch_id, session_id, job_id, output_format, options, files):
+        """Record a batch; files are (upload_id, filename, size, spool path) in upload order"""
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT INTO batches (batch_id, session_id, job_id, output_format, options, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (batch_id, session_id, job_id, output_format, json.dumps(options), time.time())
+            )
+            conn.executemany(
+                'INSERT INTO uploads (upload_id, batch_id, position, filename, size, path) VALUES (?, ?, ?, ?, ?, ?)',
+                [(upload_id, batch_id, position, filename, size, path)
+                 for position, (upload_id, filename, size, path) in enumerate(files)]
+            )
+
+    def get(self, upload_id):
+        """Return an upload with the format and options of its batch, or None"""
+        return self._get(self._connect(), upload_id)
+
+    def add_range(self, upload_id, start, end):
+        """Record that bytes [start, end) of an upload were written.
+
+        Returns (upload, claimed), where claimed is True for exactly one
+        caller: the one whose range completed the file. That caller has to
+        convert it, or hand it back with release().
+        """
+        with self._transaction() as conn:
+            upload = self._get(conn, upload_id)
+            if upload is None:
+                return None, False
+            if upload['status'] != RECEIVING:
+                return upload, False
+            now = time.time()
+            if end > start:
+                upload['ranges'] = merge_range(upload['ranges'], start, end)
+            upload['received'] = sum(high - low for low, high in upload['ranges'])
+            upload['started_at'] = upload['started_at'] or now
+            claimed = upload['received'] >= upload['size']
+            if claimed:
+                upload['status'] = CONVERTING
+                upload['completed_at'] = now
+                upload['owner'] = os.getpid()
+            conn.execute(
+                'UPDATE uploads SET ranges = ?, received = ?, status = ?, started_at = ?, completed_at = ?, owner = ? '
+                'WHERE upload_id = ?',
+                (json.dumps(upload['ranges']), upload['received'], upload['status'], upload['started_at'],
+                 upload['completed_at'], upload['owner'], upload_id)
+            )
+            return upload, claimed
+
+    def release(self, upload_id):
+        """Hand a claimed upload back, so the next chunk request for it claims it again"""
+        self._connect().execute(
+            'UPDATE uploads SET status = ?, owner = NULL WHERE upload_id = ? AND status = ?',
+            (RECEIVING, upload_id, CONVERTING)
+        )
+
+    def reclaim_orphaned(self, job_id):
+        """Claim the files of a batch whose conversion no live worker owns.
+
+        The worker converting a file may be restarted before it records
+        the outcome. Its claims are taken over by the caller, which has to
+        convert those files, or give them up with disown(). Returns the
+        uploads that were claimed.
+        """
+        with self._transaction() as conn:
+            orphaned = [self._upload(row) for row in conn.execute(
+                'SELECT uploads.*, batches.session_id, batches.job_id, batches.output_format, batches.options '
+                'FROM uploads JOIN batches USING (batch_id) WHERE batches.job_id = ? AND uploads.status = ?',
+                (job_id, CONVERTING)
+            )]
+            orphaned = [upload for upload in orphaned if is_orphaned(upload)]
+            conn.executemany('UPDATE uploads SET owner = ? WHERE upload_id = ?',
+                             [(os.getpid(), upload['upload_id']) for upload in orphaned])
+            return orphaned
+
+    def disown(self, upload_id):
+        """Give up a claimed file without converting it, for the next reclaim_orphaned() to take"""
+        self._connect().execute(
+            'UPDATE uploads SET owner = NULL WHERE upload_id = ? AND status = ?', (upload_id, CONVERTING)
+        )
+
+    def finish(self, upload_id, result):
+        """Store the outcome of a conversion.
+
+        Returns the uploads of the batch if this was the last file of it
+        to finish, once per batch, and None otherwise.
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE uploads SET status = ?, result = ? WHERE upload_id = ?',
+                (result['status'], json.dumps(result), upload_id)
+            )
+            row = conn.execute('SELECT batch_id FROM uploads WHERE upload_id = ?', (upload_id,)).fetchone()
+            if row is None:
+                return None
+            uploads = self._uploads(conn, row['batch_id'])
+            if any(upload['status'] not in FINISHED for upload in uploads):
+                return None
+            cursor = conn.execute(
+                'UPDATE batches SET finished_at = ? WHERE batch_id = ? AND finished_at IS NULL',
+                (time.time(), row['batch_id'])
+            )
+            return uploads if cursor.rowcount else None
+
+    def _uploads(self, conn, batch_id):
+        return [self._upload(row) for row in conn.execute(
+            'SELECT * FROM uploads WHERE batch_id = ? ORDER BY position', (batch_id,))]
+
+    def progress(self, job_id):
+        """Return (batch, uploads) of the batch run by a job, or None if it isn't a chunked upload"""
+        conn = self._connect()
+        row = conn.execute('SELECT * FROM batches WHERE job_id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(row), self._uploads(conn, row['batch_id'])
+
+    def discard_session(self, session_id):
+        """Forget the batches of a session; returns the spool paths of files that were never converted"""
+        with self._transaction() as conn:
+            paths = [row['path'] for row in conn.execute(
+                'SELECT path FROM uploads JOIN batches USING (batch_id) WHERE session_id = ? AND status = ?',
+                (session_id, RECEIVING)
+            )]
+            conn.execute('DELETE FROM batches WHERE session_id = ?', (session_id,))
+            return paths